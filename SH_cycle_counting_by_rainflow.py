@@ -1,77 +1,57 @@
 import csv
 import numpy as np
 import math
-import scipy
-import matplotlib.pyplot as plt
 
 
 # Finds peaks and valleys in a SoC time series and returns a reduced time series that only
-# contains these peaks and valleys (all other data points are deleted). The function also finds
-# the periods when the battery is idling at the same SoC (defined as the time when the SoC
-# changes by less than 5e-6); this info is stored in the idle array.
+# contains these peaks and valleys (all other data points are deleted). Points where the battery
+# is idling at the same SoC (defined as the time when the SoC changes by less than 5e-6) are
+# deleted first.
 def find_pkvl_and_idle(SoC):
-	SoC = np.array(SoC)
-	dlt = []
-	idle = []
-
-    # This loop goes through each element of the SoC array and if the element is different to
-	# the adjacent elements, then it is left alone. If the element is the same as the adjacent
-	# elements (within 5e-6), then its index is recorded in the delete list and the idle array.
-	# There is a flaw in this method: the SoC could increase from 0.4 to 0.8 in increments of
-	# 4e-6, for example, but the method would recognise the battery as idling the entire time!
-	for i in range(0,SoC.size):
-		if i==0:
-			if np.isclose(SoC[i], SoC[i+1], rtol=0, atol=5e-6):
-				dlt.append(i)
-				idle.append(SoC[i])
-		if i==SoC.size-1:
-			if np.isclose(SoC[i], SoC[i-1], rtol=0, atol=5e-6):
-				dlt.append(i)
-				idle.append(SoC[i])		
-		elif (np.isclose(SoC[i-1], SoC[i], rtol=0, atol=5e-6) and np.isclose(SoC[i],
-		SoC[i+1], rtol=0, atol=5e-6)):
-			dlt.append(i)
-			idle.append(SoC[i])
-		else:
-			continue
-
-	idle = np.array(idle)
-	idle = 1e5*np.round(idle, decimals=5)
-	idle = idle.astype(int)
+	SoC = np.array(SoC, dtype=float)
+	return SoC[find_pkvl_index(SoC)[1]]
+
+
+# Returns the indexes in SoC of the points left once idle points are deleted (SoC_noflat below)
+# and, of those, of the peaks and valleys that find_pkvl_and_idle keeps. Each point is kept or
+# deleted by comparing it with its neighbours only (up to two kept points back and one forward),
+# which is what lets the streaming counter below work on the series a chunk at a time.
+def find_pkvl_index(SoC):
+	SoC = np.asarray(SoC, dtype=float)
+
+	# An element is idle (and deleted) if it is the same as both adjacent elements (within 5e-6).
+	# The first and last elements only have one neighbour to compare with. The comparisons are
+	# made on the whole array at once. There is a flaw in this method: the SoC could increase
+	# from 0.4 to 0.8 in increments of 4e-6, for example, but the method would recognise the
+	# battery as idling the entire time!
+	close = np.abs(np.diff(SoC)) <= 5e-6
+	dlt = np.zeros(SoC.size, dtype=bool)
+	dlt[0] = close[0]
+	dlt[-1] = close[-1]
+	dlt[1:-1] = close[:-1] & close[1:]
 
 	# A new array is created 'SoC_noflat' that is the same as 'SoC' but with the flat sections
 	# removed. Only one data point from a flat section is kept (the one that's furthest to the
-	# right). dlt must be a list not a numpy array.
-	SoC_noflat = np.delete(SoC, dlt)
-	
-	dlt = []
-
-	# This loop goes through each element of the SoC_noflat array and if the element is a peak
-	# or a valley, then it is left alone. If the element is not a peak or a valley, then its
-	# index is recorded in the delete list.
-	for i in range(1,SoC_noflat.size-1):
-		if SoC_noflat[i] == SoC_noflat[i-1]:
-			if SoC_noflat[i] > SoC_noflat[i-2] and SoC_noflat[i] > SoC_noflat[i+1]:
-				continue
-			if SoC_noflat[i] < SoC_noflat[i-2] and SoC_noflat[i] < SoC_noflat[i+1]:
-				continue
-			if SoC_noflat[i] > SoC_noflat[i-2] and SoC_noflat[i] < SoC_noflat[i+1]:
-				dlt.append(i)
-			if SoC_noflat[i] < SoC_noflat[i-2] and SoC_noflat[i] > SoC_noflat[i+1]:
-				dlt.append(i)
-		else:
-			if SoC_noflat[i] > SoC_noflat[i-1] and SoC_noflat[i] > SoC_noflat[i+1]:
-				continue
-			elif SoC_noflat[i] < SoC_noflat[i-1] and SoC_noflat[i] < SoC_noflat[i+1]:
-				continue
-			else:
-				dlt.append(i)
-
-	#A new array is created 'SoC_pkvl' that only contains alternate peaks and valleys.
-	SoC_pkvl = np.delete(SoC_noflat, dlt)
-
-	#return(SoC_pkvl, SoC_noflat, idle)
-	return(SoC_pkvl)
+	# right).
+	noflat = np.flatnonzero(~dlt)
+	SoC_noflat = SoC[noflat]
+
+	# Elements that are not a peak or a valley are deleted. Where an element equals the one
+	# before it (the two ends of a flat section), it is compared with the element two places
+	# back instead. Note that for the second element this wraps round to the last element, as
+	# the original element-by-element loop did with SoC_noflat[i-2].
+	x = SoC_noflat
+	dlt = np.zeros(x.size, dtype=bool)
+	if x.size >= 3:
+		cur, prev, nxt = x[1:-1], x[:-2], x[2:]
+		prev2 = np.concatenate([x[-1:], x[:-3]])  # x[i-2], i.e. np.roll(x, 2)[1:-1]
+		flat = cur == prev
+		dlt_flat = ((cur > prev2) & (cur < nxt)) | ((cur < prev2) & (cur > nxt))
+		dlt_step = ~(((cur > prev) & (cur > nxt)) | ((cur < prev) & (cur < nxt)))
+		dlt[1:-1] = np.where(flat, dlt_flat, dlt_step)
+
+	#The indexes of 'SoC_pkvl', which only contains alternate peaks and valleys.
+	return noflat, noflat[~dlt]
 
 
 # Finds half and whole cycles within the SoC_pkvl time series. Two arrays are created (one for
@@ -79,50 +59,138 @@ def find_pkvl_and_idle(SoC):
 # in the 2nd row.
 def rfc_find_cycles(SoC_pkvl):
 
-	v = np.array([]) #Rainflow counting vector (1D)
-	hc = np.array([[],[]]) #Stores the cycle depth and average SoC of half-cycles (2D)
-	wc = np.array([[],[]]) #Stores the cycle depth and average SoC of whole-cycles (2D)
-	v = np.append(v, SoC_pkvl[0])
-	v = np.append(v, SoC_pkvl[1])
+	pts = np.asarray(SoC_pkvl, dtype=float).tolist()
+	n = len(pts)
+	# Rainflow counting vector, preallocated. The live stack is v[lo:hi]; half-cycles taken
+	# from the bottom of the stack just move lo up, so nothing is ever reallocated or shifted.
+	v = [0.0]*n
+	lo, hi = 0, 0
+	hc = np.empty((2, n)) #Stores the cycle depth and average SoC of half-cycles (2D)
+	wc = np.empty((2, n)) #Stores the cycle depth and average SoC of whole-cycles (2D)
+	n_hc, n_wc = 0, 0
 
 	#This is the algorithm as described in the ASTM paper
-	for i in range(2,SoC_pkvl.size):
+	for i in range(0, n):
 
-		v = np.append(v, SoC_pkvl[i])
-		while v.size >= 3:
-			x = abs(v[-2] - v[-1])
-			y = abs(v[-3] - v[-2])
+		v[hi] = pts[i]
+		hi += 1
+		while hi - lo >= 3:
+			x = abs(v[hi-2] - v[hi-1])
+			y = abs(v[hi-3] - v[hi-2])
 			if x < y:
 				break
 			else:
-				if v.size == 3:
-					hc = np.append(hc, [[y],[(v[-3]+v[-2])/2]], axis=1)
-					v = np.delete(v, -3)
+				if hi - lo == 3:
+					hc[0, n_hc], hc[1, n_hc] = y, (v[hi-3]+v[hi-2])/2
+					n_hc += 1
+					lo += 1
 				else:
-					wc = np.append(wc, [[y],[(v[-3]+v[-2])/2]], axis=1)
-					v = np.delete(v, -2)
-					v = np.delete(v, -2)
-	for i in range(0,v.size-1):
+					wc[0, n_wc], wc[1, n_wc] = y, (v[hi-3]+v[hi-2])/2
+					n_wc += 1
+					v[hi-3] = v[hi-1]
+					hi -= 2
+	for i in range(lo, hi-1):
 		y = abs(v[i]-v[i+1])
-		hc = np.append(hc, [[y],[(v[i]+v[i+1])/2]], axis=1)
+		hc[0, n_hc], hc[1, n_hc] = y, (v[i]+v[i+1])/2
+		n_hc += 1
 
-	hc = 1*np.round(hc, decimals=5)
-	wc = 1*np.round(wc, decimals=5)
+	hc = 1*np.round(hc[:, :n_hc], decimals=5)
+	wc = 1*np.round(wc[:, :n_wc], decimals=5)
 
 	#This is a very important step! If the elements in the arrays stay as floats then '=='
 	#comparisons later don't always work.
 	#hc = hc.astype(int)
 	#wc = wc.astype(int)
 
-	#print(np.size(hc,axis=1))
-	#print(np.size(wc,axis=1))
-
 	hc = hc[:, hc[0,:]!=0]
 	wc = wc[:, wc[0,:]!=0]
 
-	#print(np.size(hc,axis=1))
-	#print(np.size(wc,axis=1))
-	
+	return hc, wc
 
 
-	return hc, wc
+# Pushes reversals onto a rainflow counting stack (a list) one after another and moves the
+# cycles they close into the hc and wc lists as [depth, average SoC] pairs. This is the same
+# ASTM step as in rfc_find_cycles, used by the streaming counter below.
+def rfc_count(stack, values, hc, wc):
+	# As in rfc_find_cycles, the live stack is v[lo:hi] of a preallocated vector, and is copied
+	# back into stack at the end.
+	v = stack + [0.0]*len(values)
+	lo, hi = 0, len(stack)
+	for value in values:
+		v[hi] = value
+		hi += 1
+		while hi - lo >= 3:
+			x = abs(v[hi-2] - v[hi-1])
+			y = abs(v[hi-3] - v[hi-2])
+			if x < y:
+				break
+			if hi - lo == 3:
+				hc.append([y, (v[hi-3]+v[hi-2])/2])
+				lo += 1
+			else:
+				wc.append([y, (v[hi-3]+v[hi-2])/2])
+				v[hi-3] = v[hi-1]
+				hi -= 2
+	stack[:] = v[lo:hi]
+
+
+# Rounds [depth, average SoC] pairs and returns them in the 2-row format of rfc_find_cycles.
+def rfc_format_cycles(cycles):
+	if not cycles:
+		return np.empty((2, 0))
+	cycles = 1*np.round(np.array(cycles, dtype=float).reshape(-1, 2).T, decimals=5)
+	return cycles[:, cycles[0,:]!=0]
+
+
+# Streaming rainflow counter. The state is a plain dict holding the residual stack and the tail
+# of the SoC series whose peaks and valleys are not yet final (a point is only final once the
+# points after it are known), with the index in the series of the tail's first point ('start')
+# and the index from which peaks and valleys have not yet been counted ('next'). SoC can then be
+# fed in day by day (e.g. from the scenario loop) without keeping the whole SoC history in
+# memory. The state only holds lists and ints, so it can be saved along with BESS_dict.
+def rfc_stream_init():
+	return {'stack': [], 'tail': [], 'start': 0, 'next': 0}
+
+
+# Feeds a chunk of SoC into the streaming counter and returns the half-cycles and whole-cycles
+# closed by it (same format as rfc_find_cycles). The tail and the chunk are reduced to peaks and
+# valleys at once by find_pkvl_index, and those that are final are counted. Over a whole series
+# the cycles are those of rfc_find_cycles(find_pkvl_and_idle(SoC)), in the same order, with the
+# half-cycles still open at the end returned by rfc_stream_residual.
+def rfc_stream_update(state, SoC_chunk):
+	tail = np.concatenate([state['tail'], np.asarray(SoC_chunk, dtype=float)])
+	hc, wc = [], []
+	n = tail.size
+	if n >= 3:
+		noflat, pkvl = find_pkvl_index(tail)
+		# Kept points whose idle test saw both neighbours (the first point of the series has one)
+		exact = noflat[(noflat >= (1 if state['start'] else 0)) & (noflat <= n-2)]
+		if exact.size >= 2:
+			# The peak and valley tests are final for the points before the last exact one
+			until = int(exact[-1])
+			new = pkvl[(pkvl >= state['next'] - state['start']) & (pkvl < until)]
+			rfc_count(state['stack'], tail[new].tolist(), hc, wc)
+			state['next'] = state['start'] + until
+			if exact.size >= 3:
+				# Keep the two points before the last exact one, and the point before them, as the
+				# neighbours its tests need
+				cut = max(int(exact[-3]) - 1, 0)
+				tail = tail[cut:]
+				state['start'] += cut
+	state['tail'] = tail.tolist()
+	return rfc_format_cycles(hc), rfc_format_cycles(wc)
+
+
+# Returns the half-cycles and whole-cycles rfc_find_cycles would still count at the end of the
+# series: those closed by the peaks and valleys of the tail, once its last point is known to be
+# the end, and the half-cycles left in the stack. The state is not changed.
+def rfc_stream_residual(state):
+	tail = np.asarray(state['tail'], dtype=float)
+	stack, hc, wc = list(state['stack']), [], []
+	if tail.size >= 2:
+		pkvl = find_pkvl_index(tail)[1]
+		rfc_count(stack, tail[pkvl[pkvl >= state['next'] - state['start']]].tolist(), hc, wc)
+	elif tail.size == 1 and state['next'] == 0:
+		stack.append(float(tail[0]))
+	hc += [[abs(stack[i]-stack[i+1]), (stack[i]+stack[i+1])/2] for i in range(len(stack)-1)]
+	return rfc_format_cycles(hc), rfc_format_cycles(wc)
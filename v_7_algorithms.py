@@ -1,74 +1,412 @@
-﻿# coding: utf-8
-####################
-# Import libraries #
-####################
-# Importing libraries within function is not allowed so it is done here
-from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
-
-# For data_mgmt_by_list
-import pandas as pd  # CSV handling
-import math
-
-# for price_dict
-import datetime  # For time stamping optimisation process
-
-# For nlp_scheduler
-from pyomo.environ import *
-from pyomo.common.timing import report_timing
-from pyomo.gdp import *
-from pyomo.opt import SolverFactory
-
-
-def opt_peak_shave_rules_ASAP(s_dict, BESS_dict, load, K, peak_demands_m):
-    """Rules based peak shaving algorithm."""
-
-    # Index sets #
-    # Primary index
-    T = range(len(load))
-    # Time-step (h)
-    time_step = s_dict['time-step_h']
-
-    ################
-    """Parameters"""
-    ################
-    # Generic scalar BESS params
-    p_max = s_dict['P_inv_cont'] * s_dict['P_cap']  # kW
-    C = BESS_dict['C']
-    soc_min = s_dict['SOC_min']
-    soc_max = s_dict['SOC_max']
-    # BESS specific params
-    eff =BESS_dict['Eff_LP'] # Leave as python float to avoid slow sqrt performance
-
-    # Here comes the peak shaving algorithm
-    soc_0 = s_dict['SOC_0']  # Initialise SOC at start of period
-    c_log, d_log, soc_log =[], [], []
-    for t in T:
-        # Charge battery?
-        if load[t] < peak_demands_m[K[t]]:
-            d_log += [0]
-            c = min(p_max, peak_demands_m[K[t]] - load[t])  # Power constrained charging
-            if soc_0 + (c * time_step * math.sqrt(eff))/C <= soc_max:
-                soc = soc_0 + (c * time_step * math.sqrt(eff))/C
-            else:
-                c = (soc_max - soc_0)*C/(time_step*math.sqrt(eff)) # SOC constrained charging, derate power
-                soc = soc_max  # Update SOC counter
-            c_log += [c]
-            soc_log += [soc]
-            soc_0 = soc  # Update SOC counter
-        else: # Discharge battery
-            c_log += [0]
-            d = min(p_max, load[t] - peak_demands_m[K[t]])  # Power constrained discharging
-            if soc_0 - (d * time_step)/(math.sqrt(eff) * C) >= soc_min:
-                soc = soc_0 - (d * time_step)/(math.sqrt(eff) * C)
-            else:
-                d = (soc_0 - soc_min)* C * math.sqrt(eff)/time_step # SOC constrained discharging, derate power
-                soc = soc_min
-            d_log += [d]
-            soc_log += [soc]
-            soc_0 = soc  # Update SOC counter
-            # If BESS is unable to keep net load below the peak so far for the month, record must be updated.
-            if load[t] - d > peak_demands_m[K[t]]:
-                peak_demands_m[K[t]] = load[t] - d
-    return c_log, d_log, soc_log, peak_demands_m
-
-
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+# Importing libraries within function is not allowed so it is done here
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+
+# For data_mgmt_by_list
+import pandas as pd  # CSV handling
+import numpy as np  # Typed arrays for the dispatch kernels
+import math
+
+# for price_dict
+import datetime  # For time stamping optimisation process
+
+import importlib  # Optional dependencies (e.g. Pyomo) are imported on first use
+
+# Optional JIT compilation of the dispatch kernel
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def optional_import(module, needed_for):
+    """Imports an optional dependency when a scenario first needs it, e.g. Pyomo for optimisation formulations, so the
+    rules based path (and every pool worker) starts without it. Raises ImportError naming what needed it."""
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(module + ' is required for ' + needed_for + ' but could not be imported: ' + str(e)) from e
+
+
+def opt_peak_shave_rules_ASAP(s_dict, BESS_dict, load, K, peak_demands_m):
+    """Rules based peak shaving algorithm."""
+
+    # Index sets #
+    # Primary index
+    T = range(len(load))
+    # Time-step (h)
+    time_step = s_dict['time-step_h']
+
+    ################
+    """Parameters"""
+    ################
+    # Generic scalar BESS params
+    p_max = s_dict['P_inv_cont'] * s_dict['P_cap']  # kW
+    C = BESS_dict['C']
+    soc_min = s_dict['SOC_min']
+    soc_max = s_dict['SOC_max']
+    # BESS specific params
+    eff =BESS_dict['Eff_LP'] # Leave as python float to avoid slow sqrt performance
+
+    # Here comes the peak shaving algorithm
+    soc_0 = s_dict['SOC_0']  # Initialise SOC at start of period
+    c_log, d_log, soc_log =[], [], []
+    for t in T:
+        # Charge battery?
+        if load[t] < peak_demands_m[K[t]]:
+            d_log += [0]
+            c = min(p_max, peak_demands_m[K[t]] - load[t])  # Power constrained charging
+            if soc_0 + (c * time_step * math.sqrt(eff))/C <= soc_max:
+                soc = soc_0 + (c * time_step * math.sqrt(eff))/C
+            else:
+                c = (soc_max - soc_0)*C/(time_step*math.sqrt(eff)) # SOC constrained charging, derate power
+                soc = soc_max  # Update SOC counter
+            c_log += [c]
+            soc_log += [soc]
+            soc_0 = soc  # Update SOC counter
+        else: # Discharge battery
+            c_log += [0]
+            d = min(p_max, load[t] - peak_demands_m[K[t]])  # Power constrained discharging
+            if soc_0 - (d * time_step)/(math.sqrt(eff) * C) >= soc_min:
+                soc = soc_0 - (d * time_step)/(math.sqrt(eff) * C)
+            else:
+                d = (soc_0 - soc_min)* C * math.sqrt(eff)/time_step # SOC constrained discharging, derate power
+                soc = soc_min
+            d_log += [d]
+            soc_log += [soc]
+            soc_0 = soc  # Update SOC counter
+            # If BESS is unable to keep net load below the peak so far for the month, record must be updated.
+            if load[t] - d > peak_demands_m[K[t]]:
+                peak_demands_m[K[t]] = load[t] - d
+    return c_log, d_log, soc_log, peak_demands_m
+
+
+def _peak_shave_kernel(load, K, peak, p_max, C, soc_min, soc_max, soc_0, time_step, sqrt_eff, c_log, d_log, soc_log):
+    """State machine at the core of opt_peak_shave_rules_ASAP_fast. peak is indexed by k and is updated in place, as are
+    the preallocated logs. The arithmetic is kept in the same order as opt_peak_shave_rules_ASAP so results match."""
+    for t in range(len(load)):
+        k = K[t]
+        if load[t] < peak[k]:  # Charge battery
+            d_log[t] = 0.0
+            c = min(p_max, peak[k] - load[t])  # Power constrained charging
+            soc = soc_0 + (c * time_step * sqrt_eff)/C
+            if soc > soc_max:
+                c = (soc_max - soc_0)*C/(time_step*sqrt_eff)  # SOC constrained charging, derate power
+                soc = soc_max
+            c_log[t] = c
+        else:  # Discharge battery
+            c_log[t] = 0.0
+            d = min(p_max, load[t] - peak[k])  # Power constrained discharging
+            soc = soc_0 - (d * time_step)/(sqrt_eff * C)
+            if soc < soc_min:
+                d = (soc_0 - soc_min)*C*sqrt_eff/time_step  # SOC constrained discharging, derate power
+                soc = soc_min
+            d_log[t] = d
+            # If BESS is unable to keep net load below the peak so far for the month, record must be updated.
+            if load[t] - d > peak[k]:
+                peak[k] = load[t] - d
+        soc_log[t] = soc
+        soc_0 = soc  # Update SOC counter
+    return soc_0
+
+if njit is not None:
+    _peak_shave_kernel_jit = njit(cache=True)(_peak_shave_kernel)
+
+    @njit(cache=True)
+    def _peak_shave_batch_kernel(load, K, peak, p_max, C, soc_min, soc_max, soc_0, time_step, sqrt_eff, c_log, d_log,
+                                 soc_log):
+        """_peak_shave_kernel for each row (configuration or site) of the 2-D load, peak and log arrays, with the
+        BESS parameters held in arrays by row. soc_0 is updated in place to each row's final SOC."""
+        for i in range(load.shape[0]):
+            soc_0[i] = _peak_shave_kernel_jit(load[i], K, peak[i], p_max[i], C[i], soc_min[i], soc_max[i], soc_0[i],
+                                              time_step, sqrt_eff[i], c_log[i], d_log[i], soc_log[i])
+
+def opt_peak_shave_rules_ASAP_fast(params, bess, state, load, K, peak_demands_m):
+    """Array based version of opt_peak_shave_rules_ASAP that returns identical c/d/SOC logs (as numpy arrays), taking
+    the scenario's ScenarioParams, BESSParams and SimState (see v_7_config). Constants are computed once per call, the
+    peak demand record is held in an array indexed by k, and the time-step loop runs in _peak_shave_kernel, JIT
+    compiled if numba is installed."""
+    n = len(load)
+    time_step = params.time_step_h
+    p_max = params.P_inv_cont * params.P_cap  # kW
+    sqrt_eff = math.sqrt(bess.Eff_LP)
+    peak = peak_record_to_array(peak_demands_m, K)
+    if njit is not None:
+        c_log, d_log, soc_log = np.empty(n), np.empty(n), np.empty(n)
+        _peak_shave_kernel_jit(np.asarray(load, dtype=float), np.asarray(K, dtype=np.int64), peak, float(p_max),
+                               float(state.C), float(params.SOC_min), float(params.SOC_max), float(state.SOC_0),
+                               float(time_step), sqrt_eff, c_log, d_log, soc_log)
+    else:  # Python floats and lists are faster than numpy scalars in an interpreted loop
+        c_log, d_log, soc_log, peak_l = [0.0] * n, [0.0] * n, [0.0] * n, peak.tolist()
+        _peak_shave_kernel(np.asarray(load, dtype=float).tolist(), np.asarray(K).tolist(), peak_l, p_max,
+                           state.C, params.SOC_min, params.SOC_max, state.SOC_0, time_step, sqrt_eff, c_log, d_log,
+                           soc_log)
+        c_log, d_log, soc_log, peak = np.array(c_log), np.array(d_log), np.array(soc_log), np.array(peak_l)
+    for k in peak_demands_m:
+        peak_demands_m[k] = peak[k]
+    return c_log, d_log, soc_log, peak_demands_m
+
+def peak_record_to_array(peak_demands_m, K):
+    """Converts a {k: peak} record to an array indexed by k. Sub-periods missing from the record are NaN, so a k in
+    the window without a record fails loudly, as the dict lookup does in opt_peak_shave_rules_ASAP."""
+    max_k = max(max(peak_demands_m), int(np.max(K)))
+    peak = np.full(max_k + 1, np.nan)
+    for k, p in peak_demands_m.items():
+        peak[k] = p
+    if np.isnan(peak[np.unique(K)]).any():
+        raise KeyError('No peak demand record for sub-period(s) ' +
+                       str([int(k) for k in np.unique(K) if np.isnan(peak[k])]))
+    return peak
+
+# Without numba, batches of at least this many configurations are stepped in lockstep in numpy rather than row by row
+BATCH_LOCKSTEP_MIN = 64
+
+def make_batch_dict(params_list, bess_list, states):
+    """Stacks the dispatch parameters (ScenarioParams, BESSParams and SimState) of several scenario configurations
+    into arrays for opt_peak_shave_rules_ASAP_batch. All configurations must share the same time-step."""
+    time_steps = set(p.time_step_h for p in params_list)
+    if len(time_steps) != 1:
+        raise ValueError('Batched configurations must share a time-step, got ' + str(time_steps))
+    return {'time-step_h': time_steps.pop(),
+            'p_max': np.array([p.P_inv_cont * p.P_cap for p in params_list], dtype=float),
+            'C': np.array([state.C for state in states], dtype=float),
+            'SOC_min': np.array([p.SOC_min for p in params_list], dtype=float),
+            'SOC_max': np.array([p.SOC_max for p in params_list], dtype=float),
+            'SOC_0': np.array([state.SOC_0 for state in states], dtype=float),
+            'sqrt_eff': np.sqrt(np.array([b.Eff_LP for b in bess_list], dtype=float))}
+
+def opt_peak_shave_rules_ASAP_batch(batch_dict, load, K, peak_demands):
+    """Rules based peak shaving for n configurations (or the sites of a fleet) over the same window, so a sizing sweep
+    takes one pass over the data. batch_dict is built by make_batch_dict. load is either shared, shape (T,), or per
+    configuration, shape (n, T). peak_demands is an (n, max_k + 1) array indexed by k, updated in place.
+    Returns (n, T) arrays of c, d and SOC that match opt_peak_shave_rules_ASAP row by row. With numba the rows run
+    through the compiled _peak_shave_batch_kernel. Without it, each row runs through _peak_shave_kernel on Python
+    floats, unless there are at least BATCH_LOCKSTEP_MIN configurations, when stepping them all in lockstep in numpy
+    is quicker."""
+    time_step = batch_dict['time-step_h']
+    p_max, C, sqrt_eff = batch_dict['p_max'], batch_dict['C'], batch_dict['sqrt_eff']
+    soc_min, soc_max = batch_dict['SOC_min'], batch_dict['SOC_max']
+    load = np.asarray(load, dtype=float)
+    n, T = len(p_max), load.shape[-1]
+    rows = np.arange(n)
+    c_log, d_log, soc_log = np.zeros((n, T)), np.zeros((n, T)), np.empty((n, T))
+    soc_0 = batch_dict['SOC_0'].copy()
+    if njit is not None:
+        _peak_shave_batch_kernel(np.broadcast_to(load, (n, T)), np.asarray(K, dtype=np.int64), peak_demands, p_max,
+                                 C, soc_min, soc_max, soc_0, float(time_step), sqrt_eff, c_log, d_log, soc_log)
+        return c_log, d_log, soc_log, peak_demands
+    if n < BATCH_LOCKSTEP_MIN:
+        loads, K_l = np.broadcast_to(load, (n, T)).tolist(), np.asarray(K).tolist()
+        for i in range(n):  # Python floats and lists are faster than numpy scalars in an interpreted loop
+            c_i, d_i, soc_i, peak_i = [0.0] * T, [0.0] * T, [0.0] * T, peak_demands[i].tolist()
+            _peak_shave_kernel(loads[i], K_l, peak_i, float(p_max[i]), float(C[i]), float(soc_min[i]),
+                               float(soc_max[i]), float(soc_0[i]), time_step, float(sqrt_eff[i]), c_i, d_i, soc_i)
+            c_log[i], d_log[i], soc_log[i], peak_demands[i] = c_i, d_i, soc_i, peak_i
+        return c_log, d_log, soc_log, peak_demands
+    for t in range(T):
+        l_t = load[..., t]
+        peak_t = peak_demands[rows, K[t]]
+        charge = l_t < peak_t
+        # Charging branch
+        c = np.minimum(p_max, peak_t - l_t)  # Power constrained charging
+        soc_c = soc_0 + (c * time_step * sqrt_eff)/C
+        over = soc_c > soc_max
+        c = np.where(over, (soc_max - soc_0)*C/(time_step*sqrt_eff), c)  # SOC constrained charging, derate power
+        soc_c = np.where(over, soc_max, soc_c)
+        # Discharging branch
+        d = np.minimum(p_max, l_t - peak_t)  # Power constrained discharging
+        soc_d = soc_0 - (d * time_step)/(sqrt_eff * C)
+        under = soc_d < soc_min
+        d = np.where(under, (soc_0 - soc_min)*C*sqrt_eff/time_step, d)  # SOC constrained discharging, derate power
+        soc_d = np.where(under, soc_min, soc_d)
+        c_log[:, t] = np.where(charge, c, 0)
+        d_log[:, t] = np.where(charge, 0, d)
+        soc_0 = np.where(charge, soc_c, soc_d)
+        soc_log[:, t] = soc_0
+        # If BESS is unable to keep net load below the peak so far for the month, record must be updated.
+        peak_demands[rows, K[t]] = np.where(~charge & (l_t - d > peak_t), l_t - d, peak_t)
+    return c_log, d_log, soc_log, peak_demands
+
+def make_opt_engine(params, bess, k_charges, n_steps):
+    """Builds the optimisation engine for opt_type 'LP', or 'MILP', which also forbids charging and discharging in the
+    same time-step. The Pyomo model covers a window of n_steps time-steps and minimises the demand charges for raising
+    the month's peak record plus the cost of energy at the retail and wholesale prices (U + W, as AC_U and AC_W and the
+    rebalance cost are booked), less the revenue from the regulation and spin it reserves
+    when the scenario stacks ancillary services (AS_stacking). Everything that changes from window to window (load,
+    prices, sub-periods, peak record, initial energy and capacity) is a mutable Param, so the model is built once per
+    scenario and opt_peak_shave_LP only updates it. The solver (params.solver) is persistent for HiGHS, and warm
+    started from the previous window's solution where it supports it."""
+    pyo = optional_import('pyomo.environ', "opt_type '" + params.opt_type + "'")
+    solver = pyo.SolverFactory(params.solver)
+    if not solver.available(exception_flag=False):
+        raise RuntimeError('Solver ' + params.solver + " for opt_type '" + params.opt_type + "' is not available")
+    time_step = params.time_step_h
+    p_max = params.P_inv_cont * params.P_cap  # kW
+    sqrt_eff = math.sqrt(bess.Eff_LP)
+
+    m = pyo.ConcreteModel()
+    m.T = pyo.RangeSet(0, n_steps - 1)
+    m.K = pyo.Set(initialize=sorted(k_charges))
+    # Mutable params, updated for each window
+    m.L = pyo.Param(m.T, mutable=True, initialize=0)  # Load (kW)
+    m.U = pyo.Param(m.T, mutable=True, initialize=0)  # Retail energy price ($/kWh)
+    m.W = pyo.Param(m.T, mutable=True, initialize=0)  # Wholesale energy price ($/kWh)
+    m.in_k = pyo.Param(m.T, m.K, mutable=True, initialize=0)  # 1 where time-step t falls in sub-period k
+    m.record = pyo.Param(m.K, mutable=True, initialize=0)  # Peak demand so far in the month (kW)
+    m.E_0 = pyo.Param(mutable=True, initialize=0)  # Energy stored at the start of the window (kWh)
+    m.C = pyo.Param(mutable=True, initialize=1)  # Capacity (kWh)
+    # Variables
+    m.c = pyo.Var(m.T, bounds=(0, p_max))  # Charging power (kW)
+    m.d = pyo.Var(m.T, bounds=(0, p_max))  # Discharging power (kW)
+    m.E = pyo.Var(m.T)  # Energy stored at the end of each time-step (kWh)
+    m.peak = pyo.Var(m.K)  # Peak net demand in each sub-period (kW)
+    # Constraints
+    m.energy_balance = pyo.Constraint(m.T, rule=lambda m, t: m.E[t] == (m.E_0 if t == 0 else m.E[t - 1]) +
+                                      m.c[t] * time_step * sqrt_eff - m.d[t] * time_step / sqrt_eff)
+    m.E_min = pyo.Constraint(m.T, rule=lambda m, t: m.E[t] >= params.SOC_min * m.C)
+    m.E_max = pyo.Constraint(m.T, rule=lambda m, t: m.E[t] <= params.SOC_max * m.C)
+    m.export = pyo.Constraint(m.T, rule=lambda m, t: m.L[t] + m.c[t] - m.d[t] >= -params.export_cap)
+    m.peak_record = pyo.Constraint(m.K, rule=lambda m, k: m.peak[k] >= m.record[k])
+    AS_revenue = 0
+    if params.AS_stacking == 1:  # Co-optimise the headroom reserved for ancillary services, as AS_stack reserves it
+        rho = params.ARU / (params.ARD * bess.Eff_LP)  # Energy-neutral regulation: r_d = rho * r_u
+        m.price_s = pyo.Param(m.T, mutable=True, initialize=0)  # AS prices ($/kW per h)
+        m.price_r_d = pyo.Param(m.T, mutable=True, initialize=0)
+        m.price_r_u = pyo.Param(m.T, mutable=True, initialize=0)
+        m.r_u = pyo.Var(m.T, bounds=(0, None))  # Regulation up (kW)
+        m.s = pyo.Var(m.T, bounds=(0, None))  # Spin (kW)
+        m.up_power = pyo.Constraint(m.T, rule=lambda m, t: m.r_u[t] + m.s[t] <= params.P_inv_cont - m.d[t] + m.c[t])
+        m.up_export = pyo.Constraint(m.T, rule=lambda m, t:
+                                     m.r_u[t] + m.s[t] <= m.L[t] + m.c[t] - m.d[t] + params.export_cap)
+        m.up_energy = pyo.Constraint(m.T, rule=lambda m, t:
+                                     (m.r_u[t] + m.s[t]) * params.CER <= (m.E[t] - params.SOC_min * m.C) * sqrt_eff)
+        m.down_power = pyo.Constraint(m.T, rule=lambda m, t: rho * m.r_u[t] <= params.P_inv_cont + m.d[t] - m.c[t])
+        m.down_energy = pyo.Constraint(m.T, rule=lambda m, t:
+                                       rho * m.r_u[t] * params.CER <= (params.SOC_max * m.C - m.E[t]) / sqrt_eff)
+        AS_revenue = sum(((params.WRU * m.price_r_u[t] + rho * params.WRD * m.price_r_d[t] -
+                           (m.U[t] + m.W[t]) * (params.ARD * rho - params.ARU)) * m.r_u[t] +
+                          m.price_s[t] * m.s[t]) * time_step for t in m.T)
+    # Net load, plus full regulation down deployment when stacking, sets the peaks
+    m.peak_net = pyo.Constraint(m.T, m.K, rule=lambda m, t, k: m.peak[k] >= m.in_k[t, k] * (
+        m.L[t] + m.c[t] - m.d[t] + (rho * m.r_u[t] if params.AS_stacking == 1 else 0)))
+    if params.opt_type == 'MILP':
+        m.charging = pyo.Var(m.T, within=pyo.Binary)
+        m.charge_mode = pyo.Constraint(m.T, rule=lambda m, t: m.c[t] <= p_max * m.charging[t])
+        m.discharge_mode = pyo.Constraint(m.T, rule=lambda m, t: m.d[t] <= p_max * (1 - m.charging[t]))
+    # Demand charges count from the record, which keeps the objective small and the MILP relative gap meaningful
+    m.cost = pyo.Objective(expr=sum(k_charges[k] * (m.peak[k] - m.record[k]) for k in m.K) +
+                           sum((m.U[t] + m.W[t]) * time_step * (m.c[t] - m.d[t]) for t in m.T) - AS_revenue,
+                           sense=pyo.minimize)
+    warm_start = hasattr(solver, 'warm_start_capable') and solver.warm_start_capable()
+    return {'pyo': pyo, 'model': m, 'solver': solver, 'solve_kwargs': {'warmstart': True} if warm_start else {},
+            'n_steps': n_steps}
+
+def opt_peak_shave_LP(engine, params, bess, state, load, K, U, W, peak_demands_m, AS_prices=None):
+    """Optimal counterpart of opt_peak_shave_rules_ASAP_fast, using an engine from make_opt_engine. U and W hold the
+    retail and wholesale energy prices of each time-step in the window, and AS_prices the spin, reg-down and reg-up
+    prices when the scenario stacks ancillary services. Returns the c/d/SOC logs (as numpy arrays), the updated
+    peak record, and the regulation up and spin (kW) the schedule was planned around when stacking (else None)."""
+    pyo, m = engine['pyo'], engine['model']
+    load, K = np.asarray(load, dtype=float), np.asarray(K)
+    if len(load) != engine['n_steps']:
+        raise ValueError('Window of ' + str(len(load)) + ' time-steps, the model has ' + str(engine['n_steps']))
+    m.L.store_values(dict(enumerate(load.tolist())))
+    m.U.store_values(dict(enumerate(np.asarray(U, dtype=float).tolist())))
+    m.W.store_values(dict(enumerate(np.asarray(W, dtype=float).tolist())))
+    m.in_k.store_values({(t, k): int(K[t] == k) for t in m.T for k in m.K})
+    m.record.store_values({k: peak_demands_m.get(k, 0) for k in m.K})
+    m.E_0.set_value(state.SOC_0 * state.C)
+    m.C.set_value(state.C)
+    if params.AS_stacking == 1:
+        for param, prices in zip([m.price_s, m.price_r_d, m.price_r_u], AS_prices):
+            param.store_values(dict(enumerate(np.asarray(prices, dtype=float).tolist())))
+    results = engine['solver'].solve(m, **engine['solve_kwargs'])
+    condition = results.solver.termination_condition
+    if condition != pyo.TerminationCondition.optimal:
+        raise RuntimeError('Solver %s ended with %s on day %g' % (params.solver, condition, state.days))
+    c_log = np.maximum([m.c[t].value for t in m.T], 0)  # Clip solver tolerance either side of the bounds
+    d_log = np.maximum([m.d[t].value for t in m.T], 0)
+    soc_log = np.clip(np.array([m.E[t].value for t in m.T]) / state.C, params.SOC_min, params.SOC_max)
+    # Raise the record wherever the net load went above it
+    net_load = load + c_log - d_log
+    for k in np.unique(K).tolist():
+        peak_demands_m[k] = max(peak_demands_m.get(k, -np.inf), net_load[K == k].max())
+    AS_plan = None
+    if params.AS_stacking == 1:
+        AS_plan = (np.maximum([m.r_u[t].value for t in m.T], 0), np.maximum([m.s[t].value for t in m.T], 0))
+    return c_log, d_log, soc_log, peak_demands_m, AS_plan
+
+def rules_dispatch(params, bess, dataset, n_steps):
+    """Dispatch engine for opt_type 'rules': opt_peak_shave_rules_ASAP_fast."""
+    def dispatch(state, window, peak_demands_m):
+        return opt_peak_shave_rules_ASAP_fast(params, bess, state, window['load'], window['k'], peak_demands_m)
+    return dispatch
+
+def opt_dispatch(params, bess, dataset, n_steps):
+    """Dispatch engine for opt_type 'LP' and 'MILP': opt_peak_shave_LP on a model built once for the scenario. When
+    stacking, the regulation up and spin it co-optimised are left in window['AS_plan'] to be booked (see AS_revenue)."""
+    engine = make_opt_engine(params, bess, dataset['k_charges'], n_steps)
+
+    def dispatch(state, window, peak_demands_m):
+        c_log, d_log, soc_log, peak_demands_m, AS_plan = \
+            opt_peak_shave_LP(engine, params, bess, state, window['load'], window['k'], window['U'], window['w'],
+                              peak_demands_m, (window['s'], window['r_d'], window['r_u']))
+        if AS_plan is not None:
+            window['AS_plan'] = AS_plan
+        return c_log, d_log, soc_log, peak_demands_m
+    return dispatch
+
+# Dispatch engine factory for each opt_type (also listed in v_7_config.OPT_TYPES). A factory takes the scenario's
+# params, bess, dataset and window length in time-steps, and returns dispatch(state, window, peak_demands_m), where
+# window holds views of the exogenous arrays (and U, the energy price), that returns c/d/SOC logs and the peak record.
+# Engines that co-optimise the ancillary services reservation also leave it in window['AS_plan'].
+DISPATCH_ENGINES = {'rules': rules_dispatch, 'LP': opt_dispatch, 'MILP': opt_dispatch}
+
+def make_dispatch(params, bess, dataset, n_steps):
+    """The dispatch engine selected by params.opt_type, for windows of n_steps time-steps."""
+    if params.opt_type not in DISPATCH_ENGINES:
+        raise ValueError('No dispatch engine for opt_type ' + repr(params.opt_type))
+    return DISPATCH_ENGINES[params.opt_type](params, bess, dataset, n_steps)
+
+def AS_stack(params, bess, C, window, n_commit, c_log, d_log, soc_log, peak_demands_m):
+    """Value stacking: reserves the power and energy headroom that peak shaving leaves in a committed window for
+    regulation up/down and spinning reserve, in one vectorized pass, for the rules based engine. Regulation is bid
+    energy-neutral, with r_d = r_u * ARU / (ARD * Eff_LP), so the expected deployments (fractions ARU and ARD of the
+    bids) leave the SOC schedule unchanged and only cost the round trip losses, bought at the retail plus wholesale
+    price (U + W, as the rest of the model prices energy). Headroom is limited by the inverter rating, by the energy
+    for CER hours of full deployment at each time-step's SOC, by the export cap for up services, and by the month's
+    peak record for regulation down, so deployment never sets a new peak. Up headroom goes to regulation first where
+    it pays more per kW than spin (WRU and WRD scale the regulation payments). Returns the window's revenue from
+    reg-up, reg-down and spin, and the cost of the regulation losses ($), as AS_revenue books them."""
+    sqrt_eff = math.sqrt(bess.Eff_LP)
+    load, K = window['load'][:n_commit], window['k'][:n_commit]
+    UW = window['U'][:n_commit] + window['w'][:n_commit]
+    price_s, price_r_d, price_r_u = window['s'][:n_commit], window['r_d'][:n_commit], window['r_u'][:n_commit]
+    p = np.asarray(d_log) - np.asarray(c_log)  # BESS output (kW)
+    net_load = load - p
+    peak = peak_record_to_array(peak_demands_m, K)[K]
+    # Headroom (kW) in each direction: power, then energy sustained for CER hours
+    up = np.minimum(params.P_inv_cont - p, net_load + params.export_cap)
+    up = np.maximum(np.minimum(up, (soc_log - params.SOC_min) * C * sqrt_eff / params.CER), 0)
+    down = np.minimum(params.P_inv_cont + p, peak - net_load)
+    down = np.maximum(np.minimum(down, (params.SOC_max - soc_log) * C / (sqrt_eff * params.CER)), 0)
+    # Energy-neutral regulation, valued per kW of reg-up net of the losses
+    rho = params.ARU / (params.ARD * bess.Eff_LP)
+    reg_value = params.WRU * price_r_u + rho * params.WRD * price_r_d - UW * (params.ARD * rho - params.ARU)
+    r_u = np.where((reg_value > price_s) & (reg_value > 0), np.minimum(up, down / rho), 0)
+    s = np.where(price_s > 0, up - r_u, 0)
+    return AS_revenue(params, bess, window, n_commit, r_u, s)
+
+def AS_revenue(params, bess, window, n_commit, r_u, s):
+    """Books the regulation up r_u (with the energy-neutral regulation down that goes with it) and spin s (kW)
+    reserved over the committed n_commit time-steps of a window, by AS_stack or by the LP/MILP engines (left in
+    window['AS_plan']). Returns the revenue from reg-up, reg-down and spin, and the cost of the regulation losses
+    at U + W ($)."""
+    UW = window['U'][:n_commit] + window['w'][:n_commit]
+    price_s, price_r_d, price_r_u = window['s'][:n_commit], window['r_d'][:n_commit], window['r_u'][:n_commit]
+    r_d = params.ARU / (params.ARD * bess.Eff_LP) * r_u
+    return np.array([np.sum(params.WRU * price_r_u * r_u), np.sum(params.WRD * price_r_d * r_d),
+                     np.sum(price_s * s), np.sum(UW * (params.ARD * r_d - params.ARU * r_u))]) * params.time_step_h
@@ -0,0 +1,276 @@
+﻿# coding: utf-8
+"""Reproducible benchmarks for the scenario pipeline. Synthetic 5 min load, hourly LMP and hourly AS price files are
+generated in the schemas of the treated CSVs (from one month to 20 years of data), then parsing, month slicing,
+dispatch, rainflow counting and a full scenario are timed. Wall time, throughput and peak traced memory are written to
+a JSON results file, and two results files can be compared.
+Usage: python v_7_benchmark.py run [--months 12] [--out benchmark_results.json]
+       python v_7_benchmark.py compare benchmark_baseline.json benchmark_results.json [--tol 0.1]"""
+
+### Import required tools ###
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd                 # CSV handling
+import dataclasses
+from v_7_config import load_scenarios, make_bess_params, make_sim_state, legacy_dicts
+from v_7_param_functions import load_exog_dataset, grab_month_exog, charge_table
+from v_7_algorithms import opt_peak_shave_rules_ASAP, opt_peak_shave_rules_ASAP_fast, make_batch_dict, \
+    opt_peak_shave_rules_ASAP_batch, peak_record_to_array, make_opt_engine, opt_peak_shave_LP
+from SH_cycle_counting_by_rainflow import find_pkvl_and_idle, rfc_find_cycles, rfc_stream_init, rfc_stream_update
+from v_7_scenario_manager import run_scenario
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+START = '2012-01-01'  # Same calendar as the site load the scenarios run on
+
+
+##############################
+# Synthetic data generators #
+##############################
+def make_synthetic_load(path, months=12, seed=0, start=START):
+    """Writes a 5 min site load (kW) CSV with local_time (dd/mm/yyyy hh:mm) and value columns. The load has a
+    daytime hump, a weekday/weekend difference, a seasonal swing and noise."""
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(start, pd.Timestamp(start) + pd.DateOffset(months=months), freq='5min', inclusive='left')
+    hour = index.hour + index.minute / 60
+    season = 1 + 0.25 * np.cos(2 * np.pi * (index.dayofyear - 200) / 365)
+    weekday = np.where(index.dayofweek >= 5, 0.6, 1.0)
+    value = 120 + 80 * season * weekday * np.clip(np.sin((hour - 6) / 16 * np.pi), 0, None) \
+        + rng.normal(0, 12, len(index))
+    pd.DataFrame({'local_time': index.strftime('%d/%m/%Y %H:%M'), 'value': value.round(3)}).to_csv(path, index=False)
+    return path
+
+
+def _hourly_frame(months, start):
+    index = pd.date_range(start, pd.Timestamp(start) + pd.DateOffset(months=months), freq='h', inclusive='left')
+    gmt = index + pd.Timedelta(hours=8)  # Pacific standard time to GMT
+    gmt_format = '%Y-%m-%dT%H:00:00-00:00'
+    return index, pd.DataFrame({'INTERVALSTARTTIME_GMT': gmt.strftime(gmt_format),
+                                'INTERVALENDTIME_GMT': (gmt + pd.Timedelta(hours=1)).strftime(gmt_format),
+                                'OPR_DT': index.strftime('%d/%m/%Y'), 'OPR_HR': index.hour + 1, 'OPR_INTERVAL': 0})
+
+
+def make_synthetic_LMP(path, months=12, seed=1, start=START):
+    """Writes an hourly day-ahead LMP ($/MWh) CSV in the schema of LMP_node_HARBORG_7_N101_2019_treated.csv."""
+    rng = np.random.default_rng(seed)
+    index, df = _hourly_frame(months, start)
+    price = 35 + 15 * np.sin((index.hour - 12) / 24 * 2 * np.pi) ** 2 + rng.gamma(2, 2, len(index))
+    for col, value in [('NODE_ID_XML', 'SYNTH_NODE'), ('NODE_ID', 'SYNTH_NODE'), ('NODE', 'SYNTH_NODE'),
+                       ('MARKET_RUN_ID', 'DAM'), ('LMP_TYPE', 'LMP'), ('XML_DATA_ITEM', 'LMP_PRC'),
+                       ('PNODE_RESMRID', 'SYNTH_NODE'), ('GRP_TYPE', 'ALL'), ('POS', 1)]:
+        df[col] = value
+    df['MW'] = price.round(5)
+    df['GROUP'] = np.arange(len(index)) // 24 + 1
+    df.to_csv(path, index=False)
+    return path
+
+
+def make_synthetic_AS(path, months=12, seed=2, start=START):
+    """Writes hourly reg-down, reg-up and spin clearing prices ($/MW) in the schema of AS_CAISO_EXP_2019_treated.csv."""
+    rng = np.random.default_rng(seed)
+    index, df = _hourly_frame(months, start)
+    df.insert(2, 'month', index.month)
+    for col, value in [('OPR_TYPE', 'Hourly'), ('ANC_TYPE', 'RD'), ('ANC_REGION', 'AS_CAISO_EXP'),
+                       ('MARKET_RUN_ID', 'DAM')]:
+        df[col] = value
+    df['RD_CLR_PRC'] = (4 + rng.gamma(2, 1, len(index))).round(5)
+    df['RU_CLR_PRC'] = (4 + rng.gamma(2, 1.2, len(index))).round(5)
+    df['SP_CLR_PRC'] = (1 + rng.gamma(1.5, 1, len(index))).round(5)
+    df['Reg_comb'] = df['RD_CLR_PRC'] + df['RU_CLR_PRC']
+    df['notes'] = ''
+    df.to_csv(path, index=False)
+    return path
+
+
+def make_synthetic_scenario(directory, months=12, seed=0, **overrides):
+    """Writes synthetic exogenous files to directory, copies in the bundled tariff and BESS files, and returns the
+    ScenarioParams of the first row of v_7_scenarios.csv pointed at them (with any overrides applied)."""
+    for name in ['tariff_SCE_TOU8_option_B.csv', '2019_tariff_SCE_TOU8_option_B.csv', 'v_7_BESS_params.csv']:
+        shutil.copy(os.path.join(REPO_DIR, name), directory)
+    scenarios = pd.read_csv(os.path.join(REPO_DIR, 'v_7_scenarios.csv')).iloc[[0]].reset_index(drop=True)
+    scenarios.loc[0, 'load_profile'] = make_synthetic_load(os.path.join(directory, 'synthetic_load.csv'), months, seed)
+    scenarios.loc[0, 'wholesale_profile'] = make_synthetic_LMP(os.path.join(directory, 'synthetic_LMP.csv'), months,
+                                                               seed + 1)
+    scenarios.loc[0, 'AS_profiles'] = make_synthetic_AS(os.path.join(directory, 'synthetic_AS.csv'), months, seed + 2)
+    for key in ['tariff_key', 'tariff_prices']:
+        scenarios.loc[0, key] = os.path.join(directory, scenarios.loc[0, key])
+    scenarios.loc[0, 'scenario'] = 'benchmark'
+    scenarios.loc[0, 'verbose'] = 0
+    for key, value in overrides.items():
+        scenarios.loc[0, key] = value
+    return load_scenarios(scenarios, os.path.join(directory, 'v_7_BESS_params.csv'))[0]
+
+
+##############
+# Benchmarks #
+##############
+def measure(func, repeat=3):
+    """Returns the best wall time of repeat calls of func, and the peak memory traced during one further call."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak_memory
+
+
+def run_benchmarks(months=12, seed=0, repeat=3, n_batch=16):
+    """Runs every benchmark against months of synthetic data and returns the results dict."""
+    results = {}
+
+    def record(name, func, n_items, unit, n_repeat=repeat):
+        wall_s, peak_memory = measure(func, n_repeat)
+        results[name] = {'wall_s': wall_s, 'throughput': n_items / wall_s if wall_s > 0 else None, 'unit': unit,
+                         'peak_memory_B': peak_memory}
+        print("%-28s %10.4f s %14.1f %s %12d B" % (name, wall_s, results[name]['throughput'] or 0, unit, peak_memory))
+
+    work_dir = tempfile.mkdtemp(prefix='v_7_benchmark_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        params = make_synthetic_scenario(work_dir, months, seed)
+        dataset = load_exog_dataset(params)
+        exog_variables_t, calendar = dataset['exog_variables_t'], dataset['calendar']
+        n_t = sum(stop - start for start, stop in calendar['months'].values())
+        record('parse', lambda: load_exog_dataset(params), n_t, 'steps/s')
+
+        months_list = list(calendar['months'])
+        record('month_slice', lambda: [grab_month_exog(exog_variables_t, calendar, mm, yyyy)
+                                       for yyyy, mm in months_list], n_t, 'steps/s')
+
+        # Dispatch a day at a time through the whole dataset, as the scenario manager does
+        bess = make_bess_params(params, 'v_7_BESS_params.csv')
+        state = make_sim_state(params, bess)
+        s_dict, BESS_dict = legacy_dicts(params, bess, state)  # For the reference implementation
+        steps_per_day = calendar['steps_per_day']
+        days = []
+        for yyyy, mm in months_list:
+            m_of_load, m_of_k = grab_month_exog(exog_variables_t, calendar, mm, yyyy)[:2]
+            days += [(m_of_load[d * steps_per_day:(d + 1) * steps_per_day], m_of_k[d * steps_per_day:(d + 1) *
+                      steps_per_day]) for d in range(len(m_of_load) // steps_per_day)]
+        record_0 = {1: 200.0, 2: 210.0, 3: 220.0}
+
+        def dispatch_reference():
+            return [opt_peak_shave_rules_ASAP(s_dict, BESS_dict, list(load), list(K), dict(record_0))[2]
+                    for load, K in days]
+
+        def dispatch_fast():
+            return [opt_peak_shave_rules_ASAP_fast(params, bess, state, load, K, dict(record_0))[2]
+                    for load, K in days]
+        opt_peak_shave_rules_ASAP_fast(params, bess, state, days[0][0], days[0][1], dict(record_0))  # JIT warm-up
+        record('dispatch_reference', dispatch_reference, len(days) * steps_per_day, 'steps/s', 1)
+        record('dispatch_fast', dispatch_fast, len(days) * steps_per_day, 'steps/s')
+        batch_dict = make_batch_dict([dataclasses.replace(params, P_cap=p) for p in np.linspace(0.1, 0.8, n_batch)],
+                                     [bess] * n_batch, [state] * n_batch)
+
+        def dispatch_batch():
+            for load, K in days:
+                peak = np.tile(peak_record_to_array(record_0, K), (n_batch, 1))
+                opt_peak_shave_rules_ASAP_batch(batch_dict, load, K, peak)
+        record('dispatch_batch_x' + str(n_batch), dispatch_batch, len(days) * steps_per_day * n_batch,
+               'config-steps/s')
+
+        # Optimal dispatch of the first month with the Pyomo engine, where Pyomo and a solver are installed
+        lp_params = dataclasses.replace(params, opt_type='LP')
+        try:
+            opt_engine = make_opt_engine(lp_params, bess, dataset['k_charges'], steps_per_day)
+        except (ImportError, RuntimeError) as e:
+            print('dispatch_LP skipped:', e)
+        else:
+            u_price = charge_table(dataset['u_charges'])
+            m_of_load, m_of_k, m_of_u, m_of_w = grab_month_exog(exog_variables_t, calendar, months_list[0][1],
+                                                                months_list[0][0])[:4]
+            lp_days = [slice(d * steps_per_day, (d + 1) * steps_per_day)
+                       for d in range(len(m_of_load) // steps_per_day)]
+
+            def dispatch_LP():
+                for day in lp_days:
+                    opt_peak_shave_LP(opt_engine, lp_params, bess, state, m_of_load[day], m_of_k[day],
+                                      u_price[m_of_u[day]], m_of_w[day], dict(record_0))
+            record('dispatch_LP', dispatch_LP, len(lp_days) * steps_per_day, 'steps/s', 1)
+
+        # Rainflow counting over the SOC history of the dispatch benchmark
+        soc = np.concatenate(dispatch_fast())
+        record('rainflow', lambda: rfc_find_cycles(find_pkvl_and_idle(soc)), len(soc), 'steps/s')
+
+        def rainflow_stream():
+            rfc = rfc_stream_init()
+            for d in range(0, len(soc), steps_per_day):
+                rfc_stream_update(rfc, soc[d:d + steps_per_day])
+        record('rainflow_stream', rainflow_stream, len(soc), 'steps/s')
+
+        # Full scenario (one project year) where the data covers the year the manager runs on
+        def scenario_year():
+            run_scenario(params, dataset)
+        if months >= 12:
+            record('scenario_year', scenario_year, 365 * steps_per_day, 'steps/s', 1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'meta': {'months': months, 'seed': seed, 'repeat': repeat, 'python': platform.python_version(),
+                     'numpy': np.__version__, 'pandas': pd.__version__, 'machine': platform.machine(),
+                     'processor': platform.processor(), 'date': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(baseline, current, tol=0.1):
+    """Prints the wall time and peak memory ratios (current / baseline) of the benchmarks in both files. Returns the
+    names of benchmarks that are slower than the baseline by more than tol (as a fraction)."""
+    regressions = []
+    if baseline['meta']['months'] != current['meta']['months']:
+        print('Warning: baseline ran on', baseline['meta']['months'], 'months of data, current on',
+              current['meta']['months'])
+    print("%-28s %12s %12s %8s %8s" % ('benchmark', 'base_s', 'current_s', 'time', 'memory'))
+    for name, base in baseline['results'].items():
+        if name not in current['results']:
+            print("%-28s missing from current results" % name)
+            continue
+        cur = current['results'][name]
+        time_ratio = cur['wall_s'] / base['wall_s']
+        memory_ratio = cur['peak_memory_B'] / base['peak_memory_B'] if base['peak_memory_B'] else float('nan')
+        flag = ''
+        if time_ratio > 1 + tol:
+            regressions.append(name)
+            flag = '  <-- slower'
+        print("%-28s %12.4f %12.4f %7.2fx %7.2fx%s" % (name, base['wall_s'], cur['wall_s'], time_ratio, memory_ratio,
+                                                      flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the benchmarks and write a results file')
+    run_parser.add_argument('--months', type=int, default=12, help='Length of synthetic data (1 to 240 months)')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeat', type=int, default=3, help='Timing repeats (best is kept)')
+    run_parser.add_argument('--out', default='benchmark_results.json')
+    compare_parser = commands.add_parser('compare', help='Compare a results file with a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tol', type=float, default=0.1, help='Allowed fractional slow-down')
+    args = parser.parse_args()
+    if args.command == 'run':
+        if not 1 <= args.months <= 240:
+            parser.error('--months must be between 1 and 240')
+        results = run_benchmarks(args.months, args.seed, args.repeat)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Results written to', args.out)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        sys.exit(1 if compare(baseline, current, args.tol) else 0)
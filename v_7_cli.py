@@ -0,0 +1,122 @@
+﻿# coding: utf-8
+"""Command line entry point for the scenario pipeline. Only the standard library is imported at startup: numpy,
+pandas and the dispatch modules are imported by the command that needs them, and optional dependencies (e.g. Pyomo)
+only when a scenario's opt_type does, so --help and check are quick and pool workers start light.
+Usage: python v_7_cli.py run [scenario_csv] [-n processes] [--log-level INFO] [--progress-interval 5]
+       python v_7_cli.py check [scenario_csv]
+       python v_7_cli.py fleet [scenario_csv] [--scenario name] [--sites sites_csv]
+       python v_7_cli.py sweep [scenario_csv] [--scenario name] [--objective NPV] [--capex-kW 0] [--capex-kWh 0]
+                               [--discount-rate 0] [--refine 2] [--prune-after 3] [--prune-tol 0.05]"""
+
+### Import required tools ###
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import argparse
+import sys
+
+
+def run(args):
+    """Runs the scenarios one after another, or over a pool of processes if -n is more than 1."""
+    from v_7_config import load_scenarios
+    from v_7_log import get_logger, setup_logging
+    setup_logging(args.log_level)
+    scenarios = load_scenarios(args.scenario_csv)
+    if args.processes is not None and args.processes > 1:
+        from v_7_parallel_manager import run_scenarios_parallel
+        run_time_by_case = run_scenarios_parallel(scenarios, args.processes, args.log_level, args.progress_interval)
+    else:
+        from v_7_scenario_manager import run_scenarios
+        run_time_by_case = run_scenarios(scenarios)
+    get_logger('cli').info("run time by case: %s", run_time_by_case)
+    return 0
+
+
+def check(args):
+    """Validates the scenario CSV, with sweeps expanded, and lists the scenarios it defines."""
+    from v_7_config import load_scenarios
+    try:
+        scenarios = load_scenarios(args.scenario_csv)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for params in scenarios:
+        print(params.scenario, params.BESS, params.opt_type, sep='\t')
+    print(len(scenarios), 'valid scenarios')
+    return 0
+
+
+def fleet(args):
+    """Runs a fleet of sites (see v_7_fleet) whose base scenario is the named, or first, row of the scenario CSV."""
+    from v_7_config import load_scenarios
+    from v_7_log import setup_logging
+    setup_logging(args.log_level)
+    scenarios = [params for params in load_scenarios(args.scenario_csv)
+                 if args.scenario is None or params.scenario == args.scenario]
+    if not scenarios:
+        print('No scenario ' + str(args.scenario) + ' in ' + args.scenario_csv, file=sys.stderr)
+        return 1
+    from v_7_fleet import run_fleet
+    run_fleet(scenarios[0], args.sites)
+    return 0
+
+
+def sweep(args):
+    """Runs the sizing sweep (see v_7_sweep) held in the named, or first, row of the scenario CSV."""
+    from v_7_log import setup_logging
+    setup_logging(args.log_level)
+    from v_7_sweep import run_sweep
+    try:
+        run_sweep(args.scenario_csv, args.scenario, args.objective, args.capex_kW, args.capex_kWh,
+                  args.discount_rate, args.refine, args.prune_after, args.prune_tol)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Run the scenarios of a scenario CSV')
+    run_parser.add_argument('scenario_csv', nargs='?', default='v_7_scenarios.csv')
+    run_parser.add_argument('-n', '--processes', type=int, default=None,
+                            help='Pool size; the scenarios run one after another if omitted or 1')
+    run_parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    run_parser.add_argument('--progress-interval', type=float, default=5,
+                            help='Seconds between merged progress lines of a pool')
+    run_parser.set_defaults(func=run)
+    check_parser = commands.add_parser('check', help='Validate a scenario CSV without running it')
+    check_parser.add_argument('scenario_csv', nargs='?', default='v_7_scenarios.csv')
+    check_parser.set_defaults(func=check)
+    fleet_parser = commands.add_parser('fleet', help='Run a fleet of sites against shared tariff and prices')
+    fleet_parser.add_argument('scenario_csv', nargs='?', default='v_7_scenarios.csv')
+    fleet_parser.add_argument('--scenario', default=None,
+                              help="Base scenario, whose load_profile is the fleet load CSV (the CSV's first if "
+                                   "omitted)")
+    fleet_parser.add_argument('--sites', default=None,
+                              help='Sites CSV: a site column and optional BESS sizing columns (every load column if '
+                                   'omitted)')
+    fleet_parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    fleet_parser.set_defaults(func=fleet)
+    sweep_parser = commands.add_parser('sweep', help='Run the sizing sweep of a scenario row, with pruning and '
+                                                     'refinement, into one results table')
+    sweep_parser.add_argument('scenario_csv', nargs='?', default='v_7_scenarios.csv')
+    sweep_parser.add_argument('--scenario', default=None, help="Row to sweep (the CSV's first if omitted)")
+    sweep_parser.add_argument('--objective', default='NPV', help='NPV or avoided_cost')
+    sweep_parser.add_argument('--capex-kW', dest='capex_kW', type=float, default=0,
+                              help='Capital cost per kW of P_inv_cont')
+    sweep_parser.add_argument('--capex-kWh', dest='capex_kWh', type=float, default=0,
+                              help='Capital cost per kWh of capacity')
+    sweep_parser.add_argument('--discount-rate', type=float, default=0, help='Annual discount rate of the NPV')
+    sweep_parser.add_argument('--refine', type=int, default=2, help='Rounds of bisection around the best point')
+    sweep_parser.add_argument('--prune-after', type=int, default=3,
+                              help='Month of the first year from which dominated configurations are pruned')
+    sweep_parser.add_argument('--prune-tol', type=float, default=0.05,
+                              help='Margin a configuration must be beaten by to be pruned; negative turns pruning off')
+    sweep_parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    sweep_parser.set_defaults(func=sweep)
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
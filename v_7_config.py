@@ -0,0 +1,357 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import dataclasses
+import itertools
+import math
+import os
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import pandas as pd  # CSV handling
+from SH_cycle_counting_by_rainflow import rfc_stream_init
+
+"""Typed scenario configuration. Each row of the scenario CSV becomes a frozen ScenarioParams, and the BESS it names
+a frozen BESSParams; both are validated once at load and pickle cheaply to worker processes. Everything that changes
+as a scenario runs (SOC, day counter, capacity and ageing state) lives in a separate, mutable SimState.
+Cells of the scenario CSV may hold a sweep specification instead of a single value, either a list 'a|b|c' or an
+inclusive range 'start:stop:step'. A row with sweeps is expanded to the grid (Cartesian product) of its values."""
+
+
+@dataclass(frozen=True, slots=True)
+class ScenarioParams:
+    scenario: str
+    BESS: str
+    P_inv_cont: float  # Inverter continuous power rating (kW)
+    R_ac_dc: float
+    EtoP: float  # Energy to power ratio (h)
+    SOC_min: float
+    SOC_max: float
+    SOC_0: float  # SOC at the start of the run
+    tariff_key: str
+    tariff_prices: str
+    load_profile: str
+    wholesale_profile: str
+    AS_profiles: str
+    win_opt: int  # Optimisation window (h)
+    win_actioned: int  # Portion of the window that is implemented (h)
+    time_step_h: float
+    day_prog: float  # Days the window moves on after each optimisation
+    P_cap: float  # Fraction of P_inv_cont available for peak shaving
+    DC_fudge: float
+    project_year_cap: int
+    export_cap: float
+    verbose: int
+    T: float  # Cell temperature (K)
+    EOL: float  # End of life capacity fraction
+    opt_type: str
+    formulation: str
+    ARD: float  # Expected deployment of regulation down bids (fraction of the bid energy)
+    ARU: float  # Expected deployment of regulation up bids
+    WRD: float  # Fraction of regulation down bids paid
+    WRU: float  # Fraction of regulation up bids paid
+    CER: float  # Continuous energy requirement of reserves (h)
+    cap_init: float  # Initial capacity as a fraction of C_0
+    o_m_cost: float  # Maintenance cost per kWh of C_0
+    may_maint: int
+    # Optional columns
+    ff_tol: float = 0  # Fast-forward tolerance, 0 runs every year
+    profile: str = 'none'  # cprofile, tracemalloc or both
+    verbose_format: str = 'auto'  # parquet, hdf5, csv or auto
+    verbose_columns: Optional[Tuple[str, ...]] = None  # e.g. 'mm;dd;P;SOC' (all if blank)
+    verbose_decimate: int = 1  # Keep every n_th time-step
+    resume: int = 0  # 1 carries on from an interrupted run's checkpoint
+    peak_init_stat: str = 'mean'  # mean, e.g. p90, or prior
+    peak_init_excl_h: float = 6  # Hours left out of each day
+    progress: str = 'month'  # Progress log rate: day, month or e.g. 5%
+    maint_date: Optional[Tuple[int, int]] = None  # VRFB maintenance date (mm, dd), from 'mm-dd'
+    maint_threshold: float = 0  # VRFB maintenance when capacity falls below this fraction, 0 never triggers
+    solver: str = 'highs'  # Solver for opt_type LP or MILP: highs, appsi_highs, glpk or cbc
+    AS_stacking: int = 0  # 1 stacks regulation and spin on the headroom peak shaving leaves
+    exog_dtype: str = 'float64'  # Storage of the load and price series: float64, or float32 for long horizons
+
+
+@dataclass(frozen=True, slots=True)
+class BESSParams:
+    BESS: str
+    BESS_class: str  # VRFB or Li-ion
+    Eff_LP: float  # Round trip efficiency
+    C_0: float  # Nameplate capacity (kWh)
+    EDR: float = math.nan  # VRFB electrolyte decay rate (capacity fraction per EFC)
+    CFR: float = math.nan  # VRFB capacity fade rate, for rebalancing
+    OCV_0: float = math.nan  # Li-ion linearised open circuit voltage, V = OCV_0 + OCV_1*SOC
+    OCV_1: float = math.nan
+    Q_cell: float = math.nan  # Li-ion cell capacity (Ah) the ageing model is fitted to
+
+
+@dataclass(slots=True)
+class SimState:
+    SOC_0: float  # SOC at the start of the next window
+    days: float  # Days in operation, advanced by each committed window
+    C: float  # Current capacity (kWh)
+    Q: float = 1  # Charge throughput in EFC, init. with 1 to avoid problems with algebra on 0
+    L_cal: float = 0  # Li-ion capacity loss fractions from calendar and cycle ageing
+    L_cyc: float = 0
+    rfc: Optional[dict] = None  # Li-ion rainflow counter state, carried from day to day
+
+
+# Scenario CSV column for each ScenarioParams field, where the names differ
+COLUMN_NAMES = {'time_step_h': 'time-step_h', 'T': 'T_K'}
+SWEEP_EXCLUDED = ['scenario', 'verbose_columns', 'maint_date']  # Columns whose text is never a sweep specification
+BESS_CLASSES = ['VRFB', 'Li-ion']
+OPT_TYPES = ['rules', 'LP', 'MILP']  # Rules based dispatch, or the Pyomo rolling-horizon engine
+SOLVERS = ['highs', 'appsi_highs', 'glpk', 'cbc']
+EXOG_DTYPES = ['float64', 'float32']
+# Columns of a fleet's sites CSV that may size a site's BESS differently from the fleet's base scenario
+FLEET_COLUMNS = ['BESS', 'P_inv_cont', 'R_ac_dc', 'EtoP', 'SOC_min', 'SOC_max', 'SOC_0', 'P_cap', 'export_cap',
+                 'cap_init', 'o_m_cost']
+
+
+def _field_type(field):
+    return {float: float, int: int, str: str}.get(field.type, None)
+
+
+def _convert(field, value):
+    """Converts a CSV cell to the type of a ScenarioParams field."""
+    if field.name == 'verbose_columns':
+        return tuple(col.strip() for col in str(value).split(';'))
+    if field.name == 'maint_date':
+        return tuple(int(part) for part in str(value).split('-'))
+    kind = _field_type(field)
+    if kind is int:
+        as_float = float(value)
+        if as_float != int(as_float):
+            raise ValueError('expected a whole number, got ' + repr(value))
+        return int(as_float)
+    return kind(value)
+
+
+def parse_sweep(value):
+    """Returns the values of a sweep specification ('a|b|c' or 'start:stop:step'), or None for a single value."""
+    if not isinstance(value, str):
+        return None
+    if '|' in value:
+        return [part.strip() for part in value.split('|')]
+    if value.count(':') == 2:
+        start, stop, step = (float(part) for part in value.split(':'))
+        if step <= 0 or stop < start:
+            raise ValueError('Bad sweep range ' + repr(value))
+        n = int(math.floor((stop - start) / step + 1e-9)) + 1
+        return [repr(round(start + i * step, 12)) for i in range(n)]  # Round off accumulated float error
+    return None
+
+
+def expand_sweeps(scenarios):
+    """Expands the rows of a scenario DataFrame that hold sweep specifications into one row per point of their grid.
+    Expanded rows are named after the original scenario and the swept values, e.g. 'base_P_cap=0.2_EtoP=4'."""
+    rows = []
+    for _, row in scenarios.iterrows():
+        sweeps = {column: parse_sweep(row[column]) for column in scenarios.columns if column not in SWEEP_EXCLUDED}
+        sweeps = {column: values for column, values in sweeps.items() if values is not None}
+        if not sweeps:
+            rows.append(row)
+            continue
+        for point in itertools.product(*sweeps.values()):
+            new_row = row.copy()
+            for column, value in zip(sweeps, point):
+                new_row[column] = value
+            new_row['scenario'] = str(row['scenario']) + ''.join('_' + column + '=' + str(value)
+                                                                 for column, value in zip(sweeps, point))
+            rows.append(new_row)
+    return pd.DataFrame(rows).reset_index(drop=True)
+
+
+def make_scenario_params(file, s):
+    """Builds the ScenarioParams of the s_th row of a scenario DataFrame. Blank optional cells take their defaults."""
+    values, problems = {}, []
+    for field in dataclasses.fields(ScenarioParams):
+        column = COLUMN_NAMES.get(field.name, field.name)
+        value = file[column][s] if column in file else None
+        if value is None or value != value:  # Missing column or NaN cell
+            if field.default is dataclasses.MISSING:
+                problems.append('missing ' + column)
+            elif field.name == 'maint_date' and file['may_maint'][s] == 1:
+                values[field.name] = (5, 31)  # may_maint fixes electrolyte maintenance to the last day of May
+            continue
+        try:
+            values[field.name] = _convert(field, value)
+        except ValueError as e:
+            problems.append(column + ': ' + str(e))
+    # The scenario CSV has a duplicated time-step_h column, which pandas reads in as time-step_h.1
+    if 'time-step_h.1' in file and float(file['time-step_h.1'][s]) != float(file['time-step_h'][s]):
+        problems.append('duplicated time-step_h columns disagree')
+    if problems:
+        raise ValueError('Scenario row ' + str(s) + ' (' + str(file['scenario'][s]) + '): ' + '; '.join(problems))
+    return ScenarioParams(**values)
+
+
+def validate_params(params, check_files=True):
+    """Returns a list of problems with the units, ranges and input files of a ScenarioParams (empty if it is valid)."""
+    p, problems = params, []
+
+    def check(ok, message):
+        if not ok:
+            problems.append(message)
+    check(p.P_inv_cont > 0, 'P_inv_cont must be > 0 kW')
+    check(p.EtoP > 0, 'EtoP must be > 0 h')
+    check(0 <= p.SOC_min < p.SOC_max <= 1, 'need 0 <= SOC_min < SOC_max <= 1')
+    check(p.SOC_min <= p.SOC_0 <= p.SOC_max, 'SOC_0 must be between SOC_min and SOC_max')
+    check(0 < p.P_cap <= 1, 'P_cap must be a fraction of P_inv_cont in (0, 1]')
+    check(0 < p.time_step_h <= 1 and abs(24 / p.time_step_h - round(24 / p.time_step_h)) < 1e-9,
+          'time-step_h must divide a day into whole steps of at most an hour')
+    check(0 < p.win_actioned <= p.win_opt, 'need 0 < win_actioned <= win_opt (h)')
+    check(p.day_prog > 0, 'day_prog must be > 0 days')
+    check(abs(p.win_actioned - 24 * p.day_prog) < 1e-9, 'the window must move on by its actioned portion: '
+                                                        'win_actioned = 24 * day_prog h')
+    for key in ['win_opt', 'win_actioned']:
+        steps = getattr(p, key) / p.time_step_h
+        check(abs(steps - round(steps)) < 1e-9, key + ' must be a whole number of time-steps')
+    check(p.project_year_cap >= 1, 'project_year_cap must be at least 1 year')
+    check(p.verbose in [0, 1], 'verbose must be 0 or 1')
+    check(150 < p.T < 400, 'T_K must be a cell temperature in kelvin')
+    check(0 < p.EOL < 1, 'EOL must be a capacity fraction in (0, 1)')
+    check(0 < p.cap_init <= 1, 'cap_init must be a capacity fraction in (0, 1]')
+    check(p.o_m_cost >= 0, 'o_m_cost must be >= 0')
+    check(p.may_maint in [0, 1], 'may_maint must be 0 or 1')
+    check(p.ff_tol >= 0, 'ff_tol must be >= 0')
+    check(p.verbose_decimate >= 1, 'verbose_decimate must be >= 1')
+    check(p.resume in [0, 1], 'resume must be 0 or 1')
+    check(p.verbose_format in ['auto', 'parquet', 'hdf5', 'csv'], 'verbose_format must be auto, parquet, hdf5 or csv')
+    check(0 <= p.peak_init_excl_h < 24, 'peak_init_excl_h must be in [0, 24) h')
+    stat = p.peak_init_stat.lower()
+    check(stat in ['mean', 'prior'] or (stat.startswith('p') and stat[1:].replace('.', '', 1).isdigit() and
+                                        0 <= float(stat[1:]) <= 100), 'peak_init_stat must be mean, prior or p0-p100')
+    progress = p.progress.lower()
+    check(progress in ['day', 'month'] or (progress.endswith('%') and progress[:-1].replace('.', '', 1).isdigit()),
+          "progress must be day, month or a percentage such as 5%")
+    check(p.maint_date is None or (len(p.maint_date) == 2 and 1 <= p.maint_date[0] <= 12 and
+                                   1 <= p.maint_date[1] <= 31), "maint_date must be 'mm-dd'")
+    check(0 <= p.maint_threshold < 1, 'maint_threshold must be a capacity fraction in [0, 1)')
+    check(p.opt_type in OPT_TYPES, 'opt_type must be one of ' + ', '.join(OPT_TYPES))
+    check(p.solver in SOLVERS, 'solver must be one of ' + ', '.join(SOLVERS))
+    check(p.export_cap >= 0, 'export_cap must be >= 0 kW')
+    check(p.AS_stacking in [0, 1], 'AS_stacking must be 0 or 1')
+    check(p.exog_dtype in EXOG_DTYPES, 'exog_dtype must be one of ' + ', '.join(EXOG_DTYPES))
+    if p.AS_stacking == 1:
+        check(0 < p.ARD <= 1 and 0 < p.ARU <= 1, 'ARD and ARU must be deployment fractions in (0, 1]')
+        check(0 <= p.WRD <= 1 and 0 <= p.WRU <= 1, 'WRD and WRU must be fractions in [0, 1]')
+        check(p.CER > 0, 'CER must be > 0 h')
+    if check_files:
+        for key in ['tariff_key', 'tariff_prices', 'load_profile', 'wholesale_profile', 'AS_profiles']:
+            check(os.path.isfile(getattr(p, key)), key + ' file not found: ' + getattr(p, key))
+    return problems
+
+
+def make_bess_params(params, BESS_csv='v_7_BESS_params.csv'):
+    """Looks up the BESS named by a scenario in the BESS parameter CSV."""
+    df = pd.read_csv(BESS_csv)
+    if params.BESS not in df['BESS'].tolist():
+        raise ValueError('Scenario ' + params.scenario + ': BESS ' + repr(params.BESS) + ' not in ' + BESS_csv)
+    row = df['BESS'].tolist().index(params.BESS)  # Look up appropriate row for given BESS class
+    values = {'BESS': params.BESS, 'BESS_class': df['BESS_class'][row], 'Eff_LP': float(df['Eff_LP'][row]),
+              'C_0': params.P_inv_cont * params.EtoP}
+    if values['BESS_class'] not in BESS_CLASSES:
+        raise ValueError('BESS ' + params.BESS + ': unknown BESS_class ' + repr(values['BESS_class']))
+    # Class specific params: VRFB electrolyte decay and capacity fade rates, Li-ion OCV and cell capacity
+    needed = ['EDR', 'CFR'] if values['BESS_class'] == 'VRFB' else ['OCV_0', 'OCV_1', 'Q_cell']
+    for key in needed:
+        if key not in df or df[key][row] != df[key][row]:
+            raise ValueError('BESS ' + params.BESS + ': ' + values['BESS_class'] + ' needs ' + key)
+        values[key] = float(df[key][row])
+    if not 0 < values['Eff_LP'] <= 1:
+        raise ValueError('BESS ' + params.BESS + ': Eff_LP must be in (0, 1]')
+    return BESSParams(**values)
+
+
+def make_sim_state(params, bess):
+    """Initial simulation state of a scenario."""
+    return SimState(SOC_0=params.SOC_0, days=1, C=bess.C_0 * params.cap_init,  # Starting capacity alterable
+                    rfc=rfc_stream_init() if bess.BESS_class == 'Li-ion' else None)
+
+
+def load_scenarios(scenarios, BESS_csv='v_7_BESS_params.csv', check_files=True):
+    """Reads a scenario CSV (or DataFrame), expands its sweeps and returns a validated ScenarioParams per row. All
+    problems found are reported together in one ValueError."""
+    if not isinstance(scenarios, pd.DataFrame):
+        scenarios = pd.read_csv(scenarios)
+    scenarios = expand_sweeps(scenarios)
+    params_list, problems = [], []
+    for s in range(len(scenarios)):
+        try:
+            params = make_scenario_params(scenarios, s)
+            make_bess_params(params, BESS_csv)
+        except ValueError as e:
+            problems.append(str(e))
+            continue
+        problems += ['Scenario ' + params.scenario + ': ' + problem for problem in validate_params(params, check_files)]
+        params_list.append(params)
+    names = [params.scenario for params in params_list]
+    problems += ['Scenario name ' + name + ' is used more than once' for name in sorted(set(names))
+                 if names.count(name) > 1]
+    if problems:
+        raise ValueError('Invalid scenarios:\n  ' + '\n  '.join(problems))
+    return params_list
+
+
+def load_fleet_sites(params, load_columns, sites=None, BESS_csv='v_7_BESS_params.csv'):
+    """The ScenarioParams of each site of a fleet, by site, from the fleet's base scenario (params) and a sites CSV
+    (or DataFrame) with a site column, naming the site's column in the fleet load CSV, and any of the FLEET_COLUMNS.
+    Blank cells take the base scenario's value. Without a sites CSV, every one of load_columns is a site sized as the
+    base scenario. All problems found are reported together in one ValueError."""
+    if sites is None:
+        sites = pd.DataFrame({'site': list(load_columns)})
+    elif not isinstance(sites, pd.DataFrame):
+        sites = pd.read_csv(sites)
+    fields = {field.name: field for field in dataclasses.fields(ScenarioParams)}
+    problems = ['sites CSV column ' + column + ' is not one of site, ' + ', '.join(FLEET_COLUMNS)
+                for column in sites.columns if column != 'site' and column not in FLEET_COLUMNS]
+    site_params = {}
+    for s in range(len(sites)):
+        site = str(sites['site'][s])
+        if site in site_params:
+            problems.append('Site ' + site + ' is listed more than once')
+            continue
+        if site not in load_columns:
+            problems.append('Site ' + site + ': no load column ' + site + ' in ' + params.load_profile)
+            continue
+        values = {'scenario': params.scenario + '_' + site}
+        for column in FLEET_COLUMNS:
+            value = sites[column][s] if column in sites else None
+            if value is None or value != value:
+                continue
+            try:
+                values[column] = _convert(fields[column], value)
+            except ValueError as e:
+                problems.append('Site ' + site + ': ' + column + ': ' + str(e))
+        site_params[site] = dataclasses.replace(params, **values)
+        try:
+            make_bess_params(site_params[site], BESS_csv)
+        except ValueError as e:
+            problems.append('Site ' + site + ': ' + str(e))
+            continue
+        problems += ['Site ' + site + ': ' + problem
+                     for problem in validate_params(site_params[site], check_files=False)]
+    if problems:
+        raise ValueError('Invalid fleet sites:\n  ' + '\n  '.join(problems))
+    return site_params
+
+
+def state_to_dict(state):
+    return dataclasses.asdict(state)
+
+
+def state_from_dict(values):
+    return SimState(**values)
+
+
+def legacy_dicts(params, bess, state):
+    """The s_dict and BESS_dict of a scenario, in the form the reference implementations (e.g.
+    opt_peak_shave_rules_ASAP) take."""
+    s_dict = {'time-step_h' if field.name == 'time_step_h' else field.name: getattr(params, field.name)
+              for field in dataclasses.fields(params)}
+    s_dict.update({'SOC_0': state.SOC_0, 'days': state.days})
+    BESS_dict = {field.name: getattr(bess, field.name) for field in dataclasses.fields(bess)}
+    BESS_dict.update({field.name: getattr(state, field.name) for field in dataclasses.fields(state)
+                      if field.name not in ['SOC_0', 'days']})
+    return s_dict, BESS_dict
@@ -0,0 +1,120 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from v_7_param_functions import load_exog_dataset
+from v_7_profiling import stage
+
+"""Cache of parsed exogenous variable datasets. Datasets are stored on disk as one compact .npy file per series (see
+compact_exog) and used memory-mapped for the rest of the run, so a process only holds the pages of the months it is
+running however many years the data spans, and repeat sweeps skip CSV parsing. Entries are keyed by a hash of the
+content of the source CSVs, the time-step and the storage dtype, so editing any source file invalidates its entry.
+Within a run, datasets are looked up by the path, size and modification time of each source file, so repeat lookups
+only stat the files, and each file's content is hashed at most once per version of it."""
+
+CACHE_VERSION = 3  # Bump when the layout of load_exog_dataset's output changes
+SOURCE_KEYS = ['tariff_key', 'tariff_prices', 'load_profile', 'wholesale_profile', 'AS_profiles']
+_memory_cache = {}
+_file_hashes = {}  # (path, size, mtime_ns) -> SHA-256 of the file's content
+
+
+def source_signature(params, sites=None):
+    """Identifies the inputs of load_exog_dataset from file metadata alone: the path, size and modification time of
+    each source file, together with the time-step, storage dtype and, for a fleet, the load columns of its sites."""
+    files = []
+    for key in SOURCE_KEYS:
+        path = os.path.abspath(getattr(params, key))
+        st = os.stat(path)
+        files.append((path, st.st_size, st.st_mtime_ns))
+    return (float(params.time_step_h), params.exog_dtype, None if sites is None else tuple(sites), tuple(files))
+
+
+def file_hash(file_sig):
+    """SHA-256 of the content of a file, given its (path, size, mtime_ns) signature. Memoised for the run, so a file
+    is only read again once it has changed."""
+    if file_sig not in _file_hashes:
+        h = hashlib.sha256()
+        with open(file_sig[0], 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        _file_hashes[file_sig] = h.hexdigest()
+    return _file_hashes[file_sig]
+
+
+def dataset_hash(params, sites=None, signature=None):
+    """Hashes the content of the files load_exog_dataset reads, together with the time-step, storage dtype and, for a
+    fleet, the load columns of its sites. Pass the source_signature if already taken."""
+    if signature is None:
+        signature = source_signature(params, sites)
+    h = hashlib.sha256()
+    h.update(('v' + str(CACHE_VERSION) + '|' + repr(float(params.time_step_h)) + '|' + params.exog_dtype).encode())
+    if sites is not None:
+        h.update(('|sites|' + json.dumps(list(sites))).encode())
+    for key, file_sig in zip(SOURCE_KEYS, signature[-1]):
+        h.update(('|' + key + '|' + file_hash(file_sig)).encode())
+    return h.hexdigest()
+
+
+def save_dataset(dataset, path):
+    """Writes a dataset to a cache directory. The directory is built under a temporary name and renamed into place,
+    so concurrent writers or interruptions never leave a partial entry."""
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+    try:
+        for key, values in dataset['exog_variables_t'].items():
+            np.save(os.path.join(tmp_path, 'exog_variables_t_' + key + '.npy'), values)
+        meta = {'steps_per_day': dataset['calendar']['steps_per_day'],
+                'months': [[yyyy, mm, start, stop] for (yyyy, mm), (start, stop) in
+                           dataset['calendar']['months'].items()],
+                'exog_keys': list(dataset['exog_variables_t']),
+                'k_charges': [[int(k), float(v)] for k, v in dataset['k_charges'].items()],
+                'u_charges': [[int(u), float(v)] for u, v in dataset['u_charges'].items()]}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):  # Losing the race to another writer is fine, anything else is not
+            raise
+
+
+def load_dataset(path):
+    """Reads a cache directory written by save_dataset. Arrays are memory-mapped read-only."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    exog_variables_t = {key: np.load(os.path.join(path, 'exog_variables_t_' + key + '.npy'), mmap_mode='r')
+                        for key in meta['exog_keys']}
+    calendar = {'steps_per_day': meta['steps_per_day'],
+                'months': {(yyyy, mm): (start, stop) for yyyy, mm, start, stop in meta['months']}}
+    return {'exog_variables_t': exog_variables_t, 'calendar': calendar,
+            'k_charges': {k: v for k, v in meta['k_charges']}, 'u_charges': {u: v for u, v in meta['u_charges']}}
+
+
+def load_exog_dataset_cached(params, cache_dir='exog_cache', profile=None, sites=None):
+    """Drop-in replacement for load_exog_dataset. Looks in memory, then in cache_dir, and only parses the CSVs (and
+    stores the result) on a miss. Pass cache_dir=None to keep the cache in memory only (not memory-mapped)."""
+    with stage(profile, 'cache_lookup'):
+        signature = source_signature(params, sites)
+        if signature not in _memory_cache:  # Only hash file content when memory misses
+            key = dataset_hash(params, sites, signature)
+    if signature in _memory_cache:
+        return _memory_cache[signature]
+    path = os.path.join(cache_dir, key) if cache_dir is not None else None
+    if path is not None and os.path.isfile(os.path.join(path, 'meta.json')):
+        with stage(profile, 'cache_load'):
+            dataset = load_dataset(path)
+    else:
+        dataset = load_exog_dataset(params, profile, sites)
+        if path is not None:
+            save_dataset(dataset, path)
+            dataset = load_dataset(path)  # Memory-mapped, so the parsed arrays are freed and pages shared by processes
+    _memory_cache[signature] = dataset
+    return dataset
@@ -1,50 +1,156 @@
-﻿# coding: utf-8
-####################
-# Import libraries #
-####################
-# Importing libraries within function is not allowed so it is done here
-from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
-import math
-# For data_mgmt_by_list
-import pandas as pd  # CSV handling
-# Sam Homan's rainflow algorithm for identifying cycles with a schedule, and their associated mean SOC
-from SH_cycle_counting_by_rainflow import *
-
-def VRFB_elec_decay(mm, dd, s_dict, BESS_dict, SOC_profile):
-    """As VRFB cap. fade is only dependent on cycle throughput in our formulation (as per Rodby et al.) a simple
-    SOC tracker may be used, rather than the SH rainflow counter required for Li-ion."""
-    # Schedule input for function needs to include SOC_0 point.
-    schedule = [s_dict['SOC_0']] + [SOC_profile[i] for i in range(s_dict['win_actioned'] * 4)]
-    q = 0  # E throughput in equivalent full cycles
-    for i in range(len(schedule)-1):
-        if schedule[i+1] > schedule[i]:
-            q += (schedule[i+1] - schedule[i])/2
-        else:
-            q += (schedule[i] - schedule[i+1])/2
-    BESS_dict['Q'] += q  # Convert from SOC travel to cycles
-    print('Cycles performed:', "%.2f" % (q))
-    if s_dict['may_maint'] == 1:  # In this branch, maintenance always occurs on last day in May
-        # If capacity drops below permitted limit, perform maintenance operation and log cost
-        if mm == 5:
-            if dd == 30:  # Last day of May (first day is 0)
-                BESS_dict['C'] = BESS_dict['C_0']
-                o_and_m_d = s_dict['o_m_cost'] * BESS_dict['C_0']
-            else:
-                BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
-                o_and_m_d = 0
-        else:
-            BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
-            o_and_m_d = 0
-    else:  # If not fixing the maintenance in May, just let it decay to show what happens
-        BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
-        o_and_m_d = 0
-    print('Capacity fraction', "%.2f" % (BESS_dict['C']/BESS_dict['C_0']))
-    return o_and_m_d, q
-
-def VRFB_rebalance_cost(q, BESS_dict, U, W):
-    f = q * BESS_dict['CFR']  # % Capacity fade due to cycles performed
-    delta_ox = 4 - (2 * f * 3.5 + (1 - f) * 4)/(1 + f)
-    U_r = sum(U[0:31])/32  # Average price of retail energy in rebalance period
-    W_r = sum(W[0:31])/32  # Average price of wholesale energy in rebalance period
-    rebalance_cost_d = BESS_dict['C'] * delta_ox * (U_r + W_r) / math.sqrt(BESS_dict['Eff_LP'])
-    return rebalance_cost_d
\ No newline at end of file
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+# Importing libraries within function is not allowed so it is done here
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import math
+import numpy as np
+# For data_mgmt_by_list
+import pandas as pd  # CSV handling
+# Sam Homan's rainflow algorithm for identifying cycles with a schedule, and their associated mean SOC
+from SH_cycle_counting_by_rainflow import *
+from v_7_log import get_logger
+
+logger = get_logger('deg')
+
+def VRFB_elec_decay(mm, days, params, bess, state, SOC_profile):
+    """As VRFB cap. fade is only dependent on cycle throughput in our formulation (as per Rodby et al.) a simple
+    SOC tracker may be used, rather than the SH rainflow counter required for Li-ion. Applies the decay of one
+    committed window (SOC_profile), or the maintenance event if it is scheduled on one of the days of month mm that
+    begin in the window (days, first day is 0, see maintenance_dates), to the SimState."""
+    q, C, maint = VRFB_decay_kernel(state.SOC_0, np.asarray(SOC_profile, dtype=float)[None, :], state.C, bess.C_0,
+                                    bess.EDR, [maintenance_dates(params, mm, days).any()], params.maint_threshold)
+    state.Q += q[0]  # Convert from SOC travel to cycles
+    state.C = C[0]
+    o_and_m_d = params.o_m_cost * bess.C_0 if maint[0] else 0
+    logger.debug('Cycles performed: %.2f', q[0])
+    logger.debug('Capacity fraction %.2f', state.C/bess.C_0)
+    return o_and_m_d, q[0]
+
+def VRFB_elec_decay_fleet(mm, days, params_list, bess_list, states, SOC_profiles):
+    """VRFB_elec_decay for several VRFB sites of a fleet at once, given each site's committed SOC profile of the same
+    window in a (sites, time-steps) array. Updates each site's SimState and returns each site's O&M cost and
+    throughput."""
+    q, C, maint = VRFB_decay_kernel(np.array([state.SOC_0 for state in states]), SOC_profiles[:, None, :],
+                                    np.array([state.C for state in states]), np.array([bess.C_0 for bess in bess_list]),
+                                    np.array([bess.EDR for bess in bess_list]),
+                                    [[maintenance_dates(params, mm, days).any()] for params in params_list],
+                                    np.array([params.maint_threshold for params in params_list]))
+    for state, q_i, C_i in zip(states, q[:, 0], C[:, 0]):
+        state.Q += q_i  # Convert from SOC travel to cycles
+        state.C = C_i
+    o_and_m_d = [params.o_m_cost * bess.C_0 if maint_i else 0
+                 for params, bess, maint_i in zip(params_list, bess_list, maint[:, 0])]
+    return o_and_m_d, q[:, 0]
+
+def VRFB_elec_decay_month(mm, params, bess, state, SOC_profiles):
+    """VRFB_elec_decay for every day of month mm at once, given the SOC log of each day's window in an array of shape
+    (days, time-steps in window), of which the first win_actioned hours are committed. Each day's window starts from
+    the end of the previous one's committed portion.
+    Returns each day's O&M cost and throughput, with the state updated as if VRFB_elec_decay had been called daily."""
+    q, C, maint = VRFB_decay_kernel(state.SOC_0, SOC_profiles, state.C, bess.C_0, bess.EDR,
+                                    maintenance_dates(params, mm, range(len(SOC_profiles))), params.maint_threshold,
+                                    int(round(params.win_actioned / params.time_step_h)))
+    state.Q = np.add.accumulate(np.concatenate([[state.Q], q]))[-1]  # Summed in day order
+    if len(C):
+        state.C = C[-1]
+    return np.where(maint, params.o_m_cost * bess.C_0, 0), q
+
+def maintenance_dates(params, mm, days):
+    """Flags the days (first day of the month is 0) of month mm on which electrolyte maintenance is scheduled by
+    date. Scenarios with may_maint == 1 and no maint_date are maintained on the last day of May."""
+    days = np.asarray(days)
+    if params.maint_date is None:
+        return np.zeros(len(days), dtype=bool)
+    maint_mm, maint_dd = params.maint_date
+    return (days + 1 == maint_dd) & (mm == maint_mm)
+
+def VRFB_decay_kernel(SOC_0, SOC_profiles, C, C_0, EDR, maint_dates, maint_threshold=0, n_actioned=None):
+    """Vectorized electrolyte decay over consecutive days, for one BESS or a batch of configurations.
+    SOC_profiles holds each day's window SOC log, shape (days, time-steps), or (configs, days, time-steps) with SOC_0,
+    C, C_0, EDR, maint_threshold and maint_dates given once or per configuration (maint_dates may be a (days,) array
+    shared by all). Only the first n_actioned time-steps of a window count (all if None), and each day starts from the
+    last counted SOC of the previous window.
+    Maintenance happens on a scheduled date, or on the first day that starts with capacity below maint_threshold (a
+    fraction of C_0): capacity is restored to C_0 and that day's decay is skipped.
+    Returns throughput (EFC), capacity at the end of each day and a maintenance flag, each shaped (..., days)."""
+    SOC_profiles = np.asarray(SOC_profiles, dtype=float)
+    batch = SOC_profiles.ndim == 3
+    if not batch:
+        SOC_profiles = SOC_profiles[None]
+    n, n_days = SOC_profiles.shape[:2]
+    # Each day's schedule needs to include its SOC_0 point
+    SOC_profiles = SOC_profiles[:, :, :n_actioned]
+    starts = np.concatenate([np.broadcast_to(np.asarray(SOC_0, dtype=float), (n,))[:, None],
+                             SOC_profiles[:, :-1, -1]], axis=1)
+    schedule = np.concatenate([starts[:, :, None], SOC_profiles], axis=2)
+    q = np.cumsum(np.abs(np.diff(schedule, axis=2)) / 2, axis=2)[:, :, -1]  # E throughput, summed in time order
+    C, C_0 = (np.broadcast_to(np.asarray(values, dtype=float), (n,)) for values in [C, C_0])
+    EDR, threshold = (np.broadcast_to(np.asarray(values, dtype=float), (n,)) for values in [EDR, maint_threshold])
+    decay = q * EDR[:, None] * C_0[:, None]  # Cap loss due to electrolyte decay
+    maint_dates = np.broadcast_to(np.asarray(maint_dates, dtype=bool), (n, n_days))
+    if n_days == 1:  # A single window per configuration (e.g. the sites of a fleet) needs no search for events
+        maint = maint_dates | (C < threshold * C_0)[:, None]
+        C_end = np.where(maint, C_0[:, None], C[:, None] - decay)
+    else:
+        C_end, maint = np.empty((n, n_days)), np.zeros((n, n_days), dtype=bool)
+        for i in range(n):
+            C_i, d = C[i], 0
+            while d < n_days:
+                # Capacity at the start of each remaining day, if nothing intervenes (subtracted in day order)
+                trajectory = np.subtract.accumulate(np.concatenate([[C_i], decay[i, d:]]))
+                due = maint_dates[i, d:] | (trajectory[:-1] < threshold[i] * C_0[i])
+                if not due.any():
+                    C_end[i, d:] = trajectory[1:]
+                    break
+                e = int(np.argmax(due))  # Next maintenance event
+                C_end[i, d:d + e] = trajectory[1:e + 1]
+                C_end[i, d + e], maint[i, d + e] = C_0[i], True
+                C_i, d = C_0[i], d + e + 1
+    if not batch:
+        return q[0], C_end[0], maint[0]
+    return q, C_end, maint
+
+def VRFB_rebalance_cost_month(q, C, bess, U, W):
+    """The baseline VRFB_rebalance_cost (see v_7_legacy_reference) for every day of a month at once. q and C hold each
+    day's throughput and the capacity after that day's decay, U and W are the price arrays of the month's windows,
+    shape (days, time-steps in window). Returns the month's total rebalance cost, identical to summing
+    VRFB_rebalance_cost day by day."""
+    f = np.asarray(q, dtype=float) * bess.CFR  # % Capacity fade due to cycles performed
+    delta_ox = 4 - (2 * f * 3.5 + (1 - f) * 4)/(1 + f)
+    U_r = np.cumsum(U[:, 0:31], axis=1)[:, -1]/32  # Average price of retail energy in rebalance period, summed in order
+    W_r = np.cumsum(W[:, 0:31], axis=1)[:, -1]/32  # Average price of wholesale energy in rebalance period
+    rebalance_cost_d = np.asarray(C, dtype=float) * delta_ox * (U_r + W_r) / math.sqrt(bess.Eff_LP)
+    return np.cumsum(rebalance_cost_d)[-1] if len(rebalance_cost_d) else 0
+
+def Li_ion_deg(params, bess, state, SOC_profile):
+    """Li-ion capacity fade from calendar and cycle ageing, after Schmalstieg et al. (2014):
+    loss = alpha(V, T) * t^0.75 + beta(V_mean, DOD) * Q^0.5, with t in days and Q the cell charge throughput in Ah.
+    Stress varies from day to day, so each day's ageing is added from the equivalent time (and throughput) that gives
+    the loss accumulated so far. Cycles come from the streaming rainflow counter held in the SimState, so history is
+    never recounted. SOC_profile is the committed portion of a window. Returns E throughput in equivalent full cycles,
+    as VRFB_elec_decay does."""
+    # Schedule input needs to include SOC_0 point.
+    schedule = np.concatenate([[state.SOC_0], np.asarray(SOC_profile, dtype=float)])
+    q = np.abs(np.diff(schedule)).sum() / 2  # E throughput in equivalent full cycles
+    state.Q += q
+    T = params.T
+    # Calendar ageing at the mean SOC of the day
+    V = bess.OCV_0 + bess.OCV_1 * schedule[1:].mean()
+    alpha = max((7.543 * V - 23.75) * 1e6 * math.exp(-6976 / T), 0)
+    t = (len(schedule) - 1) * params.time_step_h / 24  # Days elapsed
+    if alpha > 0:
+        t_eq = (state.L_cal / alpha) ** (1 / 0.75)
+        state.L_cal = alpha * (t_eq + t) ** 0.75
+    # Cycle ageing, one increment per half or whole cycle closed today
+    first_day = not state.rfc['tail']  # SOC_0 was already fed in as the end of the previous day
+    hc, wc = rfc_stream_update(state.rfc, schedule if first_day else schedule[1:])
+    for cycles, n_half in [(hc, 1), (wc, 2)]:
+        for DOD, SOC_mean in cycles.T:
+            V_mean = bess.OCV_0 + bess.OCV_1 * SOC_mean
+            beta = 7.348e-3 * (V_mean - 3.667) ** 2 + 7.600e-4 + 4.081e-3 * DOD
+            Q_eq = (state.L_cyc / beta) ** 2
+            state.L_cyc = beta * math.sqrt(Q_eq + n_half * DOD * bess.Q_cell)
+    state.C = bess.C_0 * (params.cap_init - state.L_cal - state.L_cyc)
+    return q
@@ -0,0 +1,231 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import numpy as np
+import pandas as pd  # CSV handling
+from v_7_param_functions import peak_loads_by_k, init_peak_record, month_results, month_AC_K, charge_table, \
+    project_data_year
+from v_7_algorithms import make_batch_dict, opt_peak_shave_rules_ASAP_batch, rules_dispatch, njit
+from v_7_deg_functions import VRFB_elec_decay_fleet, VRFB_rebalance_cost_month, Li_ion_deg
+from v_7_config import load_fleet_sites, make_bess_params, make_sim_state
+from v_7_data_cache import load_exog_dataset_cached
+from v_7_scheduler import make_schedule, month_plan, window_days, window_view, by_window, dispatch_window
+from v_7_log import get_logger
+
+"""Fleet mode: many behind-the-meter sites, each with its own BESS, against one shared tariff and price stream. The
+fleet's base scenario names a fleet load CSV, with a local_time column and one 5 min load column (kW) per site, which
+is parsed once (and cached) into a (sites, time-steps) load array next to the shared k, u and price arrays.
+run_batch, which sizing sweeps use too (see v_7_sweep), runs many configurations together: every window, all of them
+are dispatched by the rules based peak shaving (opt_peak_shave_rules_ASAP_batch, or one by one with
+opt_peak_shave_rules_ASAP_fast where numba is not installed), and the month is accounted for all of them in one pass,
+so each configuration's results are those run_scenario gives for it alone. Degradation is tracked per configuration.
+Batches run the rules based dispatch without AS stacking, fast-forward or verbose output."""
+
+logger = get_logger('fleet')
+
+
+def fleet_load_columns(load_CSV):
+    """The site load columns of a fleet load CSV, i.e. every column but local_time."""
+    return [column for column in pd.read_csv(load_CSV, nrows=0).columns if column != 'local_time']
+
+
+def records_to_array(records, n_k):
+    """Stacks the {k: peak} records of the sites into a (sites, n_k) array indexed by k, NaN where a site has no
+    record for k."""
+    peak = np.full((len(records), n_k), np.nan)
+    for i, record in enumerate(records):
+        for k, p in record.items():
+            peak[i, k] = p
+    return peak
+
+
+def array_to_record(peak_row):
+    """The {k: peak} record of one site from its row of a records_to_array array."""
+    return {k: peak_row[k] for k in np.flatnonzero(~np.isnan(peak_row)).tolist()}
+
+
+def fleet_dispatch_window(batch_dict, window, n_commit, peak):
+    """v_7_scheduler.dispatch_window for all sites of a fleet at once. window['load'] is (sites, time-steps) and peak
+    the (sites, n_k) record array, which is not changed. Returns the committed c, d and SOC logs, shape (sites,
+    n_commit), and the record array raised by the committed net load."""
+    load, k = window['load'], np.asarray(window['k'])
+    plan = peak.copy()
+    missing = np.zeros(len(load), dtype=bool)  # Sites planned with a sub-period that has no record
+    for k_i in np.unique(k).tolist():
+        no_record = np.isnan(plan[:, k_i])
+        if no_record.any():
+            plan[no_record, k_i] = np.max(load[no_record][:, k == k_i], axis=1)
+            missing |= no_record
+    c_log, d_log, soc_log, plan = opt_peak_shave_rules_ASAP_batch(batch_dict, load, k, plan)
+    c_log, d_log, soc_log, k = c_log[:, :n_commit], d_log[:, :n_commit], soc_log[:, :n_commit], k[:n_commit]
+    net_load = load[:, :n_commit] + c_log - d_log
+    record = peak.copy()
+    for k_i in np.unique(k).tolist():
+        record[:, k_i] = np.fmax(record[:, k_i], np.max(net_load[:, k == k_i], axis=1))  # fmax skips NaN
+    if n_commit == len(window['k']):  # Where the whole window is committed, the engine's record stands
+        record[~missing] = plan[~missing]
+    return c_log, d_log, soc_log, record
+
+
+def site_dispatch_window(dispatches, states, window, n_commit, peak):
+    """fleet_dispatch_window site by site, through v_7_scheduler.dispatch_window with each site's dispatch engine and
+    SimState. Used in place of the batch kernel where numba is not installed, as the single scenario path is then
+    quicker."""
+    logs, records = [], []
+    for j, (dispatch, state) in enumerate(zip(dispatches, states)):
+        c_log, d_log, soc_log, record = dispatch_window(dispatch, state, {'load': window['load'][j], 'k': window['k']},
+                                                        n_commit, array_to_record(peak[j]))
+        logs.append((c_log, d_log, soc_log))
+        records.append(record)
+    c_log, d_log, soc_log = (np.array([log[n] for log in logs]) for n in range(3))
+    return c_log, d_log, soc_log, records_to_array(records, peak.shape[1])
+
+
+def run_batch(params_list, dataset, load_rows=None, prune=None):
+    """Runs several configurations together, e.g. the sites of a fleet or the points of a sizing sweep, for up to
+    project_year_cap years. The configurations share the time-step, windows and horizon of params_list[0] and the
+    tariff and prices of the dataset. load_rows gives each configuration's row of a fleet's (sites, time-steps) load;
+    without it all of them run on the dataset's load. After each month, prune(project_year, mm, monthly, active) may
+    return configurations (indexes into params_list) to stop, and Li-ion configurations stop at end of life.
+    Returns the monthly results rows, as run_scenario writes them with the index of the configuration under 'config',
+    and {config: (reason, project_year, mm)} for those stopped early."""
+    params = params_list[0]
+    exog_variables_t, calendar, k_charges = dataset['exog_variables_t'], dataset['calendar'], dataset['k_charges']
+    u_price = charge_table(dataset['u_charges'])
+    bess = [make_bess_params(p) for p in params_list]
+    states = [make_sim_state(p, b) for p, b in zip(params_list, bess)]
+    schedule = make_schedule(params, calendar['steps_per_day'])
+    if njit is None:  # Without numba each configuration is dispatched on its own, as run_scenario dispatches it
+        dispatches = [rules_dispatch(p, b, dataset, schedule['n_opt']) for p, b in zip(params_list, bess)]
+    steps_per_day, n_act = schedule['steps_per_day'], schedule['n_act']
+    exog_windows = {key: exog_variables_t[key] for key in ['load', 'k']}
+    n_k = int(np.max(exog_variables_t['k'])) + 1
+    active = np.arange(len(params_list))  # Configurations still running
+    prior_peak_record = [None] * len(params_list)  # Each one's peak demand record at the end of the previous month
+    monthly, stopped = [], {}
+
+    def loads(values):
+        """The active configurations' rows of load values, shape (active, time-steps)."""
+        if load_rows is None:
+            return np.broadcast_to(values, (len(active), values.shape[-1]))
+        return values[np.asarray(load_rows)[active]]
+
+    for project_year in range(params.project_year_cap):
+        if len(active) == 0:
+            break
+        yyyy = project_data_year(calendar, project_year)
+        for mm in range(1, 13):
+            batch_dict = make_batch_dict([params_list[i] for i in active], [bess[i] for i in active],
+                                         [states[i] for i in active])
+            VRFB_rows = np.flatnonzero([bess[i].BESS_class == 'VRFB' for i in active])  # Active rows by class
+            Li_ion_rows = np.flatnonzero([bess[i].BESS_class == 'Li-ion' for i in active])
+            month_start, month_stop = calendar['months'][yyyy, mm]
+            month = slice(month_start, month_stop)
+            load_m = loads(exog_variables_t['load'][..., month])
+            m_of_k, m_of_u, m_of_w = exog_variables_t['k'][month], exog_variables_t['u'][month], \
+                exog_variables_t['w'][month]
+            peak_loads_m = [peak_loads_by_k(load_m[j], m_of_k) for j in range(len(active))]
+            peak = records_to_array([init_peak_record(load_m[j], m_of_k, peak_loads_m[j], steps_per_day,
+                                                      params_list[i].peak_init_excl_h, params_list[i].peak_init_stat,
+                                                      prior_peak_record[i]) for j, i in enumerate(active)], n_k)
+            window_starts, window_commits = month_plan(schedule, month_start, month_stop)
+            # Month arrays of committed dispatch logs by configuration, and each one's state after each window
+            c_m, d_m, SOC_m = (np.empty((len(active), month_stop - month_start)) for _ in range(3))
+            q_m, C_m = np.zeros((len(active), len(window_starts))), np.zeros((len(active), len(window_starts)))
+            Q_m, o_and_m_m = np.zeros(len(active)), np.zeros(len(active))
+            for w, (window_start, n_commit) in enumerate(zip(window_starts, window_commits)):
+                offset = window_start - month_start
+                committed = slice(offset, offset + n_commit)
+                window = window_view(exog_windows, window_start, schedule['n_opt'])
+                window['load'] = loads(window['load'])
+                batch_dict['C'] = np.array([states[i].C for i in active])
+                batch_dict['SOC_0'] = np.array([states[i].SOC_0 for i in active])
+                if njit is None:
+                    c_m[:, committed], d_m[:, committed], SOC_m[:, committed], peak = site_dispatch_window(
+                        [dispatches[i] for i in active], [states[i] for i in active], window, n_commit, peak)
+                else:
+                    c_m[:, committed], d_m[:, committed], SOC_m[:, committed], peak = \
+                        fleet_dispatch_window(batch_dict, window, n_commit, peak)
+                days = window_days(schedule, offset, n_commit)
+                for i in active:
+                    states[i].days += n_commit / steps_per_day
+                if len(VRFB_rows):  # Electrolyte decay of all VRFB configurations at once
+                    rows_v = active[VRFB_rows]
+                    o_and_m_d, q_m[VRFB_rows, w] = VRFB_elec_decay_fleet(
+                        mm, days, [params_list[i] for i in rows_v], [bess[i] for i in rows_v],
+                        [states[i] for i in rows_v], SOC_m[VRFB_rows, committed])
+                    o_and_m_m[VRFB_rows] += o_and_m_d
+                for j in Li_ion_rows:  # Li-ion ageing, one by one, as the rainflow counter streams
+                    i = active[j]
+                    q_m[j, w] = Li_ion_deg(params_list[i], bess[i], states[i], SOC_m[j, committed])
+                Q_m += q_m[:, w]
+                for j, i in enumerate(active):
+                    C_m[j, w] = states[i].C
+                    states[i].SOC_0 = SOC_m[j, offset + n_commit - 1]
+
+            # Account for the month of every configuration in one pass
+            U_m, W_m = by_window(u_price[m_of_u], n_act), by_window(m_of_w, n_act)
+            AC_U_m, AC_W_m, _ = month_results(params.time_step_h, by_window(load_m, n_act), by_window(c_m, n_act),
+                                              by_window(d_m, n_act), U_m, W_m)
+            for j, i in enumerate(active):
+                record = array_to_record(peak[j])
+                rebalance_cost_m = 0
+                if bess[i].BESS_class == 'VRFB':
+                    rebalance_cost_m -= VRFB_rebalance_cost_month(q_m[j], C_m[j], bess[i], U_m, W_m)
+                monthly.append({'config': int(i), 'year': project_year, 'mm': mm,
+                                'AC_K': month_AC_K(k_charges, peak_loads_m[j], record), 'AC_U': AC_U_m[j],
+                                'AC_W': AC_W_m[j], 'Cap_frac': states[i].C / bess[i].C_0, 'Q': Q_m[j],
+                                'o_m': o_and_m_m[j], 'rebalance_cost': rebalance_cost_m})
+                prior_peak_record[i] = record  # Carried to next month for peak_init_stat 'prior'
+            logger.debug('batch %s year %d month %d: %d configurations', params.scenario, project_year, mm,
+                         len(active))
+            if prune is not None:
+                for i in prune(project_year, mm, monthly, active):
+                    stopped[int(i)] = ('pruned', project_year, mm)
+            # Li-ion configurations reach end of life at the year end, when capacity fades to the EOL fraction
+            if mm == 12:
+                for i in active:
+                    if bess[i].BESS_class == 'Li-ion' and states[i].C / bess[i].C_0 <= params_list[i].EOL \
+                            and int(i) not in stopped:
+                        stopped[int(i)] = ('end_of_life', project_year, mm)
+            active = np.array([i for i in active if int(i) not in stopped], dtype=int)
+            if len(active) == 0:
+                break
+    return monthly, stopped
+
+
+def run_fleet(params, sites=None):
+    """Runs a fleet for up to project_year_cap years and writes its results: fleet_<scenario>_monthly_results.csv
+    holds each site's monthly results, as run_scenario writes them, and fleet_<scenario>_annual_results.csv each
+    site's annual totals, plus a 'portfolio' row per year summed over the sites. params is the fleet's base
+    ScenarioParams, whose load_profile is the fleet load CSV, and sites an optional sites CSV (see
+    v_7_config.load_fleet_sites). Li-ion sites drop out of the fleet at end of life. Returns the two results tables."""
+    if params.opt_type != 'rules' or params.AS_stacking != 0:
+        raise ValueError('Fleet ' + params.scenario + ': fleets run the rules based dispatch without AS stacking')
+    site_params = load_fleet_sites(params, fleet_load_columns(params.load_profile), sites)
+    names, site_params = list(site_params), list(site_params.values())
+    dataset = load_exog_dataset_cached(params, sites=names)  # Shared tariff and prices, loads stacked by site
+    monthly, stopped = run_batch(site_params, dataset, load_rows=np.arange(len(names)))
+    for i, (reason, project_year, mm) in stopped.items():
+        logger.info('fleet %s site %s reached end of life in project year %d', params.scenario, names[i],
+                    project_year + 1)
+    monthly = pd.DataFrame(monthly, columns=['config', 'year', 'mm', 'AC_K', 'AC_U', 'AC_W', 'Cap_frac', 'Q', 'o_m',
+                                             'rebalance_cost'])
+    monthly.insert(0, 'site', [names[i] for i in monthly.pop('config')])
+    # Wrap up results by year, for each site and the portfolio
+    annual = []
+    for project_year, year_m in monthly.groupby('year', sort=True):
+        portfolio = [0, 0, 0, 0]
+        for site, site_m in year_m.groupby('site', sort=False):
+            totals = [sum(site_m[key].tolist()) for key in ['AC_K', 'AC_U', 'AC_W', 'rebalance_cost']]
+            annual.append([site, project_year] + totals)
+            portfolio = [a + b for a, b in zip(portfolio, totals)]
+        annual.append(['portfolio', project_year] + portfolio)
+        logger.info('fleet %s year %d: %d sites, portfolio AC_K %.2f, AC_U %.2f', params.scenario, project_year,
+                    year_m['site'].nunique(), portfolio[0], portfolio[1])
+    annual = pd.DataFrame(annual, columns=['site', 'Year', 'AC_K', 'AC_U', 'AC_W', 'rebalance_cost'])
+    monthly.to_csv('fleet_' + str(params.scenario) + '_monthly_results.csv', index=False)
+    annual.to_csv('fleet_' + str(params.scenario) + '_annual_results.csv', index=False)
+    return monthly, annual
@@ -0,0 +1,554 @@
+﻿# coding: utf-8
+"""Frozen copies of the baseline implementations that the performance rewrites replaced, kept as the reference paths of
+v_7_regression: the exogenous data parser and month slicer, the rules-based dispatch, the VRFB electrolyte decay, the
+rainflow counter and the scenario loop with the day by day accounting it calls, as they were before any rewrite. They
+are not used by the scenario pipeline and must not be changed, or the regression harness no longer checks the rewrites
+against the original behaviour. Only the tab indentation (and trailing whitespace) of the rainflow functions has been
+changed, and the scenario loop is wrapped in a function (see run_scenario)."""
+
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import math
+import datetime  # For time stamping optimisation procs
+import numpy as np
+import pandas as pd  # CSV handling
+
+
+##################################
+# v_7_param_functions (baseline) #
+##################################
+def make_BESS_param_dict(s_dict, BESS_csv):
+    df = pd.read_csv(BESS_csv)
+    row = df['BESS'].tolist().index(s_dict['BESS'])  # Look up appropriate row for given BESS class
+    # Read in params that are BESS class agnostic (note, for RFB I units Am-2, otherwise A.unit-1)
+    BESS_dict = {'BESS_class': df['BESS_class'][row],
+                 'Eff_LP': df['Eff_LP'][row]}
+    BESS_dict['C_0'] = s_dict['P_inv_cont'] * s_dict['EtoP']
+    BESS_dict.update({'C': BESS_dict['C_0']*s_dict['cap_init']}) # Mutable capacity entry. Starting point alterable.
+    if BESS_dict['BESS_class'] == 'VRFB':
+        BESS_dict.update({'EDR': float(df['EDR'][row]),
+                          'CFR': float(df['CFR'][row])}) # If VRFB, read the electrolyte decay and capacity fade rates
+    BESS_dict['Q'] = 1  # Track charge throughput in EFC, init. with 1 to avoid problems with algebra on 0
+    return BESS_dict
+
+def parse_k_u_periods(file):
+    file = pd.read_csv(file)
+    # Make a dictionary that will serve as lookup table
+    k_u_dict = {(file['mm'][i],
+                 file['wk_wknd'][i],
+                 file['hh'][i]):
+                [file['k'][i], file['u'][i]]
+                for i in range(len(file['mm']))
+                }
+    return k_u_dict
+
+def parse_exog_variable_data(load_CSV, k_u_dict, w_csv, AS_csv, time_step):
+    """This function constructs two lists of exogenous variable data - one at 15 min (for load, and unit charges) and
+    one at hourly resolution for ancillary services"""
+    # 15 min res data
+    c = 3  # converts 5 min res load to 15 min - adjust if desired
+    load = pd.read_csv(load_CSV)['value'].tolist()
+    date = pd.read_csv(load_CSV)['local_time']
+    wholesale_energy = pd.read_csv(w_csv)['MW'] # This is the $/MWh price
+    # Make exogenous variable list of lists, with format
+    # [[[yyyy, mm, dd, hh, min, day_of_week], [day_of_week, load, k, u]] ... ]
+    exog_variable_l_o_l_t = []
+
+    for i in range(int(len(load)/c)):
+        ts = date[i*c]
+        min = int(ts[14:16])
+        hh = int(ts[11:13])
+        dd = int(ts[0:2])
+        mm = int(ts[3:5])
+        yyyy = int(ts[6:10])
+        day_of_week = datetime.datetime(yyyy, mm, dd).strftime("%A")  # Returns day of week
+        # Generate k and u using the k_u_dict
+        if day_of_week in ['Saturday', 'Sunday']:
+            k = k_u_dict[mm, 'wknd', hh][0]
+            u = k_u_dict[mm, 'wknd', hh][1]
+        else:
+            k = k_u_dict[mm, 'wk', hh][0]
+            u = k_u_dict[mm, 'wk', hh][1]
+        # Generate w by pulling out entries from w CSV, converting i from 15min index to 1h
+        w = wholesale_energy[int(i/4)] / 1000  # And convert price to $/kWh
+        exog_variable_l_o_l_t += [[[yyyy, mm, dd, hh, min], [day_of_week, (1/time_step)*sum(load[i * c: (i * c) + c]),
+                                                              k, u, w]]]
+    # 1 hour res data
+    spin_reserve = pd.read_csv(AS_csv)['SP_CLR_PRC']  # This is the $/MWh price
+    reg_down = pd.read_csv(AS_csv)['RD_CLR_PRC']  # This is the $/MWh price
+    reg_up = pd.read_csv(AS_csv)['RU_CLR_PRC']  # This is the $/MWh price
+    exog_variable_l_o_l_h = []
+    c = 12  # conversion factor 5 min to 1h - adjust if desired
+    for i in range(int(len(load)/c)):
+        ts = date[i*c]
+        hh = int(ts[11:13])
+        dd = int(ts[0:2])
+        mm = int(ts[3:5])
+        yyyy = int(ts[6:10])
+        day_of_week = datetime.datetime(yyyy, mm, dd).strftime("%A")  # Returns day of week
+        s = spin_reserve[i] / 1000  # Convert price to $/kWh
+        r_d = reg_down[i] / 1000
+        r_u =reg_up[i] / 1000
+        exog_variable_l_o_l_h += [[[yyyy, mm, dd, hh], [s, r_d, r_u]]]
+    return exog_variable_l_o_l_t, exog_variable_l_o_l_h
+
+
+def grab_month_exog(exog_variables_t, exog_variables_h, mm, year, time_step):
+    """This function grabs a month portion of exogenous data for use in the monthly optimsiation.
+    It also grabs a day from the following month to provide a buffer in case the optimsiaiton window is > 24h."""
+    m_of_load, m_of_k, m_of_u, m_of_w = [], [], [], []
+    peak_loads_m = {}  # For tracking peak loads in each sub_period (to be used later in revenue calculation)
+    peak_loads_buffer = {}  # Also need to catch k for buffer period falling in new month (avoid index error may > june)
+    for i in exog_variables_t:
+        load, k, u, w = i[1][1], i[1][2], i[1][3], i[1][4]
+        if i[0][0] == year and i[0][1] == mm:  # Current month test
+            m_of_load += [load]
+            m_of_k += [k]
+            m_of_u += [u]
+            m_of_w += [w]
+            if k in peak_loads_m.keys():
+                if load > peak_loads_m[k]:  # Is load higher than existing peak in this demand charge sub-period?
+                    peak_loads_m[k] = load  # If so overwrite record
+            else:
+                peak_loads_m.update({k: load})
+
+        elif i[0][0] == year and i[0][1] == mm + 1 and i[0][2] == 1:  # First day from following month
+            m_of_load += [load]
+            m_of_k += [k]
+            m_of_u += [u]
+            m_of_w += [w]
+            if k not in peak_loads_m.keys():
+                if k in peak_loads_buffer.keys():
+                    peak_loads_buffer[k] = load
+                else:
+                    peak_loads_buffer.update({k: load})
+    peak_loads_buffer.update(peak_loads_m)
+    # Special case for December where buffer day is taken from following year
+    if mm == 12:
+        for i in exog_variables_t:
+            if i[0][0] == year + 1 and i[0][1] == 1 and i[0][2] == 1:  # First day from next year
+                m_of_load += [load]
+                m_of_k += [k]
+                m_of_u += [u]
+                m_of_w += [w]
+    # Convert hourly AS clearing prices to timestep resolution by duplication
+    m_of_s, m_of_r_d, m_of_r_u = [], [], []
+    for i in exog_variables_h:
+        s, r_d, r_u = i[1][0], i[1][1], i[1][2]
+        if i[0][0] == year and i[0][1] == mm:
+            m_of_s += [s for i in range(int(1/time_step))]
+            m_of_r_d += [r_d for i in range(int(1/time_step))]
+            m_of_r_u += [r_u for i in range(int(1/time_step))]
+        elif i[0][0] ==year and i[0][1] == mm+1 and i[0][2] == 1:
+            m_of_s += [s, s, s, s]
+            m_of_r_d += [r_d for i in range(int(1/time_step))]
+            m_of_r_u += [r_u for i in range(int(1/time_step))]
+    # Special case for December where buffer day is taken from following year
+    if mm == 12:
+        for i in exog_variables_h:
+            s, r = i[1][0], i[1][1]
+            if i[0][0] == year + 1 and i[0][1] == 1 and i[0][2] == 1:  # First day from next year
+                m_of_s += [s for i in range(int(1 / time_step))]
+                m_of_r_d += [r_d for i in range(int(1 / time_step))]
+                m_of_r_u += [r_u for i in range(int(1 / time_step))]
+    return m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m, peak_loads_buffer
+
+def day_results(time_step, load, c_log, d_log, U, W):
+    """This function returns the relevant data from the optimal schedule for a given day, to be used in upper level
+    calculation of monthly revenue."""
+    # Make list of ACTUAL net load, i.e. incoming load_profile net of 'optimal' schedule based on historic load
+    T = range(int(len(load)))
+    net_load_profile = []
+    for t in T:
+        net_load_profile += [load[t] + c_log[t] - d_log[t]]
+    # Calculate daily avoided cost in U and W
+    ac_u_d = sum([(d_log[t] - c_log[t]) * U[t] * time_step for t in T])
+    ac_w_d = sum([(d_log[t] - c_log[t]) * W[t] * time_step for t in T])
+    # Calculate daily revenue from AS provision
+    return ac_u_d, ac_w_d, net_load_profile
+
+def parse_verbose(verbose_results, load, c_log, d_log, SOC_profile, demand_profile,
+                                         yyyy, mm, dd, k, u, w):
+    """This function builds an optional verbose output of BESS operation at the resoltuion of the model timestep."""
+    T = range(int(len(load)))
+    verbose_results['yyyy'] += [yyyy for t in T]
+    verbose_results['mm'] += [mm for t in T]
+    verbose_results['dd'] += [dd + 1 for t in T]  # =1 to match labels in python output
+    verbose_results['period'] += [t+1 for t in T]
+    verbose_results['k'] += [k[t] for t in T]
+    verbose_results['u'] += [u[t] for t in T]
+    verbose_results['w'] += [w[t] for t in T]
+    verbose_results['load'] += [load[t] for t in T]
+    verbose_results['P'] += [c_log[t] - d_log[t] for t in T]
+    verbose_results['net_load'] += [demand_profile[t] for t in T]
+    verbose_results['SOC'] += [SOC_profile[t] for t in T]
+    return verbose_results
+
+
+#############################
+# v_7_algorithms (baseline) #
+#############################
+def opt_peak_shave_rules_ASAP(s_dict, BESS_dict, load, K, peak_demands_m):
+    """Rules based peak shaving algorithm."""
+
+    # Index sets #
+    # Primary index
+    T = range(len(load))
+    # Time-step (h)
+    time_step = s_dict['time-step_h']
+
+    ################
+    """Parameters"""
+    ################
+    # Generic scalar BESS params
+    p_max = s_dict['P_inv_cont'] * s_dict['P_cap']  # kW
+    C = BESS_dict['C']
+    soc_min = s_dict['SOC_min']
+    soc_max = s_dict['SOC_max']
+    # BESS specific params
+    eff =BESS_dict['Eff_LP'] # Leave as python float to avoid slow sqrt performance
+
+    # Here comes the peak shaving algorithm
+    soc_0 = s_dict['SOC_0']  # Initialise SOC at start of period
+    c_log, d_log, soc_log =[], [], []
+    for t in T:
+        # Charge battery?
+        if load[t] < peak_demands_m[K[t]]:
+            d_log += [0]
+            c = min(p_max, peak_demands_m[K[t]] - load[t])  # Power constrained charging
+            if soc_0 + (c * time_step * math.sqrt(eff))/C <= soc_max:
+                soc = soc_0 + (c * time_step * math.sqrt(eff))/C
+            else:
+                c = (soc_max - soc_0)*C/(time_step*math.sqrt(eff)) # SOC constrained charging, derate power
+                soc = soc_max  # Update SOC counter
+            c_log += [c]
+            soc_log += [soc]
+            soc_0 = soc  # Update SOC counter
+        else: # Discharge battery
+            c_log += [0]
+            d = min(p_max, load[t] - peak_demands_m[K[t]])  # Power constrained discharging
+            if soc_0 - (d * time_step)/(math.sqrt(eff) * C) >= soc_min:
+                soc = soc_0 - (d * time_step)/(math.sqrt(eff) * C)
+            else:
+                d = (soc_0 - soc_min)* C * math.sqrt(eff)/time_step # SOC constrained discharging, derate power
+                soc = soc_min
+            d_log += [d]
+            soc_log += [soc]
+            soc_0 = soc  # Update SOC counter
+            # If BESS is unable to keep net load below the peak so far for the month, record must be updated.
+            if load[t] - d > peak_demands_m[K[t]]:
+                peak_demands_m[K[t]] = load[t] - d
+    return c_log, d_log, soc_log, peak_demands_m
+
+
+################################
+# v_7_deg_functions (baseline) #
+################################
+def VRFB_elec_decay(mm, dd, s_dict, BESS_dict, SOC_profile):
+    """As VRFB cap. fade is only dependent on cycle throughput in our formulation (as per Rodby et al.) a simple
+    SOC tracker may be used, rather than the SH rainflow counter required for Li-ion."""
+    # Schedule input for function needs to include SOC_0 point.
+    schedule = [s_dict['SOC_0']] + [SOC_profile[i] for i in range(s_dict['win_actioned'] * 4)]
+    q = 0  # E throughput in equivalent full cycles
+    for i in range(len(schedule)-1):
+        if schedule[i+1] > schedule[i]:
+            q += (schedule[i+1] - schedule[i])/2
+        else:
+            q += (schedule[i] - schedule[i+1])/2
+    BESS_dict['Q'] += q  # Convert from SOC travel to cycles
+    print('Cycles performed:', "%.2f" % (q))
+    if s_dict['may_maint'] == 1:  # In this branch, maintenance always occurs on last day in May
+        # If capacity drops below permitted limit, perform maintenance operation and log cost
+        if mm == 5:
+            if dd == 30:  # Last day of May (first day is 0)
+                BESS_dict['C'] = BESS_dict['C_0']
+                o_and_m_d = s_dict['o_m_cost'] * BESS_dict['C_0']
+            else:
+                BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
+                o_and_m_d = 0
+        else:
+            BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
+            o_and_m_d = 0
+    else:  # If not fixing the maintenance in May, just let it decay to show what happens
+        BESS_dict['C'] -= (q * BESS_dict['EDR'] * BESS_dict['C_0'])  # Cap loss due to electrolyte decay
+        o_and_m_d = 0
+    print('Capacity fraction', "%.2f" % (BESS_dict['C']/BESS_dict['C_0']))
+    return o_and_m_d, q
+
+def VRFB_rebalance_cost(q, BESS_dict, U, W):
+    f = q * BESS_dict['CFR']  # % Capacity fade due to cycles performed
+    delta_ox = 4 - (2 * f * 3.5 + (1 - f) * 4)/(1 + f)
+    U_r = sum(U[0:31])/32  # Average price of retail energy in rebalance period
+    W_r = sum(W[0:31])/32  # Average price of wholesale energy in rebalance period
+    rebalance_cost_d = BESS_dict['C'] * delta_ox * (U_r + W_r) / math.sqrt(BESS_dict['Eff_LP'])
+    return rebalance_cost_d
+
+
+############################################
+# SH_cycle_counting_by_rainflow (baseline) #
+############################################
+# Finds peaks and valleys in a SoC time series and returns a reduced time series that only
+# contains these peaks and valleys (all other data points are deleted). The function also finds
+# the periods when the battery is idling at the same SoC (defined as the time when the SoC
+# changes by less than 5e-6); this info is stored in the idle array.
+def find_pkvl_and_idle(SoC):
+    SoC = np.array(SoC)
+    dlt = []
+    idle = []
+
+    # This loop goes through each element of the SoC array and if the element is different to
+    # the adjacent elements, then it is left alone. If the element is the same as the adjacent
+    # elements (within 5e-6), then its index is recorded in the delete list and the idle array.
+    # There is a flaw in this method: the SoC could increase from 0.4 to 0.8 in increments of
+    # 4e-6, for example, but the method would recognise the battery as idling the entire time!
+    for i in range(0,SoC.size):
+        if i==0:
+            if np.isclose(SoC[i], SoC[i+1], rtol=0, atol=5e-6):
+                dlt.append(i)
+                idle.append(SoC[i])
+        if i==SoC.size-1:
+            if np.isclose(SoC[i], SoC[i-1], rtol=0, atol=5e-6):
+                dlt.append(i)
+                idle.append(SoC[i])
+        elif (np.isclose(SoC[i-1], SoC[i], rtol=0, atol=5e-6) and np.isclose(SoC[i],
+        SoC[i+1], rtol=0, atol=5e-6)):
+            dlt.append(i)
+            idle.append(SoC[i])
+        else:
+            continue
+
+    idle = np.array(idle)
+    idle = 1e5*np.round(idle, decimals=5)
+    idle = idle.astype(int)
+
+    # A new array is created 'SoC_noflat' that is the same as 'SoC' but with the flat sections
+    # removed. Only one data point from a flat section is kept (the one that's furthest to the
+    # right). dlt must be a list not a numpy array.
+    SoC_noflat = np.delete(SoC, dlt)
+
+    dlt = []
+
+    # This loop goes through each element of the SoC_noflat array and if the element is a peak
+    # or a valley, then it is left alone. If the element is not a peak or a valley, then its
+    # index is recorded in the delete list.
+    for i in range(1,SoC_noflat.size-1):
+        if SoC_noflat[i] == SoC_noflat[i-1]:
+            if SoC_noflat[i] > SoC_noflat[i-2] and SoC_noflat[i] > SoC_noflat[i+1]:
+                continue
+            if SoC_noflat[i] < SoC_noflat[i-2] and SoC_noflat[i] < SoC_noflat[i+1]:
+                continue
+            if SoC_noflat[i] > SoC_noflat[i-2] and SoC_noflat[i] < SoC_noflat[i+1]:
+                dlt.append(i)
+            if SoC_noflat[i] < SoC_noflat[i-2] and SoC_noflat[i] > SoC_noflat[i+1]:
+                dlt.append(i)
+        else:
+            if SoC_noflat[i] > SoC_noflat[i-1] and SoC_noflat[i] > SoC_noflat[i+1]:
+                continue
+            elif SoC_noflat[i] < SoC_noflat[i-1] and SoC_noflat[i] < SoC_noflat[i+1]:
+                continue
+            else:
+                dlt.append(i)
+
+    #A new array is created 'SoC_pkvl' that only contains alternate peaks and valleys.
+    SoC_pkvl = np.delete(SoC_noflat, dlt)
+
+    #return(SoC_pkvl, SoC_noflat, idle)
+    return(SoC_pkvl)
+
+
+# Finds half and whole cycles within the SoC_pkvl time series. Two arrays are created (one for
+# half-cycles and one for whole-cycles) which have cycle depths in the 1st row and average SoC
+# in the 2nd row.
+def rfc_find_cycles(SoC_pkvl):
+
+    v = np.array([]) #Rainflow counting vector (1D)
+    hc = np.array([[],[]]) #Stores the cycle depth and average SoC of half-cycles (2D)
+    wc = np.array([[],[]]) #Stores the cycle depth and average SoC of whole-cycles (2D)
+    v = np.append(v, SoC_pkvl[0])
+    v = np.append(v, SoC_pkvl[1])
+
+    #This is the algorithm as described in the ASTM paper
+    for i in range(2,SoC_pkvl.size):
+
+        v = np.append(v, SoC_pkvl[i])
+        while v.size >= 3:
+            x = abs(v[-2] - v[-1])
+            y = abs(v[-3] - v[-2])
+            if x < y:
+                break
+            else:
+                if v.size == 3:
+                    hc = np.append(hc, [[y],[(v[-3]+v[-2])/2]], axis=1)
+                    v = np.delete(v, -3)
+                else:
+                    wc = np.append(wc, [[y],[(v[-3]+v[-2])/2]], axis=1)
+                    v = np.delete(v, -2)
+                    v = np.delete(v, -2)
+    for i in range(0,v.size-1):
+        y = abs(v[i]-v[i+1])
+        hc = np.append(hc, [[y],[(v[i]+v[i+1])/2]], axis=1)
+
+    hc = 1*np.round(hc, decimals=5)
+    wc = 1*np.round(wc, decimals=5)
+
+    #This is a very important step! If the elements in the arrays stay as floats then '=='
+    #comparisons later don't always work.
+    #hc = hc.astype(int)
+    #wc = wc.astype(int)
+
+    #print(np.size(hc,axis=1))
+    #print(np.size(wc,axis=1))
+
+    hc = hc[:, hc[0,:]!=0]
+    wc = wc[:, wc[0,:]!=0]
+
+    #print(np.size(hc,axis=1))
+    #print(np.size(wc,axis=1))
+
+
+
+    return hc, wc
+
+
+###################################
+# v_7_scenario_manager (baseline) #
+###################################
+def run_scenario(s_dict, exog_variables_t, exog_variables_h, yyyy):
+    """The body of the baseline scenario loop for one scenario row (s_dict, as make_scenario_dict built it), from the
+    tariff import to the results files. The exogenous lists from parse_exog_variable_data and the year of data yyyy
+    (hard coded to 2012 in the baseline) are passed in, and the monthly results are returned. It runs one project year
+    on a calendar year of data followed by at least the first day of the next year (grab_month_exog's buffer day for
+    December); a second project year fails, as the monthly results become a DataFrame at the first year end."""
+    tariff = pd.read_csv(s_dict['tariff_prices'])  # Get actual prices for DNO tariff
+    u_periods, u_prices, k_periods, k_prices = \
+        tariff['u_period'], tariff['u_price'], tariff['k_period'], tariff['k_price']
+    k_charges = {}
+    for i in range(len(k_periods)):
+        if k_periods[i] == k_periods[i]:  # This test skips any Nan entries
+            k_charges[i+1] = k_prices[i]
+    u_charges = {u_periods[i]: u_prices[i] for i in range(len(u_periods))}  # populate u charge dictionary from csv
+    print("Exogenous variable dataset successfully imported")
+
+    # Define absolute BESS parameters based on scenario and specific BESS #
+    BESS_dict = make_BESS_param_dict(s_dict, 'v_7_BESS_params.csv')
+    # Output receptacles
+    results_s_m = {"year":[], "mm":[], "AC_K":[], "AC_U":[], "AC_W":[], "Cap_frac":[], "Q":[],"o_m":[],
+                   "rebalance_cost":[]}
+    results_s_y = [["Year", "AC_K", "AC_U", "AC_W", "rebalance_cost"]]
+    # Optional output at max res for analysis
+    if s_dict['verbose'] == 1:  # Optional results at optimisation time-step resolution (graphs and troubleshooting)
+        verbose_results = {"yyyy": [], "mm": [], "dd": [], "period": [], "k": [], "u": [], "w": [], "load": [],
+                           "P": [], "net_load": [], "SOC": []}
+    ####################################
+    # Calendar + state based iteration #
+    ####################################
+    project_year = 0  # Project year counter
+    project_year_cap = s_dict['project_year_cap']
+    while project_year < project_year_cap:  # Prevents script running forever when degradation isn't limiting
+        # Month loop (time unit for demand charge billing) #
+        months = [m+1 for m in range(12)]
+        #months = [7]
+        monthly_results = []  # Receptacle for results at monthly resolution
+        for mm in months:
+            # Gather exog variable data for the month
+            m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m, peak_loads_buffer = \
+                    grab_month_exog(exog_variables_t, exog_variables_h, mm, yyyy, s_dict['time-step_h'])
+            # Make dict to store net demand peaks in month so far (passed to solver to prevent redundant shaving)
+            peak_demands_record = {1: 227, 2: 230, 3: 224} # Hard code an informed guess
+
+            # Initial peak demands record heuristic.
+            """This sets an initial peak demand for each sub-period, so that the
+            BESS doesn't just start discharging right away. It is based on the average demand in the sub-period for
+            the coming month, but ignores the first 6 hours of the day where demand is always low.  This is not strictly
+            future-blind, but I expect this could be done adequately with historic data."""
+            print(peak_loads_m)
+            peak_demands_record = {}
+            for k in peak_loads_m:
+                load_in_k = []
+                for d in range(int(len(m_of_load)/96)-1):  # Per day loop
+                    for t in range((d+1)*96 - 72, (d+1)*96):     # Per sub-period excluding first 6 hours
+                        if m_of_k[t] == k:
+                            load_in_k += [m_of_load[t]]
+                if len(load_in_k) != 0:  # Avoids div by 0 error at weekends (when there is no k_2, k_3)
+                    peak_demands_record.update({k: sum(load_in_k)/len(load_in_k)})
+            # Initiate monthly counters for revenue streams
+            AC_U_m, AC_W_m, AC_S_m, Q_m, o_and_m_m, rebalance_cost_m = 0, 0, 0, 0, 0, 0
+            """This loop repeatedly sends a chunk of data to the optimisation function. There are three parameters
+            that control this process: win_opt - the length of the sliding window in hours, win_actioned, the
+            portion of the optimised schedule that is implemented and day_prog, the number of days the window moves
+            on after each optimisation (usually 1)."""
+            days_in_month = range(int(len(m_of_load) * s_dict['time-step_h'] / 24) - 1) # Minus 1 to cancel buffer day
+            #days_in_month = [1,2]
+            for dd in days_in_month:
+                print('scenario', s_dict['scenario'], 'year', project_year, 'month', mm, 'day', dd + 1)
+                window = range(int(dd * s_dict['day_prog'] * 96), int(dd * s_dict['day_prog'] * 96 + s_dict['win_opt']*4))
+                # Get price data across optimisation window
+                load, K, U, W, S, R_d, R_u = [], [], [], [], [], [], []
+                for t in window:
+                    load += [m_of_load[t]]  # Actual 36h of load that will occur
+                    K += [m_of_k[t]]               # Keep as just k indices for now, as required in PYOMO part
+                    U += [u_charges[m_of_u[t]]]
+                    W += [m_of_w[t]]
+                # Here we call the optimisation function #
+                c_log, d_log, SOC_log, peak_demands_record = \
+                    opt_peak_shave_rules_ASAP(s_dict, BESS_dict, load, K, peak_demands_record)
+                # Record relevant data for the implemented schedule and update peak demand record for the month
+                AC_U_d, AC_W_d, net_load_profile = \
+                    day_results(s_dict['time-step_h'], load, c_log, d_log, U, W)
+
+                AC_U_m += AC_U_d
+                AC_W_m += AC_W_d
+
+                #print('days in operation:', "%.0f" % s_dict['days'])
+                s_dict['days'] += 1
+
+                # Call electrolyte decay tracker function
+                if BESS_dict['BESS_class'] == 'VRFB':
+                    o_and_m_d, q = VRFB_elec_decay(mm, dd, s_dict, BESS_dict, SOC_log)
+                    Q_m += q
+                    o_and_m_m += o_and_m_d
+                # Call capacity rebalance cost tracker function
+                if BESS_dict['BESS_class'] == 'VRFB':
+                    rebalance_cost = VRFB_rebalance_cost(q, BESS_dict, U, W)
+                    rebalance_cost_m -= rebalance_cost
+                # This code updates the SOC_0 value to be used in the following window
+                s_dict['SOC_0'] = SOC_log[-1]
+                #print("SOC at end of window: ", "%.2f" % s_dict['SOC_0'], "\n")
+
+                # This optional code writes verbose results to the l_o_l
+                if s_dict['verbose'] == 1:
+                    verbose_results = parse_verbose(verbose_results, load, c_log, d_log, SOC_log, net_load_profile, yyyy, mm, dd, K,
+                                                    U, W)
+
+            # Wrap up results at monthly resolution
+            AC_K_m = sum([k_charges[k] * (peak_loads_m[k] - peak_demands_record[k]) for k in peak_loads_m])
+
+            # Add monthly res results to dict for output later
+            results_s_m['year'] += [project_year]
+            results_s_m['mm'] += [mm]
+            results_s_m['AC_K'] += [AC_K_m]
+            results_s_m['AC_U'] += [AC_U_m]
+            results_s_m['AC_W'] += [AC_W_m]
+            results_s_m['Cap_frac'] += [BESS_dict['C'] / BESS_dict['C_0']]
+            results_s_m["Q"] += [Q_m]
+            results_s_m['o_m'] += [o_and_m_m]
+            results_s_m['rebalance_cost'] += [rebalance_cost_m]
+
+
+        # Wrap up results at year end by summing monthly values
+        results_s_y += [[project_year, sum(results_s_m['AC_K']), sum(results_s_m['AC_U']), sum(results_s_m['AC_W']),
+                        sum(results_s_m['rebalance_cost'])]]
+
+        # Progress year
+        project_year += 1
+        # Output scenario results (write at end of each year in case of interuption)
+        results_s_m = pd.DataFrame(results_s_m)
+        results_s_m.to_csv("scenario_" + str(s_dict['scenario']) + "_monthly_results.csv")
+        results_s_y = pd.DataFrame(results_s_y)
+        results_s_y.to_csv("scenario_" + str(s_dict['scenario']) + "_annual_results.csv")
+    if s_dict['verbose'] == 1:
+        verbose_output = pd.DataFrame(verbose_results)
+        verbose_output.to_csv("scenario_" + str(s_dict['scenario']) + "_verbose_results.csv")
+    return results_s_m
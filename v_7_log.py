@@ -0,0 +1,110 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import logging
+import logging.handlers
+import math
+import time
+
+"""Logging for the scenario pipeline, in place of unconditional prints. Modules log to children of the 'bess' logger,
+which setup_logging points at stderr, or at a multiprocessing queue in pool workers. Progress through a scenario is
+logged at a configurable rate (every day, month, or n percent complete) and carries the scenario's fraction complete,
+so the parent process of a pool can merge the progress of all its workers into one rate-limited line."""
+
+LOGGER_NAME = 'bess'
+
+
+def get_logger(name=None):
+    """Returns the pipeline's logger, or a named child of it (e.g. get_logger('deg'))."""
+    return logging.getLogger(LOGGER_NAME if name is None else LOGGER_NAME + '.' + name)
+
+
+def _quiet_filter(record):
+    """Lets only warnings, errors and progress records through."""
+    return record.levelno >= logging.WARNING or hasattr(record, 'progress')
+
+
+def setup_logging(level='INFO', queue=None, quiet=False):
+    """Configures the pipeline's logger. Records go to stderr, or to queue (a multiprocessing queue) in pool workers,
+    where the parent process handles them with listen_log_queue. quiet drops everything but warnings, errors and
+    progress records, e.g. so that workers only report progress."""
+    logger = get_logger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if queue is not None:
+        handler = logging.handlers.QueueHandler(queue)
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+    if quiet:
+        handler.addFilter(_quiet_filter)
+    logger.addHandler(handler)
+    logger.setLevel(level.upper() if isinstance(level, str) else level)
+    logger.propagate = False
+    return logger
+
+
+def make_progress(scenario, total_days, every='month'):
+    """Progress reporter for a scenario of total_days simulated days. every is 'day', 'month' or a percentage step
+    such as '5%'. Days in between are only logged at DEBUG level."""
+    every = str(every).strip().lower()
+    step = float(every[:-1]) if every.endswith('%') else None
+    if step is None and every not in ['day', 'month']:
+        raise ValueError("progress must be 'day', 'month' or a percentage such as '5%', not " + repr(every))
+    return {'scenario': scenario, 'total_days': max(total_days, 1), 'every': every, 'step': step, 'next_pct': 0}
+
+
+def progress_update(progress, days_done, project_year, mm, dd, end_of_month=False):
+    """Reports that day dd (first day is 0) of month mm of project_year is done, days_done days into the scenario."""
+    fraction = min(days_done / progress['total_days'], 1)
+    if progress['step'] is not None:
+        report = fraction * 100 >= progress['next_pct']
+        if report:
+            progress['next_pct'] = (math.floor(fraction * 100 / progress['step']) + 1) * progress['step']
+    else:
+        report = progress['every'] == 'day' or end_of_month
+    logger = get_logger('progress')
+    if report or logger.isEnabledFor(logging.DEBUG):
+        logger.log(logging.INFO if report else logging.DEBUG, 'scenario %s year %d month %d day %d (%.0f%%)',
+                   progress['scenario'], project_year, mm, dd + 1, 100 * fraction,
+                   extra={'progress': fraction, 'scenario': str(progress['scenario'])})
+
+
+def make_progress_view(n_scenarios, interval_s=5):
+    """Merged view of the progress of n_scenarios running in other processes, logged at most every interval_s."""
+    return {'n': n_scenarios, 'fractions': {}, 'finished': set(), 'interval_s': interval_s, 'last_log': 0}
+
+
+def progress_view_update(view, scenario, fraction, force=False):
+    view['fractions'][scenario] = fraction
+    now = time.monotonic()
+    if not force and now - view['last_log'] < view['interval_s']:
+        return
+    view['last_log'] = now
+    running = {s: f for s, f in view['fractions'].items() if s not in view['finished']}
+    get_logger().info('progress %.0f%% overall, %d finished, %d running of %d%s',
+                      100 * sum(view['fractions'].values()) / max(view['n'], 1), len(view['finished']),
+                      len(running), view['n'],
+                      ' | ' + ', '.join('%s %.0f%%' % (s, 100 * f) for s, f in running.items()) if running else '')
+
+
+def progress_view_finish(view, scenario):
+    """Marks a scenario as complete (it may stop short of its year cap, e.g. at end of life)."""
+    view['finished'].add(str(scenario))
+    progress_view_update(view, str(scenario), 1, force=len(view['finished']) == view['n'])
+
+
+def listen_log_queue(queue, view):
+    """Handles the records workers put on queue until it receives None: progress records update the merged view,
+    everything else is passed to the parent's handlers. Run it in a thread of the parent process."""
+    while True:
+        record = queue.get()
+        if record is None:
+            break
+        if hasattr(record, 'progress'):
+            if record.scenario not in view['finished']:  # Late records can't undo a finish
+                progress_view_update(view, record.scenario, record.progress)
+        else:
+            get_logger().handle(record)
@@ -0,0 +1,94 @@
+﻿# coding: utf-8
+"""This script runs the scenarios of the scenario CSV in parallel over a process pool. Each distinct exogenous variable
+dataset is parsed once in the parent process and read by the workers, which inherit it when processes are forked
+(or receive one pickled copy per worker otherwise). Every worker writes its own scenario results files atomically.
+Workers log quietly to a queue, and the parent merges their progress into a single line.
+Usage: python v_7_parallel_manager.py [scenario_csv] [-n processes] [--log-level INFO] [--progress-interval 5]"""
+
+### Import required tools ###
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import argparse
+import datetime                     # For time stamping scenario runs
+import multiprocessing as mp
+import threading
+from v_7_config import load_scenarios
+from v_7_param_functions import dataset_key
+from v_7_data_cache import load_exog_dataset_cached
+from v_7_scenario_manager import run_scenario
+from v_7_profiling import make_profile, start_profile, stop_profile, write_profile
+from v_7_log import get_logger, setup_logging, make_progress_view, progress_view_finish, listen_log_queue
+
+logger = get_logger('parallel')
+
+# Read-only state shared with the workers: inherited on fork, set by _init_worker otherwise
+_scenarios = None
+_datasets = {}
+
+
+def _init_worker(scenarios, datasets, log_queue, log_level):
+    global _scenarios, _datasets
+    if scenarios is not None:  # Not needed when the state is inherited on fork
+        _scenarios, _datasets = scenarios, datasets
+    setup_logging(log_level, queue=log_queue, quiet=True)
+
+
+def _run_scenario_row(s):
+    """Worker task: runs the s_th scenario against the shared dataset and returns its run time."""
+    start_time = datetime.datetime.now()  # Timestamp scenario analysis start
+    params = _scenarios[s]
+    profile = make_profile(params.profile)
+    start_profile(profile)
+    run_scenario(params, _datasets[dataset_key(params)], profile)
+    stop_profile(profile)
+    run_time = (datetime.datetime.now() - start_time).seconds
+    write_profile(profile, params.scenario, run_time)
+    return s, run_time
+
+
+def run_scenarios_parallel(scenarios, processes=None, log_level='INFO', progress_interval_s=5):
+    """Runs every scenario in the scenarios list (of ScenarioParams, see v_7_config.load_scenarios) over a pool of
+    processes and returns run_time_by_case, in the order of the list. Worker progress is logged as one merged line
+    at most every progress_interval_s."""
+    global _scenarios, _datasets
+    _scenarios = list(scenarios)
+    # Parse each distinct dataset once, before the pool is created, so that forked workers inherit it
+    _datasets = {}
+    for params in scenarios:
+        key = dataset_key(params)
+        if key not in _datasets:
+            _datasets[key] = load_exog_dataset_cached(params)
+    logger.info("Exogenous variable datasets successfully imported: %d", len(_datasets))
+
+    if 'fork' in mp.get_all_start_methods():
+        context, shared = mp.get_context('fork'), (None, None)
+    else:
+        context, shared = mp.get_context(), (_scenarios, _datasets)
+    log_queue = context.Queue()
+    view = make_progress_view(len(scenarios), progress_interval_s)
+    listener = threading.Thread(target=listen_log_queue, args=(log_queue, view), daemon=True)
+    listener.start()
+    pool = context.Pool(processes, initializer=_init_worker, initargs=shared + (log_queue, log_level))
+    run_time_by_case = [None] * len(scenarios)
+    try:
+        with pool:
+            for s, run_time in pool.imap_unordered(_run_scenario_row, range(len(scenarios))):
+                run_time_by_case[s] = run_time
+                logger.info("scenario %s finished in %d s", scenarios[s].scenario, run_time)
+                progress_view_finish(view, scenarios[s].scenario)
+    finally:
+        log_queue.put(None)  # Stops the listener once the workers' records are handled
+        listener.join()
+    return run_time_by_case
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('scenario_csv', nargs='?', default='v_7_scenarios.csv')
+    parser.add_argument('-n', '--processes', type=int, default=None, help='Pool size (default: CPU count)')
+    parser.add_argument('--log-level', default='INFO', help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--progress-interval', type=float, default=5, help='Seconds between merged progress lines')
+    args = parser.parse_args()
+    setup_logging(args.log_level)
+    run_time_by_case = run_scenarios_parallel(load_scenarios(args.scenario_csv), args.processes, args.log_level,
+                                              args.progress_interval)
+    logger.info("run time by case: %s", run_time_by_case)
@@ -1,217 +1,270 @@
-﻿# coding: utf-8
-####################
-# Import libraries #
-####################
-# Importing libraries within function is not allowed so it is done here
-from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
-import pandas as pd  # CSV handling
-import math
-import datetime  # For time stamping optimisation procs
-
-"""Library of functions for parsing parameter and exogenous variable data and passing to the scenario_manager script"""
-
-def make_scenario_dict(file, s):
-    """This function takes the CSV containing s scenarios and converts the s_th row to a dictionary for use in
-    the rest of the script."""
-    s_dict = {'scenario': file['scenario'][s],
-              'P_inv_cont': file['P_inv_cont'][s],
-              'R_ac_dc': file['R_ac_dc'][s],
-              'EtoP': file['EtoP'][s],
-              'SOC_0': file['SOC_0'][s],
-              'tariff_key': file['tariff_key'][s],
-              'tariff_prices': file['tariff_prices'][s],
-              'load_profile': file['load_profile'][s],
-              'wholesale_profile': file['wholesale_profile'][s],
-              'AS_profiles': file['AS_profiles'][s],
-              'ARD': file['ARD'][s],
-              'ARU': file['ARU'][s],
-              'WRD': file['WRD'][s],
-              'WRU': file['WRU'][s],
-              'CER': file['CER'][s],
-              'time-step_h': file['time-step_h'][s],
-              'win_opt': file['win_opt'][s],
-              'win_actioned': file['win_actioned'][s],
-              'BESS': file['BESS'][s],
-              'SOC_min': file['SOC_min'][s],
-              'SOC_max': file['SOC_max'][s],
-              'DC_fudge': file['DC_fudge'][s],
-              'project_year_cap': file["project_year_cap"][s],
-              'day_prog': file['day_prog'][s],
-              'P_cap': file['P_cap'][s],
-              'verbose': file['verbose'][s],
-              'T': file['T_K'][s],
-              'EOL': file['EOL'][s],
-              'export_cap': file['export_cap'][s],
-              'days': 1, # Start a day tracker for calendar ageing calcs
-              'o_m_cost': file['o_m_cost'][s],
-              'may_maint': file['may_maint'][s], # Fix electrolyte maintenance to happen in May
-              'cap_init': file['cap_init'][s]  # This param allows us to nudge the maintenance of the VRFB around.
-              }
-    return s_dict
-
-def make_BESS_param_dict(s_dict, BESS_csv):
-    df = pd.read_csv(BESS_csv)
-    row = df['BESS'].tolist().index(s_dict['BESS'])  # Look up appropriate row for given BESS class
-    # Read in params that are BESS class agnostic (note, for RFB I units Am-2, otherwise A.unit-1)
-    BESS_dict = {'BESS_class': df['BESS_class'][row],
-                 'Eff_LP': df['Eff_LP'][row]}
-    BESS_dict['C_0'] = s_dict['P_inv_cont'] * s_dict['EtoP']
-    BESS_dict.update({'C': BESS_dict['C_0']*s_dict['cap_init']}) # Mutable capacity entry. Starting point alterable.
-    if BESS_dict['BESS_class'] == 'VRFB':
-        BESS_dict.update({'EDR': float(df['EDR'][row]),
-                          'CFR': float(df['CFR'][row])}) # If VRFB, read the electrolyte decay and capacity fade rates
-    BESS_dict['Q'] = 1  # Track charge throughput in EFC, init. with 1 to avoid problems with algebra on 0
-    return BESS_dict
-
-def parse_k_u_periods(file):
-    file = pd.read_csv(file)
-    # Make a dictionary that will serve as lookup table
-    k_u_dict = {(file['mm'][i],
-                 file['wk_wknd'][i],
-                 file['hh'][i]):
-                [file['k'][i], file['u'][i]]
-                for i in range(len(file['mm']))
-                }
-    return k_u_dict
-
-def parse_exog_variable_data(load_CSV, k_u_dict, w_csv, AS_csv, time_step):
-    """This function constructs two lists of exogenous variable data - one at 15 min (for load, and unit charges) and
-    one at hourly resolution for ancillary services"""
-    # 15 min res data
-    c = 3  # converts 5 min res load to 15 min - adjust if desired
-    load = pd.read_csv(load_CSV)['value'].tolist()
-    date = pd.read_csv(load_CSV)['local_time']
-    wholesale_energy = pd.read_csv(w_csv)['MW'] # This is the $/MWh price
-    # Make exogenous variable list of lists, with format
-    # [[[yyyy, mm, dd, hh, min, day_of_week], [day_of_week, load, k, u]] ... ]
-    exog_variable_l_o_l_t = []
-
-    for i in range(int(len(load)/c)):
-        ts = date[i*c]
-        min = int(ts[14:16])
-        hh = int(ts[11:13])
-        dd = int(ts[0:2])
-        mm = int(ts[3:5])
-        yyyy = int(ts[6:10])
-        day_of_week = datetime.datetime(yyyy, mm, dd).strftime("%A")  # Returns day of week
-        # Generate k and u using the k_u_dict
-        if day_of_week in ['Saturday', 'Sunday']:
-            k = k_u_dict[mm, 'wknd', hh][0]
-            u = k_u_dict[mm, 'wknd', hh][1]
-        else:
-            k = k_u_dict[mm, 'wk', hh][0]
-            u = k_u_dict[mm, 'wk', hh][1]
-        # Generate w by pulling out entries from w CSV, converting i from 15min index to 1h
-        w = wholesale_energy[int(i/4)] / 1000  # And convert price to $/kWh
-        exog_variable_l_o_l_t += [[[yyyy, mm, dd, hh, min], [day_of_week, (1/time_step)*sum(load[i * c: (i * c) + c]),
-                                                              k, u, w]]]
-    # 1 hour res data
-    spin_reserve = pd.read_csv(AS_csv)['SP_CLR_PRC']  # This is the $/MWh price
-    reg_down = pd.read_csv(AS_csv)['RD_CLR_PRC']  # This is the $/MWh price
-    reg_up = pd.read_csv(AS_csv)['RU_CLR_PRC']  # This is the $/MWh price
-    exog_variable_l_o_l_h = []
-    c = 12  # conversion factor 5 min to 1h - adjust if desired
-    for i in range(int(len(load)/c)):
-        ts = date[i*c]
-        hh = int(ts[11:13])
-        dd = int(ts[0:2])
-        mm = int(ts[3:5])
-        yyyy = int(ts[6:10])
-        day_of_week = datetime.datetime(yyyy, mm, dd).strftime("%A")  # Returns day of week
-        s = spin_reserve[i] / 1000  # Convert price to $/kWh
-        r_d = reg_down[i] / 1000
-        r_u =reg_up[i] / 1000
-        exog_variable_l_o_l_h += [[[yyyy, mm, dd, hh], [s, r_d, r_u]]]
-    return exog_variable_l_o_l_t, exog_variable_l_o_l_h
-
-
-def grab_month_exog(exog_variables_t, exog_variables_h, mm, year, time_step):
-    """This function grabs a month portion of exogenous data for use in the monthly optimsiation.
-    It also grabs a day from the following month to provide a buffer in case the optimsiaiton window is > 24h."""
-    m_of_load, m_of_k, m_of_u, m_of_w = [], [], [], []
-    peak_loads_m = {}  # For tracking peak loads in each sub_period (to be used later in revenue calculation)
-    peak_loads_buffer = {}  # Also need to catch k for buffer period falling in new month (avoid index error may > june)
-    for i in exog_variables_t:
-        load, k, u, w = i[1][1], i[1][2], i[1][3], i[1][4]
-        if i[0][0] == year and i[0][1] == mm:  # Current month test
-            m_of_load += [load]
-            m_of_k += [k]
-            m_of_u += [u]
-            m_of_w += [w]
-            if k in peak_loads_m.keys():
-                if load > peak_loads_m[k]:  # Is load higher than existing peak in this demand charge sub-period?
-                    peak_loads_m[k] = load  # If so overwrite record
-            else:
-                peak_loads_m.update({k: load})
-
-        elif i[0][0] == year and i[0][1] == mm + 1 and i[0][2] == 1:  # First day from following month
-            m_of_load += [load]
-            m_of_k += [k]
-            m_of_u += [u]
-            m_of_w += [w]
-            if k not in peak_loads_m.keys():
-                if k in peak_loads_buffer.keys():
-                    peak_loads_buffer[k] = load
-                else:
-                    peak_loads_buffer.update({k: load})
-    peak_loads_buffer.update(peak_loads_m)
-    # Special case for December where buffer day is taken from following year
-    if mm == 12:
-        for i in exog_variables_t:
-            if i[0][0] == year + 1 and i[0][1] == 1 and i[0][2] == 1:  # First day from next year
-                m_of_load += [load]
-                m_of_k += [k]
-                m_of_u += [u]
-                m_of_w += [w]
-    # Convert hourly AS clearing prices to timestep resolution by duplication
-    m_of_s, m_of_r_d, m_of_r_u = [], [], []
-    for i in exog_variables_h:
-        s, r_d, r_u = i[1][0], i[1][1], i[1][2]
-        if i[0][0] == year and i[0][1] == mm:
-            m_of_s += [s for i in range(int(1/time_step))]
-            m_of_r_d += [r_d for i in range(int(1/time_step))]
-            m_of_r_u += [r_u for i in range(int(1/time_step))]
-        elif i[0][0] ==year and i[0][1] == mm+1 and i[0][2] == 1:
-            m_of_s += [s, s, s, s]
-            m_of_r_d += [r_d for i in range(int(1/time_step))]
-            m_of_r_u += [r_u for i in range(int(1/time_step))]
-    # Special case for December where buffer day is taken from following year
-    if mm == 12:
-        for i in exog_variables_h:
-            s, r = i[1][0], i[1][1]
-            if i[0][0] == year + 1 and i[0][1] == 1 and i[0][2] == 1:  # First day from next year
-                m_of_s += [s for i in range(int(1 / time_step))]
-                m_of_r_d += [r_d for i in range(int(1 / time_step))]
-                m_of_r_u += [r_u for i in range(int(1 / time_step))]
-    return m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m, peak_loads_buffer
-
-def day_results(time_step, load, c_log, d_log, U, W):
-    """This function returns the relevant data from the optimal schedule for a given day, to be used in upper level
-    calculation of monthly revenue."""
-    # Make list of ACTUAL net load, i.e. incoming load_profile net of 'optimal' schedule based on historic load
-    T = range(int(len(load)))
-    net_load_profile = []
-    for t in T:
-        net_load_profile += [load[t] + c_log[t] - d_log[t]]
-    # Calculate daily avoided cost in U and W
-    ac_u_d = sum([(d_log[t] - c_log[t]) * U[t] * time_step for t in T])
-    ac_w_d = sum([(d_log[t] - c_log[t]) * W[t] * time_step for t in T])
-    # Calculate daily revenue from AS provision
-    return ac_u_d, ac_w_d, net_load_profile
-
-def parse_verbose(verbose_results, load, c_log, d_log, SOC_profile, demand_profile,
-                                         yyyy, mm, dd, k, u, w):
-    """This function builds an optional verbose output of BESS operation at the resoltuion of the model timestep."""
-    T = range(int(len(load)))
-    verbose_results['yyyy'] += [yyyy for t in T]
-    verbose_results['mm'] += [mm for t in T]
-    verbose_results['dd'] += [dd + 1 for t in T]  # =1 to match labels in python output
-    verbose_results['period'] += [t+1 for t in T]
-    verbose_results['k'] += [k[t] for t in T]
-    verbose_results['u'] += [u[t] for t in T]
-    verbose_results['w'] += [w[t] for t in T]
-    verbose_results['load'] += [load[t] for t in T]
-    verbose_results['P'] += [c_log[t] - d_log[t] for t in T]
-    verbose_results['net_load'] += [demand_profile[t] for t in T]
-    verbose_results['SOC'] += [SOC_profile[t] for t in T]
-    return verbose_results
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+# Importing libraries within function is not allowed so it is done here
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import pandas as pd  # CSV handling
+import numpy as np  # Array handling for the exogenous variable data
+import math
+import datetime  # For time stamping optimisation procs
+from v_7_profiling import stage
+
+"""Library of functions for parsing parameter and exogenous variable data and passing to the scenario_manager script"""
+
+def parse_k_u_periods(file):
+    file = pd.read_csv(file)
+    # Make a dictionary that will serve as lookup table
+    k_u_dict = {(file['mm'][i],
+                 file['wk_wknd'][i],
+                 file['hh'][i]):
+                [file['k'][i], file['u'][i]]
+                for i in range(len(file['mm']))
+                }
+    return k_u_dict
+
+def make_k_u_table(k_u_dict):
+    """This function converts the k_u_dict lookup table into an array indexed by [mm, weekend, hh], where the last axis
+    holds [k, u]. This lets charge periods be assigned to a whole timeseries in one array lookup."""
+    k_u_table = np.zeros((13, 2, 24, 2), dtype=int)  # Month index runs 1-12, so index 0 is left unused
+    for (mm, wk_wknd, hh), k_u in k_u_dict.items():
+        k_u_table[mm, int(wk_wknd == 'wknd'), hh] = k_u
+    return k_u_table
+
+def parse_timestamps(date):
+    """Slices the dd/mm/yyyy hh:mm local time strings of the load CSV into integer arrays in one pass."""
+    date = date.astype(str).str
+    return {'yyyy': date.slice(6, 10).astype(int).to_numpy(),
+            'mm': date.slice(3, 5).astype(int).to_numpy(),
+            'dd': date.slice(0, 2).astype(int).to_numpy(),
+            'hh': date.slice(11, 13).astype(int).to_numpy(),
+            'min': date.slice(14, 16).astype(int).to_numpy()}
+
+def parse_exog_variable_data(load_CSV, k_u_dict, w_csv, AS_csv, time_step, sites=None):
+    """This function constructs two dictionaries of exogenous variable arrays - one at time-step resolution (for load,
+    and unit charges) and one at hourly resolution for ancillary services. Timestamps are parsed once, resampling is
+    done by reshaping the 5 min data and k and u are assigned with an array lookup on (mm, weekend, hh).
+    The load is the CSV's value column, or for a fleet, the load columns named by sites, as a (sites, time-steps)
+    array."""
+    c = int(round(time_step * 12))  # converts 5 min res load to time-step res (3 for 15 min)
+    c_h = 12  # conversion factor 5 min to 1h
+    steps_per_h = int(round(1 / time_step))
+    load_data = pd.read_csv(load_CSV)
+    load = load_data['value' if sites is None else list(sites)].to_numpy(dtype=float).T  # Or (sites, 5 min rows)
+    stamps = parse_timestamps(load_data['local_time'])
+    # Weekend flag from the date at the start of each 5 min interval (Saturday = 5, Sunday = 6)
+    weekend = (pd.to_datetime(pd.DataFrame({'year': stamps['yyyy'], 'month': stamps['mm'], 'day': stamps['dd']}))
+               .dt.dayofweek.to_numpy() >= 5).astype(int)
+    k_u_table = make_k_u_table(k_u_dict)
+
+    # Time-step res data, format {'yyyy': [...], 'mm': [...], ..., 'load': [...], 'k': [...], 'u': [...], 'w': [...]}
+    n_rows = load.shape[-1]
+    n_t = int(n_rows / c)
+    rows_t = np.arange(n_t) * c  # First 5 min row of each time-step
+    exog_variables_t = {key: stamps[key][rows_t] for key in ['yyyy', 'mm', 'dd', 'hh', 'min']}
+    exog_variables_t['weekend'] = weekend[rows_t]
+    exog_variables_t['load'] = (1 / time_step) * load[..., :n_t * c].reshape(load.shape[:-1] + (n_t, c)).sum(axis=-1)
+    k_u = k_u_table[exog_variables_t['mm'], exog_variables_t['weekend'], exog_variables_t['hh']]
+    exog_variables_t['k'], exog_variables_t['u'] = k_u[:, 0], k_u[:, 1]
+    wholesale_energy = pd.read_csv(w_csv)['MW'].to_numpy(dtype=float)  # This is the $/MWh price
+    if len(wholesale_energy) < -(-n_t // steps_per_h):  # Prices are matched to the load by position
+        raise ValueError(w_csv + ' holds fewer hours than the load data in ' + load_CSV)
+    exog_variables_t['w'] = wholesale_energy[np.arange(n_t) // steps_per_h] / 1000  # And convert price to $/kWh
+
+    # 1 hour res data
+    n_h = int(n_rows / c_h)
+    rows_h = np.arange(n_h) * c_h
+    exog_variables_h = {key: stamps[key][rows_h] for key in ['yyyy', 'mm', 'dd', 'hh']}
+    AS_prices = pd.read_csv(AS_csv, usecols=['SP_CLR_PRC', 'RD_CLR_PRC', 'RU_CLR_PRC'])  # These are $/MWh prices
+    if len(AS_prices) < n_h:
+        raise ValueError(AS_csv + ' holds fewer hours than the load data in ' + load_CSV)
+    exog_variables_h['s'] = AS_prices['SP_CLR_PRC'].to_numpy(dtype=float)[:n_h] / 1000  # Convert price to $/kWh
+    exog_variables_h['r_d'] = AS_prices['RD_CLR_PRC'].to_numpy(dtype=float)[:n_h] / 1000
+    exog_variables_h['r_u'] = AS_prices['RU_CLR_PRC'].to_numpy(dtype=float)[:n_h] / 1000
+    return exog_variables_t, exog_variables_h
+
+
+def make_calendar_index(exog_variables_t, exog_variables_h, time_step):
+    """This function is run once per dataset. It expands the hourly AS clearing prices to time-step resolution, and
+    indexes the contiguous array offsets of each (yyyy, mm) so that grab_month_exog can return array views rather than
+    scanning the whole dataset. Look-ahead past the final month wraps round to the start of the data (see
+    v_7_scheduler.window_view)."""
+    steps_per_day = int(round(24 / time_step))
+    n_t = exog_variables_t['load'].shape[-1]
+    # Convert hourly AS clearing prices to timestep resolution by duplication (hourly rows align with 5 min rows * 12)
+    for key in ['s', 'r_d', 'r_u']:
+        exog_variables_t[key] = np.repeat(exog_variables_h[key], int(round(1 / time_step)))[:n_t]
+    # Find start and end offset of each month
+    month_key = exog_variables_t['yyyy'][:n_t] * 100 + exog_variables_t['mm'][:n_t]
+    starts = np.flatnonzero(np.diff(month_key, prepend=-1))
+    stops = np.append(starts[1:], n_t)
+    calendar = {'steps_per_day': steps_per_day, 'months': {}}
+    for start, stop in zip(starts, stops):
+        yyyy_mm = (int(exog_variables_t['yyyy'][start]), int(exog_variables_t['mm'][start]))
+        if yyyy_mm in calendar['months']:
+            raise ValueError('Exogenous data for ' + str(yyyy_mm) + ' is not contiguous')
+        calendar['months'][yyyy_mm] = (int(start), int(stop))
+    return exog_variables_t, calendar
+
+def compact_exog(exog_variables_t, float_dtype='float64'):
+    """Stores each exogenous series in the narrowest dtype that holds it, so that long multi-year datasets stay small
+    on disk and in memory: int8 for the calendar fields and charge periods (int16 for yyyy), and float_dtype (float64,
+    or float32 to halve the footprint of load and prices) for the rest. Integer narrowing is checked to be lossless."""
+    compact = {}
+    for key, values in exog_variables_t.items():
+        if np.issubdtype(values.dtype, np.integer):
+            compact[key] = values.astype(np.int16 if key == 'yyyy' else np.int8)
+            if not np.array_equal(compact[key], values):
+                raise ValueError('Exogenous series ' + key + ' does not fit in ' + str(compact[key].dtype))
+        else:
+            compact[key] = values.astype(float_dtype)
+    return compact
+
+def data_years(calendar):
+    """The years of a dataset that hold all 12 months, in order."""
+    months = calendar['months']
+    return [yyyy for yyyy in sorted({y for y, mm in months}) if all((yyyy, mm) in months for mm in range(1, 13))]
+
+def project_data_year(calendar, project_year):
+    """The year of data that project year project_year (first is 0) runs on: project year N runs on the N_th complete
+    year of the dataset, wrapping round to the first once they are used up, so a single year of data is replayed."""
+    years = data_years(calendar)
+    if not years:
+        raise ValueError('The exogenous data holds no complete calendar year')
+    return years[project_year % len(years)]
+
+def grab_month_exog(exog_variables_t, calendar, mm, year):
+    """This function grabs a month portion of exogenous data for use in the monthly optimsiation.
+    The portions returned are views of the arrays indexed by make_calendar_index. Optimisation windows that look ahead
+    into the following month are cut from the whole dataset by the scheduler (see v_7_scheduler)."""
+    start, stop = calendar['months'][year, mm]
+    grab = slice(start, stop)
+    t = exog_variables_t
+    m_of_load, m_of_k, m_of_u, m_of_w = t['load'][grab], t['k'][grab], t['u'][grab], t['w'][grab]
+    m_of_s, m_of_r_d, m_of_r_u = t['s'][grab], t['r_d'][grab], t['r_u'][grab]
+    # For tracking peak loads in each sub_period (to be used later in revenue calculation)
+    peak_loads_m = peak_loads_by_k(m_of_load, m_of_k)
+    return m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m
+
+def peak_loads_by_k(load, k):
+    """Returns a dict of the peak load in each demand charge sub-period, with keys in order of first appearance."""
+    if len(k) == 0:
+        return {}
+    k_set, first_seen = np.unique(k, return_index=True)
+    order = np.argsort(first_seen)
+    peaks = np.maximum.reduceat(load[np.argsort(k, kind='stable')], np.searchsorted(np.sort(k), k_set))
+    return {int(k_set[i]): peaks[i] for i in order}
+
+def init_peak_record(m_of_load, m_of_k, peak_loads_m, steps_per_day, excl_h=6, stat='mean', prior=None):
+    """Initial peak demand record for each sub-period k in peak_loads_m, from the month's load over the days of the
+    month excluding the first excl_h hours of each day, where demand is always low. stat
+    is 'mean', a percentile given as e.g. 'p90', or 'prior', which carries over the previous month's record (prior),
+    capped at this month's peak load, and falls back to the mean for sub-periods without one. Sub-periods with no load
+    in the window (e.g. k_2, k_3, when a month starts on a weekend) are left out of the record."""
+    n_days = len(m_of_load) // steps_per_day
+    excl = int(round(excl_h * steps_per_day / 24))
+    load = np.asarray(m_of_load[:n_days * steps_per_day]).reshape(n_days, steps_per_day)[:, excl:]
+    k = np.asarray(m_of_k[:n_days * steps_per_day]).reshape(n_days, steps_per_day)[:, excl:]
+    stat = str(stat).lower()
+    peak_demands_record = {}
+    for k_i in peak_loads_m:
+        if stat == 'prior' and prior is not None and k_i in prior:
+            peak_demands_record[k_i] = min(prior[k_i], peak_loads_m[k_i])
+            continue
+        load_in_k = load[k == k_i]  # Day by day, in time order
+        if len(load_in_k) == 0:
+            continue
+        if stat.startswith('p') and stat != 'prior':
+            peak_demands_record[k_i] = np.percentile(load_in_k, float(stat[1:]))
+        else:  # Mean, summed in time order so it matches a Python sum over the same values
+            peak_demands_record[k_i] = np.cumsum(load_in_k)[-1] / len(load_in_k)
+    return peak_demands_record
+
+def load_exog_dataset(params, profile=None, sites=None):
+    """Parses the tariff and exogenous variable files named in a scenario's ScenarioParams and indexes them by month.
+    Scenarios with the same dataset_key can share the returned dict, which is only read from during a scenario run.
+    For a fleet, sites names the load columns of the fleet load CSV (see parse_exog_variable_data)."""
+    with stage(profile, 'csv_parse'):
+        k_u_dict = parse_k_u_periods(params.tariff_key)  # Get DNO charge periods w.r.t time in dictionary form.
+        exog_variables_t, exog_variables_h = \
+            parse_exog_variable_data(params.load_profile, k_u_dict, params.wholesale_profile,
+                                     params.AS_profiles, params.time_step_h, sites)
+        tariff = pd.read_csv(params.tariff_prices)  # Get actual prices for DNO tariff
+    with stage(profile, 'exog_construction'):
+        exog_variables_t, calendar = make_calendar_index(exog_variables_t, exog_variables_h, params.time_step_h)
+        exog_variables_t = compact_exog(exog_variables_t, params.exog_dtype)
+        u_periods, u_prices, k_periods, k_prices = \
+            tariff['u_period'], tariff['u_price'], tariff['k_period'], tariff['k_price']
+        k_charges = {}
+        for i in range(len(k_periods)):
+            if k_periods[i] == k_periods[i]:  # This test skips any Nan entries
+                k_charges[i+1] = k_prices[i]
+        u_charges = {u_periods[i]: u_prices[i] for i in range(len(u_periods))}  # populate u charge dict from csv
+    return {'exog_variables_t': exog_variables_t, 'calendar': calendar, 'k_charges': k_charges,
+            'u_charges': u_charges}
+
+def dataset_key(params):
+    """Identifies the inputs that load_exog_dataset depends on, including the dtype the series are stored in."""
+    return (params.tariff_key, params.tariff_prices, params.load_profile, params.wholesale_profile,
+            params.AS_profiles, params.time_step_h, params.exog_dtype)
+
+def year_converged(results_s_m, n_months, tol):
+    """Tests whether the final simulated year repeats the previous one, i.e. whether the capacity trajectory and monthly
+    AC_K, AC_U and AC_W are all within a relative tolerance of the previous year's. Returns the test result and the
+    largest relative difference found."""
+    if len(results_s_m['year']) < 2 * n_months:
+        return False, float('inf')
+    max_rel_diff = 0
+    for key in ['Cap_frac', 'AC_K', 'AC_U', 'AC_W']:
+        this_year = np.array(results_s_m[key][-n_months:], dtype=float)
+        last_year = np.array(results_s_m[key][-2 * n_months:-n_months], dtype=float)
+        scale = max(np.abs(last_year).max(), 1e-12)
+        max_rel_diff = max(max_rel_diff, np.abs(this_year - last_year).max() / scale)
+    return max_rel_diff <= tol, max_rel_diff
+
+def extrapolate_years(results_s_m, results_s_y, n_years, n_months):
+    """Fast-forward for steady-state degradation. Appends n_years copies of the final simulated year to the monthly
+    and annual results. The error bound on each extrapolated year's total (AC_K + AC_U + AC_W + rebalance_cost) assumes
+    the year-on-year change seen between the last two simulated years keeps accumulating."""
+    last_m = {key: results_s_m[key][-n_months:] for key in results_s_m}
+    last_y, prev_y = results_s_y[-1], results_s_y[-2]
+    drift = sum(abs(last_y[i] - prev_y[i]) for i in range(1, 5))
+    for j in range(1, n_years + 1):
+        for key in results_s_m:
+            results_s_m[key] += last_m[key] if key != 'year' else [last_y[0] + j] * n_months
+        results_s_y += [[last_y[0] + j] + last_y[1:5] + [1, j * drift]]
+    return results_s_m, results_s_y
+
+def charge_table(charges):
+    """Converts a {period: price} dict of tariff charges to an array indexed by period, so prices can be looked up for
+    a whole array of periods at once."""
+    table = np.full(max(charges) + 1, np.nan)  # Periods missing from the tariff are NaN
+    for period, price in charges.items():
+        table[period] = price
+    return table
+
+def sequential_sum(values, axis=-1):
+    """Sums along an axis in index order, i.e. with the same rounding as a Python sum() loop (np.sum sums pairwise)."""
+    values = np.asarray(values, dtype=float)
+    if values.shape[axis] == 0:
+        return np.sum(values, axis=axis)
+    return np.take(np.cumsum(values, axis=axis), -1, axis=axis)
+
+def month_results(time_step, load, c_log, d_log, U, W):
+    """Month-level version of the baseline day_results (see v_7_legacy_reference), where each argument is an array of
+    shape (days, time-steps in window) that holds the committed windows of the month. Returns the month's AC_U and
+    AC_W, and the net load for each window, with results identical to summing day_results over the month."""
+    net_load = load + c_log - d_log
+    discharge = d_log - c_log
+    ac_u_m = sequential_sum(sequential_sum(discharge * U * time_step))  # Daily sums, then summed over the month
+    ac_w_m = sequential_sum(sequential_sum(discharge * W * time_step))
+    return ac_u_m, ac_w_m, net_load
+
+def month_AC_K(k_charges, peak_loads_m, peak_demands_record):
+    """Avoided demand charges for the month: the charge for each sub-period times the reduction in its peak demand."""
+    ks = list(peak_loads_m)
+    if len(ks) == 0:
+        return 0
+    k_price = np.array([k_charges[k] for k in ks])
+    return sequential_sum(k_price * (np.array([peak_loads_m[k] for k in ks]) -
+                                     np.array([peak_demands_record[k] for k in ks])))
@@ -0,0 +1,90 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import contextlib
+import cProfile
+import json
+import time
+import tracemalloc
+import pandas as pd  # CSV handling
+
+"""Per-stage timing for the scenario pipeline. A profile is a plain dict that records wall time and call counts for
+each (stage, project year, month). Stage timing is cheap enough to leave on for every run; cProfile and tracemalloc
+capture are switched on from the 'profile' scenario column ('cprofile', 'tracemalloc' or 'both')."""
+
+
+def make_profile(mode=None):
+    """Returns an empty profile. mode selects optional cProfile and/or tracemalloc capture."""
+    mode = str(mode).lower() if mode == mode and mode is not None else 'none'  # NaN (blank CSV cell) means none
+    return {'stages': {}, 'mode': mode, 'year': None, 'mm': None,
+            'cprofile': cProfile.Profile() if mode in ['cprofile', 'both'] else None,
+            'tracemalloc': mode in ['tracemalloc', 'both'], 'peak_memory_B': None}
+
+
+@contextlib.contextmanager
+def stage(profile, name):
+    """Times the enclosed block and adds it to the profile under the current project year and month. Does nothing if
+    profile is None."""
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = profile['stages'].setdefault((name, profile['year'], profile['mm']), [0, 0.0])
+        record[0] += 1
+        record[1] += time.perf_counter() - start
+
+
+def set_period(profile, year=None, mm=None):
+    """Sets the project year and month that following stages are recorded under."""
+    if profile is not None:
+        profile['year'], profile['mm'] = year, mm
+
+
+def start_profile(profile):
+    if profile is None:
+        return
+    if profile['tracemalloc']:
+        tracemalloc.start()
+    if profile['cprofile'] is not None:
+        profile['cprofile'].enable()
+
+
+def stop_profile(profile):
+    if profile is None:
+        return
+    if profile['cprofile'] is not None:
+        profile['cprofile'].disable()
+    if profile['tracemalloc']:
+        profile['peak_memory_B'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+
+def profile_table(profile):
+    """Returns the stage records as a DataFrame with one row per (stage, year, mm)."""
+    return pd.DataFrame([[name, year, mm, calls, wall_s] for (name, year, mm), (calls, wall_s)
+                         in profile['stages'].items()], columns=['stage', 'year', 'mm', 'calls', 'wall_s'])\
+        .astype({'year': 'Int64', 'mm': 'Int64'})  # Dataset stages have no year or month
+
+
+def write_profile(profile, scenario, run_time=None):
+    """Writes the profile alongside the scenario results: a CSV with the per-month breakdown, a JSON summary with
+    per-stage totals, and the raw cProfile stats (readable with pstats) if captured."""
+    if profile is None:
+        return
+    table = profile_table(profile)
+    prefix = "scenario_" + str(scenario) + "_profile"
+    table.to_csv(prefix + ".csv", index=False)
+    totals = table.groupby('stage', sort=False)[['calls', 'wall_s']].sum()
+    summary = {'scenario': str(scenario), 'run_time_s': run_time, 'mode': profile['mode'],
+               'peak_memory_B': profile['peak_memory_B'],
+               'stages': {name: {'calls': int(row['calls']), 'wall_s': float(row['wall_s'])}
+                          for name, row in totals.iterrows()}}
+    with open(prefix + ".json", 'w') as f:
+        json.dump(summary, f, indent=1)
+    if profile['cprofile'] is not None:
+        profile['cprofile'].dump_stats(prefix + ".pstats")
@@ -0,0 +1,563 @@
+﻿# coding: utf-8
+"""Golden-output regression harness for the performance rewrites. 'record' runs the reference implementations on fixed
+inputs and writes their outputs to a golden file: exogenous arrays from parse_exog_variable_data and grab_month_exog,
+dispatch logs of opt_peak_shave_rules_ASAP, VRFB_elec_decay capacity trajectories, rainflow half and whole cycles, and
+the monthly results (AC_K, AC_U, AC_W, Cap_frac, ...) of the scenario loop. 'check' regenerates the same inputs, runs
+the reference and every faster path of each case (the array parser and month slicer, the fast, batch and fleet dispatch,
+the daily, month level and fleet decay, the batch and streaming rainflow counters, run_scenario and run_batch, the
+dataset cache), compares their outputs with the golden file within rtol/atol, and reports their wall times side by side.
+A new engine is checked by registering it as a path of a case, from code with register_path or from the command line
+with --path case=module:function.
+The reference of every case is the baseline implementation frozen in v_7_legacy_reference, with its outputs put in the
+array form of the rewrites, so the golden file holds the baseline behaviour whichever version records it. The baseline
+scenario loop runs a single project year and has no Li-ion ageing, so the monthly case covers one year of the VRFB input
+sets.
+The inputs are synthetic (v_7_benchmark generators, fixed seed) VRFB and Li-ion scenarios, and the synthetic load
+against the bundled LMP and AS price files.
+Usage: python v_7_regression.py record [--months 12] [--seed 0] [--out v_7_regression_golden.npz]
+       python v_7_regression.py check [--golden v_7_regression_golden.npz] [--rtol 1e-9] [--atol 1e-9]
+                                      [--tol case=rtol,atol] [--repeat 2] [--case dispatch] [--path case=module:func]"""
+
+### Import required tools ###
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import argparse
+import contextlib
+import copy
+import importlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd                 # CSV handling
+from v_7_benchmark import REPO_DIR, make_synthetic_scenario
+from v_7_config import make_bess_params, make_sim_state, legacy_dicts
+from v_7_param_functions import parse_k_u_periods, load_exog_dataset, grab_month_exog, peak_loads_by_k, \
+    init_peak_record
+from v_7_algorithms import opt_peak_shave_rules_ASAP_fast, make_batch_dict, opt_peak_shave_rules_ASAP_batch, \
+    peak_record_to_array
+from v_7_deg_functions import VRFB_elec_decay, VRFB_elec_decay_month, VRFB_elec_decay_fleet
+from v_7_data_cache import save_dataset, load_dataset
+from v_7_scheduler import window_view
+from v_7_fleet import records_to_array, array_to_record, fleet_dispatch_window, run_batch
+from v_7_scenario_manager import run_scenario
+from SH_cycle_counting_by_rainflow import find_pkvl_and_idle, rfc_find_cycles, rfc_stream_init, rfc_stream_update, \
+    rfc_stream_residual
+import v_7_legacy_reference as legacy  # The baseline implementations, the reference paths of the cases
+
+GOLDEN = 'v_7_regression_golden.npz'
+INPUT_SETS = {'synthetic': {},  # Overrides of the synthetic scenario (see make_synthetic_scenario)
+              'bundled_prices': {'wholesale_profile':
+                                 os.path.join(REPO_DIR, 'LMP_node_HARBORG_7_N101_2019_treated.csv'),
+                                 'AS_profiles': os.path.join(REPO_DIR, 'AS_CAISO_EXP_2019_treated.csv')},
+              'li_ion': {'BESS': 'Schma2014'}}
+EXOG_KEYS = ['load', 'k', 'u', 'w', 's', 'r_d', 'r_u']
+MONTHLY_KEYS = ['AC_K', 'AC_U', 'AC_W', 'Cap_frac', 'Q', 'o_m', 'rebalance_cost']
+PROJECT_YEARS = 1  # Of the monthly results case, as the baseline scenario loop fails on a second project year
+
+
+##########
+# Inputs #
+##########
+def make_context(work_dir, name, months, seed):
+    """The scenario, BESS and dataset of an input set, written to work_dir. The reference dispatch SOC, which the
+    decay and rainflow cases count, is added on first use (see reference_soc)."""
+    params = make_synthetic_scenario(work_dir, months, seed, project_year_cap=PROJECT_YEARS, **INPUT_SETS[name])
+    bess = make_bess_params(params, os.path.join(work_dir, 'v_7_BESS_params.csv'))
+    return {'name': name, 'dir': work_dir, 'params': params, 'bess': bess, 'dataset': load_exog_dataset(params)}
+
+
+def month_days(ctx):
+    """(mm, offsets of the month's days) for every month of the dataset, in order."""
+    calendar = ctx['dataset']['calendar']
+    steps_per_day = calendar['steps_per_day']
+    for (yyyy, mm), (start, stop) in sorted(calendar['months'].items()):
+        yield mm, np.arange(start, stop - steps_per_day + 1, steps_per_day)
+
+
+def reference_soc(ctx):
+    if 'soc' not in ctx:
+        ctx['soc'] = dispatch_reference(ctx)['soc']
+    return ctx['soc']
+
+
+def legacy_exog(ctx):
+    """The time-step and hourly lists of the baseline parser, parsed on first use like the reference SOC, so the
+    month_slice reference is timed without the parse."""
+    if 'legacy_exog' not in ctx:
+        params = ctx['params']
+        ctx['legacy_exog'] = legacy.parse_exog_variable_data(params.load_profile,
+                                                             legacy.parse_k_u_periods(params.tariff_key),
+                                                             params.wholesale_profile, params.AS_profiles,
+                                                             params.time_step_h)
+    return ctx['legacy_exog']
+
+
+##############################
+# Cases: reference and paths #
+##############################
+def exog_outputs(dataset):
+    """The time-step arrays and month offsets of a dataset."""
+    outputs = {key: np.asarray(dataset['exog_variables_t'][key]) for key in EXOG_KEYS}
+    outputs['months'] = np.array([[yyyy, mm, start, stop] for (yyyy, mm), (start, stop)
+                                  in sorted(dataset['calendar']['months'].items())])
+    return outputs
+
+
+def parse_reference(ctx):
+    """The baseline parser's lists in the form of exog_outputs: hourly AS prices repeated to time-step resolution, as
+    the baseline grab_month_exog did, and months at the offsets where (yyyy, mm) changes."""
+    params = ctx['params']
+    exog_variables_t, exog_variables_h = legacy.parse_exog_variable_data(params.load_profile,
+                                                                         legacy.parse_k_u_periods(params.tariff_key),
+                                                                         params.wholesale_profile, params.AS_profiles,
+                                                                         params.time_step_h)
+    outputs = {key: np.array([row[1][i] for row in exog_variables_t]) for i, key in enumerate(EXOG_KEYS[:4], 1)}
+    for i, key in enumerate(EXOG_KEYS[4:]):
+        outputs[key] = np.repeat([row[1][i] for row in exog_variables_h],
+                                 int(1 / params.time_step_h))[:len(exog_variables_t)]
+    months = [row[0][:2] for row in exog_variables_t]
+    starts = [t for t in range(len(months)) if t == 0 or months[t] != months[t - 1]]
+    outputs['months'] = np.array(sorted([months[start] + [start, stop]
+                                         for start, stop in zip(starts, starts[1:] + [len(months)])]))
+    return outputs
+
+
+def parse_arrays(ctx):
+    """The array parser and calendar index of load_exog_dataset."""
+    return exog_outputs(load_exog_dataset(ctx['params']))
+
+
+def parse_cache(ctx):
+    """The dataset after a round trip through the memory-mapped cache."""
+    path = os.path.join(ctx['dir'], 'regression_cache')
+    if not os.path.isdir(path):
+        save_dataset(ctx['dataset'], path)
+    return exog_outputs(load_dataset(path))
+
+
+def month_outputs(months):
+    """Concatenates the month slices [(exog arrays, peak_loads_m)] into one array per series."""
+    outputs = {key: np.concatenate([month[0][i] for month in months]) for i, key in enumerate(EXOG_KEYS)}
+    outputs['peak_k'] = np.concatenate([list(month[1].keys()) for month in months])
+    outputs['peak_load'] = np.concatenate([list(month[1].values()) for month in months])
+    return outputs
+
+
+def month_slice_reference(ctx):
+    """The baseline grab_month_exog, whose series run on into the first day of the following month (the buffer day of
+    its day-ahead windows). They are cut back to the month."""
+    exog_variables_t, exog_variables_h = legacy_exog(ctx)
+    n_steps = {}
+    for row in exog_variables_t:
+        n_steps[row[0][0], row[0][1]] = n_steps.get((row[0][0], row[0][1]), 0) + 1
+    months = []
+    for yyyy, mm in sorted(n_steps):
+        month = legacy.grab_month_exog(exog_variables_t, exog_variables_h, mm, yyyy, ctx['params'].time_step_h)
+        months.append(([np.array(series[:n_steps[yyyy, mm]]) for series in month[:7]], month[7]))
+    return month_outputs(months)
+
+
+def month_slice_calendar(ctx):
+    """Month views from grab_month_exog and the calendar index."""
+    exog_variables_t, calendar = ctx['dataset']['exog_variables_t'], ctx['dataset']['calendar']
+    months = []
+    for yyyy, mm in sorted(calendar['months']):
+        month = grab_month_exog(exog_variables_t, calendar, mm, yyyy)
+        months.append((month[:7], month[7]))
+    return month_outputs(months)
+
+
+def month_slice_window(ctx):
+    """Months cut by the scheduler's window_view."""
+    exog_variables_t, calendar = ctx['dataset']['exog_variables_t'], ctx['dataset']['calendar']
+    months = []
+    for start, stop in [calendar['months'][key] for key in sorted(calendar['months'])]:
+        window = window_view({key: exog_variables_t[key] for key in EXOG_KEYS}, start, stop - start)
+        months.append(([window[key] for key in EXOG_KEYS], peak_loads_by_k(window['load'], window['k'])))
+    return month_outputs(months)
+
+
+def dispatch_days(ctx, engine):
+    """Chains a day-ahead dispatch engine, engine(load, K, peak_demands_m, SOC_0) -> (c, d, SOC, peak_demands_m),
+    through every day of the dataset, from each month's initial peak record. Returns the logs and month-end records."""
+    exog_variables_t, calendar = ctx['dataset']['exog_variables_t'], ctx['dataset']['calendar']
+    params, steps_per_day = ctx['params'], calendar['steps_per_day']
+    soc_0 = make_sim_state(params, ctx['bess']).SOC_0
+    logs, records = {'c': [], 'd': [], 'soc': []}, []
+    for yyyy, mm in sorted(calendar['months']):
+        m_of_load, m_of_k = grab_month_exog(exog_variables_t, calendar, mm, yyyy)[:2]
+        record = init_peak_record(m_of_load, m_of_k, peak_loads_by_k(m_of_load, m_of_k), steps_per_day,
+                                  params.peak_init_excl_h, params.peak_init_stat)
+        for day in range(len(m_of_load) // steps_per_day):
+            day = slice(day * steps_per_day, (day + 1) * steps_per_day)
+            c_log, d_log, soc_log, record = engine(m_of_load[day], m_of_k[day], record, soc_0)
+            for key, log in zip(['c', 'd', 'soc'], [c_log, d_log, soc_log]):
+                logs[key].append(np.asarray(log, dtype=float))
+            soc_0 = float(soc_log[-1])
+        records.append([record[k] for k in sorted(record)])
+    outputs = {key: np.concatenate(log) for key, log in logs.items()}
+    outputs['peak'] = np.concatenate(records)
+    return outputs
+
+
+def dispatch_reference(ctx):
+    s_dict, BESS_dict = legacy_dicts(ctx['params'], ctx['bess'], make_sim_state(ctx['params'], ctx['bess']))
+
+    def engine(load, K, record, soc_0):
+        s_dict['SOC_0'] = soc_0
+        return legacy.opt_peak_shave_rules_ASAP(s_dict, BESS_dict, list(load), list(K), record)
+    return dispatch_days(ctx, engine)
+
+
+def dispatch_fast(ctx):
+    state = make_sim_state(ctx['params'], ctx['bess'])
+
+    def engine(load, K, record, soc_0):
+        state.SOC_0 = soc_0
+        return opt_peak_shave_rules_ASAP_fast(ctx['params'], ctx['bess'], state, load, K, record)
+    return dispatch_days(ctx, engine)
+
+
+def dispatch_batch(ctx):
+    state = make_sim_state(ctx['params'], ctx['bess'])
+
+    def engine(load, K, record, soc_0):
+        state.SOC_0 = soc_0
+        batch_dict = make_batch_dict([ctx['params']], [ctx['bess']], [state])
+        c_log, d_log, soc_log, peak = opt_peak_shave_rules_ASAP_batch(batch_dict, load, K,
+                                                                      peak_record_to_array(record, K)[None, :])
+        return c_log[0], d_log[0], soc_log[0], {k: peak[0, k] for k in record}
+    return dispatch_days(ctx, engine)
+
+
+def dispatch_fleet(ctx):
+    """A fleet of one site, dispatched by fleet_dispatch_window with the whole window committed."""
+    state = make_sim_state(ctx['params'], ctx['bess'])
+    n_k = int(np.max(ctx['dataset']['exog_variables_t']['k'])) + 1
+
+    def engine(load, K, record, soc_0):
+        state.SOC_0 = soc_0
+        batch_dict = make_batch_dict([ctx['params']], [ctx['bess']], [state])
+        c_log, d_log, soc_log, peak = fleet_dispatch_window(batch_dict, {'load': np.asarray(load)[None, :], 'k': K},
+                                                            len(K), records_to_array([record], n_k))
+        return c_log[0], d_log[0], soc_log[0], array_to_record(peak[0])
+    return dispatch_days(ctx, engine)
+
+
+def decay_reference(ctx):
+    """The baseline VRFB_elec_decay day by day over the reference dispatch SOC: each day's throughput and O&M cost,
+    and the capacity and cumulative throughput at the end of each month. Its progress prints are discarded."""
+    soc, steps_per_day = reference_soc(ctx), ctx['dataset']['calendar']['steps_per_day']
+    s_dict, BESS_dict = legacy_dicts(ctx['params'], ctx['bess'], make_sim_state(ctx['params'], ctx['bess']))
+    outputs = {'q': [], 'o_m': [], 'C': [], 'Q': []}
+    day_n = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mm, days in month_days(ctx):
+            for d in range(len(days)):
+                SOC_profile = soc[day_n * steps_per_day:(day_n + 1) * steps_per_day]
+                o_m, q = legacy.VRFB_elec_decay(mm, d, s_dict, BESS_dict, SOC_profile)
+                s_dict['SOC_0'] = SOC_profile[-1]
+                outputs['q'].append(q)
+                outputs['o_m'].append(o_m)
+                day_n += 1
+            outputs['C'].append(BESS_dict['C'])
+            outputs['Q'].append(BESS_dict['Q'])
+    return {key: np.array(values, dtype=float) for key, values in outputs.items()}
+
+
+def decay_daily(ctx):
+    """VRFB_elec_decay, a day at a time."""
+    soc, steps_per_day = reference_soc(ctx), ctx['dataset']['calendar']['steps_per_day']
+    state = make_sim_state(ctx['params'], ctx['bess'])
+    outputs = {'q': [], 'o_m': [], 'C': [], 'Q': []}
+    day_n = 0
+    for mm, days in month_days(ctx):
+        for d in range(len(days)):
+            SOC_profile = soc[day_n * steps_per_day:(day_n + 1) * steps_per_day]
+            o_m, q = VRFB_elec_decay(mm, [d], ctx['params'], ctx['bess'], state, SOC_profile)
+            state.SOC_0 = SOC_profile[-1]
+            outputs['q'].append(q)
+            outputs['o_m'].append(o_m)
+            day_n += 1
+        outputs['C'].append(state.C)
+        outputs['Q'].append(state.Q)
+    return {key: np.array(values, dtype=float) for key, values in outputs.items()}
+
+
+def decay_month(ctx):
+    """VRFB_elec_decay_month, a month of days at once."""
+    soc, steps_per_day = reference_soc(ctx), ctx['dataset']['calendar']['steps_per_day']
+    state = make_sim_state(ctx['params'], ctx['bess'])
+    outputs = {'q': [], 'o_m': [], 'C': [], 'Q': []}
+    day_n = 0
+    for mm, days in month_days(ctx):
+        SOC_profiles = soc[day_n * steps_per_day:(day_n + len(days)) * steps_per_day].reshape(len(days), -1)
+        o_m, q = VRFB_elec_decay_month(mm, ctx['params'], ctx['bess'], state, SOC_profiles)
+        state.SOC_0 = SOC_profiles[-1, -1]
+        outputs['q'].extend(q)
+        outputs['o_m'].extend(o_m)
+        outputs['C'].append(state.C)
+        outputs['Q'].append(state.Q)
+        day_n += len(days)
+    return {key: np.array(values, dtype=float) for key, values in outputs.items()}
+
+
+def decay_fleet(ctx):
+    """VRFB_elec_decay_fleet for a fleet of one site, day by day."""
+    soc, steps_per_day = reference_soc(ctx), ctx['dataset']['calendar']['steps_per_day']
+    state = make_sim_state(ctx['params'], ctx['bess'])
+    outputs = {'q': [], 'o_m': [], 'C': [], 'Q': []}
+    day_n = 0
+    for mm, days in month_days(ctx):
+        for d in range(len(days)):
+            SOC_profile = soc[day_n * steps_per_day:(day_n + 1) * steps_per_day]
+            o_m, q = VRFB_elec_decay_fleet(mm, [d], [ctx['params']], [ctx['bess']], [state], SOC_profile[None, :])
+            state.SOC_0 = SOC_profile[-1]
+            outputs['q'].append(q[0])
+            outputs['o_m'].append(o_m[0])
+            day_n += 1
+        outputs['C'].append(state.C)
+        outputs['Q'].append(state.Q)
+    return {key: np.array(values, dtype=float) for key, values in outputs.items()}
+
+
+def rainflow_reference(ctx):
+    hc, wc = legacy.rfc_find_cycles(legacy.find_pkvl_and_idle(reference_soc(ctx)))
+    return {'hc': hc, 'wc': wc}
+
+
+def rainflow_batch(ctx):
+    """The vectorised peak and valley search and preallocated counter, over the whole SOC history at once."""
+    hc, wc = rfc_find_cycles(find_pkvl_and_idle(reference_soc(ctx)))
+    return {'hc': hc, 'wc': wc}
+
+
+def rainflow_stream(ctx):
+    """The streaming counter fed a day at a time, with the cycles it counts at the end."""
+    soc, steps_per_day = reference_soc(ctx), ctx['dataset']['calendar']['steps_per_day']
+    rfc = rfc_stream_init()
+    hc, wc = [], []
+    for d in range(0, len(soc), steps_per_day):
+        hc_d, wc_d = rfc_stream_update(rfc, soc[d:d + steps_per_day])
+        hc.append(hc_d)
+        wc.append(wc_d)
+    hc_end, wc_end = rfc_stream_residual(rfc)
+    hc.append(hc_end)
+    wc.append(wc_end)
+    return {'hc': np.concatenate(hc, axis=1), 'wc': np.concatenate(wc, axis=1)}
+
+
+def monthly_reference(ctx):
+    """Monthly results of the baseline scenario loop. Its grab_month_exog needs the first day of the next year as
+    December's buffer day, so the data year is followed by its first day again, as the rewrite's windows wrap round
+    to the start of the data. Its progress prints are discarded."""
+    exog_variables_t, exog_variables_h = legacy_exog(ctx)
+    yyyy, steps_per_day = exog_variables_t[0][0][0], ctx['dataset']['calendar']['steps_per_day']
+    exog_variables_t = exog_variables_t + [[[yyyy + 1, 1, 1] + row[0][3:], row[1]]
+                                           for row in exog_variables_t[:steps_per_day]]
+    exog_variables_h = exog_variables_h + [[[yyyy + 1, 1, 1] + row[0][3:], row[1]] for row in exog_variables_h[:24]]
+    s_dict = legacy_dicts(ctx['params'], ctx['bess'], make_sim_state(ctx['params'], ctx['bess']))[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        monthly = legacy.run_scenario(s_dict, exog_variables_t, exog_variables_h, yyyy)
+    return {key: monthly[key].to_numpy(dtype=float) for key in MONTHLY_KEYS}
+
+
+def monthly_scenario(ctx):
+    """Monthly results of run_scenario, as written to its results file."""
+    run_scenario(ctx['params'], ctx['dataset'])
+    monthly = pd.read_csv('scenario_' + str(ctx['params'].scenario) + '_monthly_results.csv')
+    return {key: monthly[key].to_numpy(dtype=float) for key in MONTHLY_KEYS}
+
+
+def monthly_batch(ctx):
+    """Monthly results of run_batch for a batch of one."""
+    monthly = pd.DataFrame(run_batch([ctx['params']], ctx['dataset'])[0])
+    return {key: monthly[key].to_numpy(dtype=float) for key in MONTHLY_KEYS}
+
+
+# {case: {path: function(ctx) -> {name: array}}}; the first path of each case is the reference implementation
+CASES = {'parse': {'reference': parse_reference, 'arrays': parse_arrays, 'cache': parse_cache},
+         'month_slice': {'reference': month_slice_reference, 'calendar': month_slice_calendar,
+                         'window_view': month_slice_window},
+         'dispatch': {'reference': dispatch_reference, 'fast': dispatch_fast, 'batch': dispatch_batch,
+                      'fleet': dispatch_fleet},
+         'decay': {'reference': decay_reference, 'daily': decay_daily, 'month': decay_month, 'fleet': decay_fleet},
+         'rainflow': {'reference': rainflow_reference, 'batch': rainflow_batch, 'stream': rainflow_stream},
+         'monthly': {'reference': monthly_reference, 'scenario': monthly_scenario, 'batch': monthly_batch}}
+VRFB_CASES = ['decay', 'monthly']  # Cases that only apply to VRFB input sets (the baseline has no Li-ion ageing)
+
+
+def register_path(case, name, func):
+    """Adds a path (e.g. a new engine) to a case, to be checked against its golden outputs."""
+    if case not in CASES:
+        raise ValueError('No regression case ' + case + ', expected one of ' + ', '.join(CASES))
+    CASES[case][name] = func
+
+
+def applies(case, ctx):
+    return case not in VRFB_CASES or ctx['bess'].BESS_class == 'VRFB'
+
+
+###########################
+# Recording and checking #
+###########################
+def timed(func, ctx, repeat=1):
+    """Returns the best wall time of repeat calls of func(ctx), and the outputs of the last call. Each call gets its
+    own copy of the context, so paths cannot change each other's inputs, and runs in the input set's directory."""
+    os.chdir(ctx['dir'])
+    times = []
+    for _ in range(repeat):
+        ctx_i = copy.copy(ctx)
+        start = time.perf_counter()
+        outputs = func(ctx_i)
+        times.append(time.perf_counter() - start)
+        ctx.update({key: ctx_i[key] for key in ['soc', 'legacy_exog'] if key in ctx_i})  # Computed once, then shared
+    return min(times), outputs
+
+
+def with_contexts(months, seed, func):
+    """Runs func(contexts) in a temporary working directory holding the input sets' files."""
+    work_dir = tempfile.mkdtemp(prefix='v_7_regression_')
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        contexts = []
+        for name in INPUT_SETS:
+            os.makedirs(os.path.join(work_dir, name))
+            contexts.append(make_context(os.path.join(work_dir, name), name, months, seed))
+        return func(contexts)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def record(path=GOLDEN, months=12, seed=0):
+    """Runs the reference path of every case on every input set and writes the outputs to the golden file."""
+    def record_contexts(contexts):
+        golden = {}
+        for ctx in contexts:
+            for case, paths in CASES.items():
+                if not applies(case, ctx):
+                    continue
+                wall_s, outputs = timed(paths['reference'], ctx)
+                for key, values in outputs.items():
+                    golden[ctx['name'] + '/' + case + '/' + key] = np.asarray(values)
+                print("%-16s %-12s %10.4f s" % (ctx['name'], case, wall_s))
+        return golden
+    golden = with_contexts(months, seed, record_contexts)
+    meta = {'months': months, 'seed': seed, 'numpy': np.__version__, 'pandas': pd.__version__,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    np.savez_compressed(path, __meta__=np.array(json.dumps(meta)), **golden)
+    print('Golden outputs written to', path)
+
+
+def compare_outputs(golden, outputs, rtol, atol):
+    """The largest absolute difference between a path's outputs and their golden values, and a list of problems
+    (missing outputs, shape changes and differences beyond rtol/atol)."""
+    problems, max_err = [], 0.0
+    for key, expected in golden.items():
+        if key not in outputs:
+            problems.append(key + ' missing')
+            continue
+        actual = np.asarray(outputs[key])
+        if actual.shape != expected.shape:
+            problems.append(key + ' shape ' + str(actual.shape) + ' != ' + str(expected.shape))
+            continue
+        if actual.size:
+            max_err = max(max_err, float(np.nanmax(np.abs(actual.astype(float) - expected.astype(float)))))
+        if not np.allclose(actual, expected, rtol=rtol, atol=atol, equal_nan=True):
+            problems.append(key + ' differs')
+    return max_err, problems
+
+
+def check(path=GOLDEN, rtol=1e-9, atol=1e-9, tolerances=None, repeat=2, cases=None):
+    """Runs every path of each case (or the named cases) on every input set, compares the outputs with the golden
+    file and prints each path's wall time beside the reference's. tolerances may give a case its own (rtol, atol).
+    Returns the failures as (input set, case, path, problems)."""
+    tolerances = tolerances or {}
+    with np.load(path) as f:
+        meta = json.loads(str(f['__meta__']))
+        golden = {key: f[key] for key in f.files if key != '__meta__'}
+    print('Golden outputs from', meta['date'], 'for', meta['months'], 'months, seed', meta['seed'])
+
+    def check_contexts(contexts):
+        failures = []
+        print("%-16s %-12s %-12s %10s %10s %12s  %s" % ('inputs', 'case', 'path', 'wall_s', 'speed-up', 'max_err',
+                                                       'status'))
+        for ctx in contexts:
+            for case, paths in CASES.items():
+                if (cases and case not in cases) or not applies(case, ctx):
+                    continue
+                case_rtol, case_atol = tolerances.get(case, (rtol, atol))
+                prefix = ctx['name'] + '/' + case + '/'
+                expected = {key[len(prefix):]: values for key, values in golden.items() if key.startswith(prefix)}
+                if not expected:
+                    print("%-16s %-12s not in the golden file" % (ctx['name'], case))
+                    continue
+                reference_s = None
+                for name, func in paths.items():
+                    try:
+                        wall_s, outputs = timed(func, ctx, repeat)
+                    except Exception as e:
+                        failures.append((ctx['name'], case, name, [type(e).__name__ + ': ' + str(e)]))
+                        print("%-16s %-12s %-12s %10s %10s %12s  ERROR %s" % (ctx['name'], case, name, '', '', '',
+                                                                              failures[-1][3][0]))
+                        continue
+                    reference_s = wall_s if name == 'reference' else reference_s
+                    max_err, problems = compare_outputs(expected, outputs, case_rtol, case_atol)
+                    if problems:
+                        failures.append((ctx['name'], case, name, problems))
+                    speed_up = "%9.2fx" % (reference_s / wall_s) if reference_s and wall_s > 0 else ''
+                    print("%-16s %-12s %-12s %10.4f %10s %12.3g  %s" % (ctx['name'], case, name, wall_s, speed_up,
+                                                                        max_err, '; '.join(problems) or 'ok'))
+        return failures
+    return with_contexts(meta['months'], meta['seed'], check_contexts)
+
+
+def import_path(spec):
+    """Registers a path given on the command line as case=module:function."""
+    case, target = spec.split('=', 1)
+    module, func = target.split(':', 1)
+    register_path(case, func, getattr(importlib.import_module(module), func))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    record_parser = commands.add_parser('record', help='Write the reference outputs to a golden file')
+    record_parser.add_argument('--months', type=int, default=12, help='Length of synthetic data (12 to 240 months)')
+    record_parser.add_argument('--seed', type=int, default=0)
+    record_parser.add_argument('--out', default=GOLDEN)
+    check_parser = commands.add_parser('check', help='Check every path against a golden file')
+    check_parser.add_argument('--golden', default=GOLDEN)
+    check_parser.add_argument('--rtol', type=float, default=1e-9)
+    check_parser.add_argument('--atol', type=float, default=1e-9)
+    check_parser.add_argument('--tol', action='append', default=[],
+                              help='Tolerances of one case, as case=rtol,atol (may be repeated)')
+    check_parser.add_argument('--repeat', type=int, default=2,
+                              help='Timing repeats (best is kept, so JIT compilation is left out)')
+    check_parser.add_argument('--case', action='append', default=None, help='Only check this case (may be repeated)')
+    check_parser.add_argument('--path', action='append', default=[],
+                              help='Also check a new path, as case=module:function taking the context dict')
+    args = parser.parse_args()
+    if args.command == 'record':
+        if not 12 <= args.months <= 240:
+            parser.error('--months must be between 12 and 240')
+        record(args.out, args.months, args.seed)
+    else:
+        tolerances = {}
+        for spec in args.tol:
+            case, values = spec.split('=', 1)
+            tolerances[case] = tuple(float(value) for value in values.split(','))
+        try:
+            for spec in args.path:
+                import_path(spec)
+        except (ValueError, ImportError, AttributeError) as e:
+            parser.error(str(e))
+        failures = check(args.golden, args.rtol, args.atol, tolerances, args.repeat, args.case)
+        print(len(failures), 'failures' if len(failures) != 1 else 'failure')
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,112 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd  # CSV handling
+
+"""Incremental, crash-safe store for the monthly and annual results of a scenario. Rows are appended to the results
+CSVs as each month (or year) completes, rather than rewriting the whole file, and a checkpoint of the simulation state
+is written atomically after every month. If a run is interrupted, the CSVs are truncated back to the last checkpoint
+and the scenario can carry on from the month after it, reading back the recent rows it still needs."""
+
+
+def _path(scenario, kind):
+    return "scenario_" + str(scenario) + "_" + kind
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):  # numpy scalars, e.g. capacity after degradation
+        return obj.item()
+    raise TypeError(repr(obj) + ' is not JSON serialisable')
+
+
+def _append(path, text):
+    """Appends text in a single write and forces it to disk before returning."""
+    with open(path, 'a', newline='') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_atomic(path, text):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w', newline='') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def open_results_store(scenario, monthly_columns, annual_columns, resume=False):
+    """Opens the results files of a scenario. With resume, and a checkpoint from an interrupted run, the files are
+    truncated to the state of the checkpoint, which is returned in store['checkpoint']. Otherwise, new files with
+    just the headers are started."""
+    store = {'monthly_path': _path(scenario, "monthly_results.csv"),
+             'annual_path': _path(scenario, "annual_results.csv"),
+             'checkpoint_path': _path(scenario, "checkpoint.json"),
+             'monthly_columns': list(monthly_columns), 'annual_columns': list(annual_columns),
+             'n_monthly': 0, 'n_annual': 0, 'checkpoint': None}
+    if resume and os.path.isfile(store['checkpoint_path']):
+        with open(store['checkpoint_path']) as f:
+            checkpoint = json.load(f)
+        for kind in ['monthly', 'annual']:  # Drop anything written after the checkpoint
+            with open(store[kind + '_path'], 'r+') as f:
+                f.truncate(checkpoint['bytes_' + kind])
+            store['n_' + kind] = checkpoint['n_' + kind]
+        store['checkpoint'] = checkpoint
+    else:
+        _write_atomic(store['monthly_path'], pd.DataFrame(columns=store['monthly_columns']).to_csv())
+        _write_atomic(store['annual_path'], pd.DataFrame(columns=store['annual_columns']).to_csv())
+    return store
+
+
+def append_monthly(store, rows):
+    """Appends monthly rows, given as a dict of equal length lists keyed by the monthly columns."""
+    df = pd.DataFrame(rows, columns=store['monthly_columns'])
+    df.index = pd.RangeIndex(store['n_monthly'], store['n_monthly'] + len(df))
+    _append(store['monthly_path'], df.to_csv(header=False))
+    store['n_monthly'] += len(df)
+
+
+def append_annual(store, rows):
+    """Appends annual rows, given as a list of lists in the order of the annual columns."""
+    df = pd.DataFrame(rows, columns=store['annual_columns'])
+    df.index = pd.RangeIndex(store['n_annual'], store['n_annual'] + len(df))
+    _append(store['annual_path'], df.to_csv(header=False))
+    store['n_annual'] += len(df)
+
+
+def load_monthly(store, first_row):
+    """The monthly rows from row first_row on, read back from the monthly CSV as a dict of lists keyed by the monthly
+    columns, e.g. the recent rows a resumed run still needs. Earlier rows are skipped unparsed."""
+    df = pd.read_csv(store['monthly_path'], index_col=0, skiprows=range(1, first_row + 1),
+                     float_precision='round_trip')  # Exactly the values written
+    return {key: df[key].tolist() for key in store['monthly_columns']}
+
+
+def load_annual(store, first_row):
+    """The annual rows from row first_row on, read back from the annual CSV as a list of lists."""
+    df = pd.read_csv(store['annual_path'], index_col=0, skiprows=range(1, first_row + 1),
+                     float_precision='round_trip')  # Exactly the values written
+    return df[store['annual_columns']].astype(object).values.tolist()
+
+
+def save_checkpoint(store, state):
+    """Atomically records the simulation state (a JSON-able dict) along with how much of each results file belongs to
+    it. Called once a month has been completely written. The results rows themselves are only in the CSVs, so the
+    checkpoint stays the same size however long the run (see load_monthly and load_annual)."""
+    checkpoint = dict(state, n_monthly=store['n_monthly'], n_annual=store['n_annual'],
+                      bytes_monthly=os.path.getsize(store['monthly_path']),
+                      bytes_annual=os.path.getsize(store['annual_path']))
+    _write_atomic(store['checkpoint_path'], json.dumps(checkpoint, default=_json_default))
+
+
+def close_results_store(store):
+    """Removes the checkpoint once a scenario has run to completion."""
+    if os.path.isfile(store['checkpoint_path']):
+        os.remove(store['checkpoint_path'])
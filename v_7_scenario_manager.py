@@ -1,169 +1,285 @@
-﻿# coding: utf-8
-"""This script is the top level one for running various scenarios in the behind
-the meter case study described by Fisher et al. (2019). The script relies on two
-CSV param files: one contains the BESS performance params, the other the
-scenario params, e.g. the BESS sizing. The bulk of this script is devoted to
-parsing the exogenous variable data set within the monthly framework required
-for the demand charge billing."""
-
-### Import required tools ###
-from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
-import pandas as pd                 # CSV handling
-import datetime                     # For time stamping optimisation process
-from pyomo.environ import *         # For optimisation posement
-# I've separated generic python functions and optimisation functions into two files to avoid huge lists of functions
-from v_7_param_functions  import *
-from v_7_algorithms import *
-from v_7_deg_functions import *
-
-######################
-# Scenario iteration #
-######################
-run_time_by_case = []  # Receptacle for run time results
-results_by_case = pd.DataFrame()  # Receptacle for results by case
-
-scenarios = pd.read_csv('v_7_scenarios.csv')  # Import CSV file containing scenario rows
-for s in range(len(scenarios)):
-    start_time = datetime.datetime.now()  # Timestamp scenario analysis start
-    # Import scenario parameters in dictionary format #
-    s_dict = make_scenario_dict(scenarios, s)
-    # Import exogenous variables #
-    yyyy = 2012  # Script doesn't currently iterate over multiple years of data, but this is a placeholder for such
-    k_u_dict = parse_k_u_periods(s_dict['tariff_key'])  # Get DNO charge periods w.r.t time in dictionary form.
-    exog_variables_t, exog_variables_h = \
-        parse_exog_variable_data(s_dict['load_profile'], k_u_dict, s_dict['wholesale_profile'],
-                                 s_dict['AS_profiles'], s_dict['time-step_h'])
-    tariff = pd.read_csv(s_dict['tariff_prices'])  # Get actual prices for DNO tariff
-    u_periods, u_prices, k_periods, k_prices = \
-        tariff['u_period'], tariff['u_price'], tariff['k_period'], tariff['k_price']
-    k_charges = {}
-    for i in range(len(k_periods)):
-        if k_periods[i] == k_periods[i]:  # This test skips any Nan entries
-            k_charges[i+1] = k_prices[i]
-    u_charges = {u_periods[i]: u_prices[i] for i in range(len(u_periods))}  # populate u charge dictionary from csv
-    print("Exogenous variable dataset successfully imported")
-
-    # Define absolute BESS parameters based on scenario and specific BESS #
-    BESS_dict = make_BESS_param_dict(s_dict, 'v_7_BESS_params.csv')
-    # Output receptacles
-    results_s_m = {"year":[], "mm":[], "AC_K":[], "AC_U":[], "AC_W":[], "Cap_frac":[], "Q":[],"o_m":[],
-                   "rebalance_cost":[]}
-    results_s_y = [["Year", "AC_K", "AC_U", "AC_W", "rebalance_cost"]]
-    # Optional output at max res for analysis
-    if s_dict['verbose'] == 1:  # Optional results at optimisation time-step resolution (graphs and troubleshooting)
-        verbose_results = {"yyyy": [], "mm": [], "dd": [], "period": [], "k": [], "u": [], "w": [], "load": [],
-                           "P": [], "net_load": [], "SOC": []}
-    ####################################
-    # Calendar + state based iteration #
-    ####################################
-    project_year = 0  # Project year counter
-    project_year_cap = s_dict['project_year_cap']
-    while project_year < project_year_cap:  # Prevents script running forever when degradation isn't limiting
-        # Month loop (time unit for demand charge billing) #
-        months = [m+1 for m in range(12)]
-        #months = [7]
-        monthly_results = []  # Receptacle for results at monthly resolution
-        for mm in months:
-            # Gather exog variable data for the month
-            m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m, peak_loads_buffer = \
-                    grab_month_exog(exog_variables_t, exog_variables_h, mm, yyyy, s_dict['time-step_h'])
-            # Make dict to store net demand peaks in month so far (passed to solver to prevent redundant shaving)
-            peak_demands_record = {1: 227, 2: 230, 3: 224} # Hard code an informed guess
-
-            # Initial peak demands record heuristic.
-            """This sets an initial peak demand for each sub-period, so that the
-            BESS doesn't just start discharging right away. It is based on the average demand in the sub-period for 
-            the coming month, but ignores the first 6 hours of the day where demand is always low.  This is not strictly
-            future-blind, but I expect this could be done adequately with historic data."""
-            print(peak_loads_m)
-            peak_demands_record = {}
-            for k in peak_loads_m:
-                load_in_k = []
-                for d in range(int(len(m_of_load)/96)-1):  # Per day loop
-                    for t in range((d+1)*96 - 72, (d+1)*96):     # Per sub-period excluding first 6 hours
-                        if m_of_k[t] == k:
-                            load_in_k += [m_of_load[t]]
-                if len(load_in_k) != 0:  # Avoids div by 0 error at weekends (when there is no k_2, k_3)
-                    peak_demands_record.update({k: sum(load_in_k)/len(load_in_k)})
-            # Initiate monthly counters for revenue streams
-            AC_U_m, AC_W_m, AC_S_m, Q_m, o_and_m_m, rebalance_cost_m = 0, 0, 0, 0, 0, 0
-            """This loop repeatedly sends a chunk of data to the optimisation function. There are three parameters
-            that control this process: win_opt - the length of the sliding window in hours, win_actioned, the
-            portion of the optimised schedule that is implemented and day_prog, the number of days the window moves
-            on after each optimisation (usually 1)."""
-            days_in_month = range(int(len(m_of_load) * s_dict['time-step_h'] / 24) - 1) # Minus 1 to cancel buffer day
-            #days_in_month = [1,2]
-            for dd in days_in_month:
-                print('scenario', s_dict['scenario'], 'year', project_year, 'month', mm, 'day', dd + 1)
-                window = range(int(dd * s_dict['day_prog'] * 96), int(dd * s_dict['day_prog'] * 96 + s_dict['win_opt']*4))
-                # Get price data across optimisation window
-                load, K, U, W, S, R_d, R_u = [], [], [], [], [], [], []
-                for t in window:
-                    load += [m_of_load[t]]  # Actual 36h of load that will occur
-                    K += [m_of_k[t]]               # Keep as just k indices for now, as required in PYOMO part
-                    U += [u_charges[m_of_u[t]]]
-                    W += [m_of_w[t]]
-                # Here we call the optimisation function #
-                c_log, d_log, SOC_log, peak_demands_record = \
-                    opt_peak_shave_rules_ASAP(s_dict, BESS_dict, load, K, peak_demands_record)
-                # Record relevant data for the implemented schedule and update peak demand record for the month
-                AC_U_d, AC_W_d, net_load_profile = \
-                    day_results(s_dict['time-step_h'], load, c_log, d_log, U, W)
-
-                AC_U_m += AC_U_d
-                AC_W_m += AC_W_d
-
-                #print('days in operation:', "%.0f" % s_dict['days'])
-                s_dict['days'] += 1
-
-                # Call electrolyte decay tracker function
-                if BESS_dict['BESS_class'] == 'VRFB':
-                    o_and_m_d, q = VRFB_elec_decay(mm, dd, s_dict, BESS_dict, SOC_log)
-                    Q_m += q
-                    o_and_m_m += o_and_m_d
-                # Call capacity rebalance cost tracker function
-                if BESS_dict['BESS_class'] == 'VRFB':
-                    rebalance_cost = VRFB_rebalance_cost(q, BESS_dict, U, W)
-                    rebalance_cost_m -= rebalance_cost
-                # This code updates the SOC_0 value to be used in the following window
-                s_dict['SOC_0'] = SOC_log[-1]
-                #print("SOC at end of window: ", "%.2f" % s_dict['SOC_0'], "\n")
-
-                # This optional code writes verbose results to the l_o_l
-                if s_dict['verbose'] == 1:
-                    verbose_results = parse_verbose(verbose_results, load, c_log, d_log, SOC_log, net_load_profile, yyyy, mm, dd, K,
-                                                    U, W)
-
-            # Wrap up results at monthly resolution
-            AC_K_m = sum([k_charges[k] * (peak_loads_m[k] - peak_demands_record[k]) for k in peak_loads_m])
-
-            # Add monthly res results to dict for output later
-            results_s_m['year'] += [project_year]
-            results_s_m['mm'] += [mm]
-            results_s_m['AC_K'] += [AC_K_m]
-            results_s_m['AC_U'] += [AC_U_m]
-            results_s_m['AC_W'] += [AC_W_m]
-            results_s_m['Cap_frac'] += [BESS_dict['C'] / BESS_dict['C_0']]
-            results_s_m["Q"] += [Q_m]
-            results_s_m['o_m'] += [o_and_m_m]
-            results_s_m['rebalance_cost'] += [rebalance_cost_m]
-
-
-        # Wrap up results at year end by summing monthly values
-        results_s_y += [[project_year, sum(results_s_m['AC_K']), sum(results_s_m['AC_U']), sum(results_s_m['AC_W']),
-                        sum(results_s_m['rebalance_cost'])]]
-
-        # Progress year
-        project_year += 1
-        # Output scenario results (write at end of each year in case of interuption)
-        results_s_m = pd.DataFrame(results_s_m)
-        results_s_m.to_csv("scenario_" + str(s_dict['scenario']) + "_monthly_results.csv")
-        results_s_y = pd.DataFrame(results_s_y)
-        results_s_y.to_csv("scenario_" + str(s_dict['scenario']) + "_annual_results.csv")
-    run_time = (datetime.datetime.now() - start_time).seconds
-    run_time_by_case += [run_time]
-    if s_dict['verbose'] == 1:
-        verbose_output = pd.DataFrame(verbose_results)
-        verbose_output.to_csv("scenario_" + str(s_dict['scenario']) + "_verbose_results.csv")
-
-    print("run time by case: ", run_time_by_case)
+﻿# coding: utf-8
+"""This script is the top level one for running various scenarios in the behind
+the meter case study described by Fisher et al. (2019). The script relies on two
+CSV param files: one contains the BESS performance params, the other the
+scenario params, e.g. the BESS sizing. The bulk of this script is devoted to
+parsing the exogenous variable data set within the monthly framework required
+for the demand charge billing."""
+
+### Import required tools ###
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import pandas as pd                 # CSV handling
+import datetime                     # For time stamping optimisation process
+# I've separated generic python functions and optimisation functions into two files to avoid huge lists of functions
+from v_7_param_functions  import *
+from v_7_algorithms import *
+from v_7_deg_functions import *
+from v_7_config import load_scenarios, make_bess_params, make_sim_state, state_to_dict, state_from_dict
+from v_7_data_cache import load_exog_dataset_cached
+from v_7_scheduler import make_schedule, month_plan, window_days, window_view, dispatch_window, by_window
+from v_7_verbose_sink import make_verbose_sink, verbose_sink_add, verbose_sink_flush, verbose_sink_close
+from v_7_profiling import make_profile, stage, set_period, start_profile, stop_profile, write_profile
+from v_7_results_store import open_results_store, append_monthly, append_annual, load_monthly, load_annual, \
+    save_checkpoint, close_results_store
+from v_7_log import get_logger, setup_logging, make_progress, progress_update
+
+logger = get_logger('manager')
+
+def simulation_state(project_year, next_mm, end_of_life, state, prior_peak_record):
+    """Everything run_scenario needs to carry on from the start of month next_mm of project_year, apart from the
+    results rows, which are read back from the results files (see v_7_results_store)."""
+    return {'project_year': project_year, 'next_mm': next_mm, 'end_of_life': end_of_life,
+            'state': state_to_dict(state),
+            'prior_peak_record': None if prior_peak_record is None else [[k, peak] for k, peak in
+                                                                         prior_peak_record.items()]}
+
+def run_scenario(params, dataset, profile=None):
+    """Runs the calendar + state based iteration for a single scenario and writes its results files. The exogenous
+    variable dataset comes from load_exog_dataset, so it can be parsed once and shared by scenarios that use it.
+    If a profile (see v_7_profiling) is given, each stage is timed per project year and month. Results are appended
+    to the results files month by month, with a checkpoint that params.resume == 1 picks up from after a crash.
+    params is a ScenarioParams (see v_7_config), which is never changed; what changes as the BESS operates is held in
+    a SimState. Project year N runs on the N_th complete year of the data, wrapping round once they are used up (see
+    project_data_year), so a single year of data is replayed every year."""
+    exog_variables_t, calendar = dataset['exog_variables_t'], dataset['calendar']
+    k_charges, u_charges = dataset['k_charges'], dataset['u_charges']
+    u_price = charge_table(u_charges)  # Energy price by u period, for array lookups
+
+    # Define absolute BESS parameters based on scenario and specific BESS #
+    bess = make_bess_params(params, 'v_7_BESS_params.csv')
+    state = make_sim_state(params, bess)
+    # Sliding window geometry, and the dispatch engine selected by opt_type (models are built once, here)
+    schedule = make_schedule(params, calendar['steps_per_day'])
+    dispatch = make_dispatch(params, bess, dataset, schedule['n_opt'])
+    # Output receptacles
+    results_s_m = {"year":[], "mm":[], "AC_K":[], "AC_U":[], "AC_W":[], "Cap_frac":[], "Q":[],"o_m":[],
+                   "rebalance_cost":[]}
+    if params.AS_stacking == 1:  # Revenue by ancillary service, and the cost of the regulation losses
+        results_s_m.update({"AS_reg_up":[], "AS_reg_down":[], "AS_spin":[], "AS_loss_cost":[]})
+    results_s_y = []
+    first_m, first_y = 0, 0  # Row of the results files that results_s_m and results_s_y start at
+    results_store = open_results_store(params.scenario, results_s_m,
+                                       ["Year", "AC_K", "AC_U", "AC_W", "rebalance_cost", "extrapolated",
+                                        "extrap_err_bound"], params.resume == 1)
+    project_year = 0  # Project year counter
+    next_mm = 1  # First month to run in the current project year (later than 1 only when resuming)
+    end_of_life = False  # Li-ion projects end when capacity fades to the EOL fraction
+    prior_peak_record = None  # Peak demand record at the end of the previous month
+    verbose_stem = "scenario_" + str(params.scenario) + "_verbose_results"
+    checkpoint = results_store['checkpoint']
+    if checkpoint is not None:  # Restore the state of the interrupted run
+        project_year, next_mm, end_of_life = \
+            checkpoint['project_year'], checkpoint['next_mm'], checkpoint['end_of_life']
+        state = state_from_dict(checkpoint['state'])
+        # Only this year's and last year's monthly rows (for the year sum and year_converged) and the last two annual
+        # rows (for extrapolate_years) are needed from here on
+        first_m = max(results_store['n_monthly'] - (12 + next_mm - 1), 0)
+        first_y = max(results_store['n_annual'] - 2, 0)
+        results_s_m, results_s_y = load_monthly(results_store, first_m), load_annual(results_store, first_y)
+        if checkpoint['prior_peak_record'] is not None:  # JSON keys are strings, so it is stored as [k, peak] pairs
+            prior_peak_record = {k: peak for k, peak in checkpoint['prior_peak_record']}
+        verbose_stem += "_from_year_" + str(project_year) + "_month_" + str(next_mm)  # Earlier verbose output is kept
+        logger.info('scenario %s resumed at year %d month %d', params.scenario, project_year, next_mm)
+    # Optional output at max res for analysis
+    if params.verbose == 1:  # Optional results at optimisation time-step resolution (graphs and troubleshooting)
+        # Buffer sized to hold the longest month, flushed to disk at the end of every month
+        chunk_rows = max(stop - start for start, stop in calendar['months'].values())
+        verbose_sink = make_verbose_sink(verbose_stem, chunk_rows, params.verbose_columns,
+                                         params.verbose_decimate, params.verbose_format)
+    ####################################
+    # Calendar + state based iteration #
+    ####################################
+    project_year_cap = params.project_year_cap
+    days_by_year = {yyyy: sum(stop - start for (y, mm), (start, stop) in calendar['months'].items() if y == yyyy)
+                    // calendar['steps_per_day'] for yyyy in data_years(calendar)}
+    progress = make_progress(params.scenario, sum(days_by_year[project_data_year(calendar, y)]
+                                                  for y in range(project_year_cap)), params.progress)
+    # Year cap prevents script running forever when degradation isn't limiting
+    while project_year < project_year_cap and not end_of_life:
+        yyyy = project_data_year(calendar, project_year)  # Year of exogenous data this project year runs on
+        # Month loop (time unit for demand charge billing) #
+        months = [m+1 for m in range(12)]
+        #months = [7]
+        monthly_results = []  # Receptacle for results at monthly resolution
+        for mm in months:
+            if mm < next_mm:  # Already run before the checkpoint
+                continue
+            set_period(profile, project_year, mm)
+            # Gather exog variable data for the month
+            with stage(profile, 'month_grab'):
+                m_of_load, m_of_k, m_of_u, m_of_w, m_of_s, m_of_r_d, m_of_r_u, peak_loads_m = \
+                        grab_month_exog(exog_variables_t, calendar, mm, yyyy)
+            # Make dict to store net demand peaks in month so far (passed to solver to prevent redundant shaving)
+            peak_demands_record = {1: 227, 2: 230, 3: 224} # Hard code an informed guess
+
+            # Initial peak demands record heuristic.
+            """This sets an initial peak demand for each sub-period, so that the
+            BESS doesn't just start discharging right away. By default it is the average demand in the sub-period for 
+            the coming month, ignoring the first 6 hours of the day where demand is always low.  This is not strictly
+            future-blind, but I expect this could be done adequately with historic data. The statistic and exclusion
+            window are set by the peak_init_stat and peak_init_excl_h scenario columns (see init_peak_record)."""
+            with stage(profile, 'peak_record_init'):
+                peak_demands_record = init_peak_record(m_of_load, m_of_k, peak_loads_m, calendar['steps_per_day'],
+                                                       params.peak_init_excl_h, params.peak_init_stat,
+                                                       prior_peak_record)
+            # Initiate monthly counters for revenue streams
+            Q_m, o_and_m_m, rebalance_cost_m = 0, 0, 0
+            """This loop repeatedly sends a chunk of data to the optimisation function. There are three parameters
+            that control this process: win_opt - the length of the sliding window in hours, win_actioned, the
+            portion of the optimised schedule that is implemented and day_prog, the number of days the window moves
+            on after each optimisation (usually 1). Only the actioned portion is committed (see v_7_scheduler)."""
+            month_start, month_stop = calendar['months'][yyyy, mm]
+            window_starts, window_commits = month_plan(schedule, month_start, month_stop)
+            # Month arrays of committed dispatch logs, and the state after each window, for month level accounting
+            n_m = month_stop - month_start
+            c_m, d_m, SOC_m = np.empty(n_m), np.empty(n_m), np.empty(n_m)
+            q_m, C_m = np.zeros(len(window_starts)), np.zeros(len(window_starts))
+            AS_m = np.zeros(4)  # Reg-up, reg-down and spin revenue, regulation loss cost
+            for w, (window_start, n_commit) in enumerate(zip(window_starts, window_commits)):
+                offset = window_start - month_start
+                committed = slice(offset, offset + n_commit)
+                window = window_view(exog_variables_t, window_start, schedule['n_opt'], u_price)
+                # Here we call the optimisation function #
+                with stage(profile, 'dispatch'):
+                    c_m[committed], d_m[committed], SOC_m[committed], peak_demands_record = \
+                        dispatch_window(dispatch, state, window, n_commit, peak_demands_record)
+                if params.AS_stacking == 1:
+                    with stage(profile, 'AS_stacking'):
+                        if 'AS_plan' in window:  # Book the reservation the LP/MILP schedule was planned around
+                            AS_m += AS_revenue(params, bess, window, n_commit, window['AS_plan'][0][:n_commit],
+                                               window['AS_plan'][1][:n_commit])
+                        else:  # Reserve the headroom left by the committed rules based schedule
+                            AS_m += AS_stack(params, bess, state.C, window, n_commit, c_m[committed],
+                                             d_m[committed], SOC_m[committed], peak_demands_record)
+
+                #print('days in operation:', "%.0f" % state.days)
+                state.days += n_commit / schedule['steps_per_day']
+
+                with stage(profile, 'degradation'):
+                    # Call electrolyte decay tracker function
+                    if bess.BESS_class == 'VRFB':
+                        o_and_m_d, q_m[w] = VRFB_elec_decay(mm, window_days(schedule, offset, n_commit), params, bess,
+                                                            state, SOC_m[committed])
+                        Q_m += q_m[w]
+                        o_and_m_m += o_and_m_d
+                    # Call Li-ion cycle and calendar ageing function
+                    if bess.BESS_class == 'Li-ion':
+                        q_m[w] = Li_ion_deg(params, bess, state, SOC_m[committed])
+                        Q_m += q_m[w]
+                    C_m[w] = state.C  # Capacity after the window's decay, as used for the rebalance cost
+                # This code updates the SOC_0 value to be used in the following window
+                state.SOC_0 = SOC_m[offset + n_commit - 1]
+                #print("SOC at end of window: ", "%.2f" % state.SOC_0, "\n")
+                progress_update(progress, state.days - 1, project_year, mm, offset // schedule['steps_per_day'],
+                                w == len(window_starts) - 1)
+
+            # Account for the whole month in one pass over the month arrays, window by window
+            with stage(profile, 'accounting'):
+                n_act = schedule['n_act']
+                load_m, U_m, W_m = by_window(m_of_load, n_act), by_window(u_price[m_of_u], n_act), \
+                    by_window(m_of_w, n_act)
+                AC_U_m, AC_W_m, net_load_m = month_results(params.time_step_h, load_m, by_window(c_m, n_act),
+                                                           by_window(d_m, n_act), U_m, W_m)
+                # Call capacity rebalance cost tracker function
+                if bess.BESS_class == 'VRFB':
+                    rebalance_cost_m -= VRFB_rebalance_cost_month(q_m, C_m, bess, U_m, W_m)
+                # Wrap up results at monthly resolution
+                AC_K_m = month_AC_K(k_charges, peak_loads_m, peak_demands_record)
+            prior_peak_record = dict(peak_demands_record)  # Carried to next month for peak_init_stat 'prior'
+
+            # This optional code writes verbose results to the sink
+            if params.verbose == 1:
+                with stage(profile, 'verbose'):
+                    net_load_m = net_load_m.ravel()
+                    for window_start, n_commit in zip(window_starts, window_commits):
+                        offset = window_start - month_start
+                        w = slice(offset, offset + n_commit)
+                        verbose_sink_add(verbose_sink, m_of_load[w], c_m[w], d_m[w], SOC_m[w], net_load_m[w], yyyy,
+                                         mm, offset // schedule['steps_per_day'], m_of_k[w], u_price[m_of_u[w]],
+                                         m_of_w[w])
+                with stage(profile, 'output_write'):
+                    verbose_sink_flush(verbose_sink)
+
+            # Add monthly res results to dict for output later
+            results_s_m['year'] += [project_year]
+            results_s_m['mm'] += [mm]
+            results_s_m['AC_K'] += [AC_K_m]
+            results_s_m['AC_U'] += [AC_U_m]
+            results_s_m['AC_W'] += [AC_W_m]
+            results_s_m['Cap_frac'] += [state.C / bess.C_0]
+            results_s_m["Q"] += [Q_m]
+            results_s_m['o_m'] += [o_and_m_m]
+            results_s_m['rebalance_cost'] += [rebalance_cost_m]
+            if params.AS_stacking == 1:
+                for key, value in zip(["AS_reg_up", "AS_reg_down", "AS_spin", "AS_loss_cost"], AS_m):
+                    results_s_m[key] += [value]
+            with stage(profile, 'output_write'):
+                append_monthly(results_store, {key: values[results_store['n_monthly'] - first_m:]
+                                               for key, values in results_s_m.items()})
+                if mm != months[-1]:  # The last month's checkpoint waits for the year end wrap up
+                    save_checkpoint(results_store, simulation_state(project_year, mm + 1, end_of_life, state,
+                                                                    prior_peak_record))
+        next_mm = 1
+
+
+        # Wrap up results at year end by summing monthly values
+        year_m = slice(-len(months), None)  # This year's rows in the monthly results
+        results_s_y += [[project_year, sum(results_s_m['AC_K'][year_m]), sum(results_s_m['AC_U'][year_m]),
+                         sum(results_s_m['AC_W'][year_m]), sum(results_s_m['rebalance_cost'][year_m]), 0, 0]]
+
+        # Progress year
+        project_year += 1
+        if bess.BESS_class == 'Li-ion' and state.C / bess.C_0 <= params.EOL:
+            end_of_life = True
+            logger.info('scenario %s reached end of life in project year %d', params.scenario, project_year)
+        # Fast-forward: once a year repeats the previous one, extrapolate the remaining years rather than replay them
+        # (only when a single year of data is replayed, as multi-year data differs from one year to the next)
+        if params.ff_tol > 0 and len(days_by_year) == 1 and not end_of_life and project_year < project_year_cap:
+            converged, rel_diff = year_converged(results_s_m, len(months), params.ff_tol)
+            if converged:
+                extrapolate_years(results_s_m, results_s_y, project_year_cap - project_year, len(months))
+                logger.info('scenario %s converged after %d years (max rel. diff %.2e), extrapolated to year %d with '
+                            'error bound %.2f', params.scenario, project_year, rel_diff, project_year_cap,
+                            results_s_y[-1][-1])
+                project_year = project_year_cap
+        set_period(profile, project_year - 1)
+        # Output scenario results (appended at end of each year in case of interuption)
+        with stage(profile, 'output_write'):
+            # Rows not yet in the files: this year's and any extrapolated ones
+            append_monthly(results_store, {key: values[results_store['n_monthly'] - first_m:]
+                                           for key, values in results_s_m.items()})
+            append_annual(results_store, results_s_y[results_store['n_annual'] - first_y:])
+            save_checkpoint(results_store, simulation_state(project_year, 1, end_of_life, state, prior_peak_record))
+    if params.verbose == 1:
+        with stage(profile, 'output_write'):
+            verbose_sink_close(verbose_sink)
+    close_results_store(results_store)
+
+
+######################
+# Scenario iteration #
+######################
+def run_scenarios(scenarios):
+    """Runs a list of ScenarioParams one after another and returns run_time_by_case."""
+    run_time_by_case = []  # Receptacle for run time results
+    for params in scenarios:
+        start_time = datetime.datetime.now()  # Timestamp scenario analysis start
+        profile = make_profile(params.profile)  # Stage timing, plus optional cProfile/tracemalloc capture
+        start_profile(profile)
+        # Import exogenous variables #
+        dataset = load_exog_dataset_cached(params, profile=profile)  # Parsed once per distinct set of input files
+        logger.info("Exogenous variable dataset successfully imported")
+        run_scenario(params, dataset, profile)
+        stop_profile(profile)
+        run_time = (datetime.datetime.now() - start_time).seconds
+        run_time_by_case += [run_time]
+        write_profile(profile, params.scenario, run_time)
+
+        logger.info("run time by case: %s", run_time_by_case)
+    return run_time_by_case
+
+
+if __name__ == '__main__':
+    setup_logging('INFO')  # 'DEBUG' adds daily progress and degradation detail
+    # Import CSV file containing scenario rows, with any sweeps expanded, as validated ScenarioParams
+    run_scenarios(load_scenarios('v_7_scenarios.csv'))
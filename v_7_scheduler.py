@@ -0,0 +1,84 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import numpy as np
+
+"""Rolling-window scheduler. A dispatch engine (see v_7_algorithms.make_dispatch) optimises a window of win_opt hours,
+the first win_actioned hours of its schedule are committed, and the next window starts where the committed portion
+ends, day_prog days on. Windows are cut from the whole dataset rather than from a month, so a window's look-ahead runs
+on into the next month's data, and past the end of the data it wraps round to the start (the data is replayed each
+project year). All lengths are in time-steps, so any time-step that divides the hour works."""
+
+
+def make_schedule(params, steps_per_day):
+    """Window lengths in time-steps: n_opt are optimised and the first n_act of them committed, which is also how far
+    the window moves on. validate_params checks that these are whole numbers of time-steps."""
+    steps_per_h = steps_per_day / 24
+    n_opt, n_act = int(round(params.win_opt * steps_per_h)), int(round(params.win_actioned * steps_per_h))
+    if n_act != int(round(params.day_prog * steps_per_day)):
+        raise ValueError('win_actioned must be the ' + str(24 * params.day_prog) + ' h the window moves on by')
+    return {'n_opt': n_opt, 'n_act': n_act, 'steps_per_day': steps_per_day}
+
+
+def month_plan(schedule, start, stop):
+    """Dataset offset of the first time-step of each window that covers a month's time-steps [start, stop), and the
+    number of time-steps each window commits (the last window of a month may commit fewer than n_act)."""
+    starts = np.arange(start, stop, schedule['n_act'])
+    return starts, np.minimum(schedule['n_act'], stop - starts)
+
+
+def window_days(schedule, offset, n_commit):
+    """Days of the month (first day is 0) that begin within a window's committed time-steps, where offset is the
+    window's first time-step counted from the start of the month."""
+    steps_per_day = schedule['steps_per_day']
+    return np.arange(-(-offset // steps_per_day), -(-(offset + n_commit) // steps_per_day))
+
+
+def window_view(exog, start, n_steps, u_price=None):
+    """The n_steps time-steps of each array in exog from dataset offset start (along the last axis, so a fleet's
+    (sites, time-steps) load is cut too). These are views of the arrays, unless the window runs past the end of the
+    data, where it wraps round to the start and is copied. Given the u_price table (see charge_table), the window
+    also holds U, the energy price of its time-steps, looked up from its u periods so that no price array the length
+    of the (memory-mapped) dataset is built."""
+    n_data = exog['load'].shape[-1]
+    if start + n_steps <= n_data:
+        window = {key: values[..., start:start + n_steps] for key, values in exog.items()}
+    else:
+        index = np.arange(start, start + n_steps) % n_data
+        window = {key: values[..., index] for key, values in exog.items()}
+    if u_price is not None:
+        window['U'] = u_price[window['u']]
+    return window
+
+
+def dispatch_window(dispatch, state, window, n_commit, peak_record):
+    """Runs a dispatch engine over a window and commits its first n_commit time-steps. Returns the committed c, d and
+    SOC logs and the peak record, raised by the committed net load only. Sub-periods of the window that have no record
+    (e.g. in look-ahead past the end of the month, which is billed separately) are planned with their peak load in the
+    window as the record, so they are not shaved."""
+    k = np.asarray(window['k'])
+    plan_record = dict(peak_record)
+    missing = [k_i for k_i in np.unique(k).tolist() if k_i not in plan_record]
+    for k_i in missing:
+        plan_record[k_i] = np.max(window['load'][k == k_i])
+    c_log, d_log, soc_log, plan_record = dispatch(state, window, plan_record)
+    if n_commit == len(k) and not missing:  # The whole window is committed, so the engine's record stands
+        return c_log, d_log, soc_log, plan_record
+    c_log, d_log, soc_log, k = c_log[:n_commit], d_log[:n_commit], soc_log[:n_commit], k[:n_commit]
+    net_load = window['load'][:n_commit] + c_log - d_log
+    record = dict(peak_record)
+    for k_i in np.unique(k).tolist():
+        record[k_i] = max(record.get(k_i, -np.inf), np.max(net_load[k == k_i]))
+    return c_log, d_log, soc_log, record
+
+
+def by_window(values, n_act, fill=0.0):
+    """Reshapes a month of committed values to (windows, n_act), padding a short last window with fill, for the
+    month level accounting functions that work window by window. Leading axes (e.g. a fleet's sites) are kept."""
+    values = np.asarray(values)
+    pad = -values.shape[-1] % n_act
+    if pad:
+        values = np.concatenate([values, np.full(values.shape[:-1] + (pad,), fill, dtype=values.dtype)], axis=-1)
+    return values.reshape(values.shape[:-1] + (-1, n_act))
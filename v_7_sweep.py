@@ -0,0 +1,172 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import dataclasses
+import itertools
+import numpy as np
+import pandas as pd  # CSV handling
+from v_7_config import SWEEP_EXCLUDED, parse_sweep, make_scenario_params, make_bess_params, validate_params
+from v_7_data_cache import load_exog_dataset_cached
+from v_7_fleet import run_batch
+from v_7_log import get_logger
+
+"""Sizing sweeps. A scenario row whose P_inv_cont, EtoP, P_cap, SOC_min, SOC_max or o_m_cost cells hold sweep
+specifications ('a|b|c' or 'start:stop:step', see v_7_config) is run as one batch over the grid of those values
+(v_7_fleet.run_batch), sharing the dataset and dispatching every configuration together. Configurations whose results
+part way through the first year are already dominated are pruned. The grid is then refined by bisection around the
+best configuration, and every configuration run goes into a single results table, sweep_<scenario>_results.csv.
+Each configuration is valued as its avoided costs net of maintenance, AC_K + AC_U + AC_W + rebalance_cost - o_m,
+summed over its project years (avoided_cost), or discounted and net of capital cost (NPV)."""
+
+logger = get_logger('sweep')
+
+SWEEP_COLUMNS = ['P_inv_cont', 'EtoP', 'P_cap', 'SOC_min', 'SOC_max', 'o_m_cost']  # Batched without a new dataset
+OBJECTIVES = ['NPV', 'avoided_cost']
+
+
+def sweep_axes(scenarios, scenario=None):
+    """The base ScenarioParams of the named (or first) row of a scenario CSV or DataFrame, and the sorted values of
+    each of its swept columns. The base takes the first value of each sweep."""
+    if not isinstance(scenarios, pd.DataFrame):
+        scenarios = pd.read_csv(scenarios)
+    rows = [s for s in range(len(scenarios)) if scenario is None or str(scenarios['scenario'][s]) == scenario]
+    if not rows:
+        raise ValueError('No scenario ' + str(scenario) + ' to sweep')
+    row = scenarios.iloc[[rows[0]]].reset_index(drop=True).astype(object)
+    axes = {}
+    for column in row.columns:
+        values = parse_sweep(row[column][0]) if column not in SWEEP_EXCLUDED else None
+        if values is None:
+            continue
+        if column not in SWEEP_COLUMNS:
+            raise ValueError('Sweep column ' + column + ' is not one of ' + ', '.join(SWEEP_COLUMNS))
+        axes[column] = sorted(set(float(value) for value in values))
+        row.loc[0, column] = axes[column][0]
+    if not axes:
+        raise ValueError('Scenario ' + str(row['scenario'][0]) + ' has no sweep to run')
+    return make_scenario_params(row, 0), axes  # Each point is validated by sweep_point
+
+
+def sweep_point(base, point):
+    """The ScenarioParams of one point of a sweep ({column: value}), or None if the combination is invalid (e.g.
+    SOC_min above SOC_max)."""
+    params = dataclasses.replace(base, scenario=base.scenario + ''.join('_' + column + '=' + str(value)
+                                                                        for column, value in point.items()),
+                                 **point)
+    problems = validate_params(params, check_files=False)
+    if problems:
+        logger.warning('sweep point %s skipped: %s', params.scenario, '; '.join(problems))
+        return None
+    return params
+
+
+def capital_cost(params, capex_kW, capex_kWh):
+    return capex_kW * params.P_inv_cont + capex_kWh * make_bess_params(params).C_0
+
+
+def month_value(row):
+    """A month's avoided costs net of maintenance."""
+    return row['AC_K'] + row['AC_U'] + row['AC_W'] + row['rebalance_cost'] - row['o_m']
+
+
+def make_pruner(capex, prune_after, prune_tol):
+    """Pruning rule for run_batch. From month prune_after of the first project year, a configuration is dropped once
+    another one that costs no more to build has already earned more, by a margin of prune_tol (a fraction of the
+    value so far) that allows for configurations catching up later in the year."""
+    value = np.zeros(len(capex))  # Value so far in the first year
+
+    def prune(project_year, mm, monthly, active):
+        if project_year > 0:
+            return []
+        for row in monthly[-len(active):]:  # The month just run
+            value[row['config']] += month_value(row)
+        if mm < prune_after or len(active) < 2:
+            return []
+        return [i for i in active if np.any((capex[active] <= capex[i]) &
+                                            (value[active] > value[i] + prune_tol * abs(value[i])))]
+    return prune
+
+
+def run_round(base, points, dataset, round_n, options):
+    """Runs the configurations of a list of sweep points as one batch. Returns a results table row for each."""
+    params_list = [sweep_point(base, point) for point in points]
+    points = [point for point, params in zip(points, params_list) if params is not None]
+    params_list = [params for params in params_list if params is not None]
+    if not params_list:
+        return []
+    capex = np.array([capital_cost(params, options['capex_kW'], options['capex_kWh']) for params in params_list])
+    prune = make_pruner(capex, options['prune_after'], options['prune_tol']) if options['prune_tol'] >= 0 else None
+    monthly, stopped = run_batch(params_list, dataset, prune=prune)
+    monthly = pd.DataFrame(monthly)
+    monthly['value'] = month_value(monthly)
+    rows = []
+    for i, params in enumerate(params_list):
+        config_m = monthly[monthly['config'] == i]
+        annual_value = config_m.groupby('year', sort=True)['value'].sum()
+        status = stopped.get(i, ('complete',))[0]
+        discount = (1 + options['discount_rate']) ** -(annual_value.index.to_numpy() + 1.0)
+        row = {'scenario': params.scenario, 'round': round_n}
+        row.update(points[i])
+        row.update({'C_0': make_bess_params(params).C_0, 'capex': capex[i], 'status': status,
+                    'months_run': len(config_m), 'Cap_frac': config_m['Cap_frac'].iloc[-1]})
+        row.update({key: config_m[key].sum() for key in ['AC_K', 'AC_U', 'AC_W', 'rebalance_cost', 'o_m']})
+        complete = status != 'pruned'  # Configurations at end of life are valued over the years they ran
+        row['avoided_cost'] = annual_value.sum() if complete else np.nan
+        row['NPV'] = np.sum(annual_value.to_numpy() * discount) - capex[i] if complete else np.nan
+        rows.append(row)
+    logger.info('sweep %s round %d: %d configurations, %d pruned', base.scenario, round_n, len(rows),
+                sum(row['status'] == 'pruned' for row in rows))
+    return rows
+
+
+def refine_points(axes, best):
+    """Bisection around the best point: for each swept column, the midpoints between the best value and its
+    neighbours among the values run so far, with the other columns held at the best point."""
+    points = []
+    for column, values in axes.items():
+        i = values.index(best[column])
+        for neighbour in [i - 1, i + 1]:
+            if 0 <= neighbour < len(values):
+                points.append(dict(best, **{column: round((values[i] + values[neighbour]) / 2, 12)}))
+    return points
+
+
+def run_sweep(scenarios, scenario=None, objective='NPV', capex_kW=0, capex_kWh=0, discount_rate=0, refine=2,
+              prune_after=3, prune_tol=0.05):
+    """Runs the sweep of the named (or first) row of a scenario CSV or DataFrame: the grid of its swept values, then
+    refine rounds of bisection around the best configuration by objective (NPV or avoided_cost). capex_kW and
+    capex_kWh are capital costs per kW of P_inv_cont and per kWh of C_0, and discount_rate the annual rate for the
+    NPV. A negative prune_tol turns pruning off. Writes and returns the results table, best first."""
+    if objective not in OBJECTIVES:
+        raise ValueError('objective must be one of ' + ', '.join(OBJECTIVES))
+    base, axes = sweep_axes(scenarios, scenario)
+    if base.opt_type != 'rules' or base.AS_stacking != 0:
+        raise ValueError('Sweep ' + base.scenario + ': sweeps run the rules based dispatch without AS stacking')
+    options = {'capex_kW': capex_kW, 'capex_kWh': capex_kWh, 'discount_rate': discount_rate,
+               'prune_after': prune_after, 'prune_tol': prune_tol}
+    dataset = load_exog_dataset_cached(base)  # Shared by every configuration
+    grid = [dict(zip(axes, values)) for values in itertools.product(*axes.values())]
+    rows = run_round(base, grid, dataset, 0, options)
+    for round_n in range(1, refine + 1):
+        ranked = [row for row in rows if row[objective] == row[objective]]
+        if not ranked:
+            break
+        best = max(ranked, key=lambda row: row[objective])
+        done = set(tuple(row[column] for column in axes) for row in rows)
+        points = [point for point in refine_points(axes, {column: best[column] for column in axes})
+                  if tuple(point[column] for column in axes) not in done]
+        if not points:
+            break
+        for point in points:
+            for column, value in point.items():
+                if value not in axes[column]:
+                    axes[column] = sorted(axes[column] + [value])
+        rows += run_round(base, points, dataset, round_n, options)
+    results = pd.DataFrame(rows).sort_values(objective, ascending=False, na_position='last', kind='stable')
+    results.to_csv('sweep_' + str(base.scenario) + '_results.csv', index=False)
+    if results[objective].notna().any():
+        logger.info('sweep %s: best %s %.2f for %s', base.scenario, objective, results[objective].iloc[0],
+                    results['scenario'].iloc[0])
+    return results
@@ -0,0 +1,122 @@
+﻿# coding: utf-8
+####################
+# Import libraries #
+####################
+from __future__ import division     # Without this, rounding errors occur in python 2.7, but apparently not in 3.4
+import os
+import numpy as np
+import pandas as pd  # CSV handling
+
+"""Verbose output of BESS operation at the resolution of the model time-step. Rows are written into preallocated typed
+arrays and flushed to disk in chunks (one chunk per month by default) as the run progresses, so memory use doesn't
+grow with the length of the run. Parquet (row groups, needs pyarrow) and HDF5 (resizable datasets, needs h5py) are
+used if installed, otherwise chunks are appended to a CSV in the same layout as the original verbose results file.
+Columns can be selected, and rows decimated (keep every n_th time-step) for long runs."""
+
+VERBOSE_COLUMNS = {'yyyy': np.int32, 'mm': np.int32, 'dd': np.int32, 'period': np.int32, 'k': np.int32,
+                   'u': np.float64, 'w': np.float64, 'load': np.float64, 'P': np.float64, 'net_load': np.float64,
+                   'SOC': np.float64}
+EXTENSIONS = {'parquet': '.parquet', 'hdf5': '.h5', 'csv': '.csv'}
+
+
+def available_format(fmt='auto'):
+    """Resolves 'auto' to the best installed format."""
+    if fmt != 'auto':
+        return fmt
+    for fmt, module in [('parquet', 'pyarrow'), ('hdf5', 'h5py')]:
+        try:
+            __import__(module)
+            return fmt
+        except ImportError:
+            pass
+    return 'csv'
+
+
+def make_verbose_sink(path_stem, chunk_rows, columns=None, decimate=1, fmt='auto'):
+    """Opens a verbose results sink writing to path_stem + the format's extension. chunk_rows sets the size of the
+    preallocated buffer, e.g. the number of time-steps in the longest month of the calendar."""
+    fmt = available_format(fmt)
+    columns = list(VERBOSE_COLUMNS) if columns is None else list(columns)
+    unknown = [col for col in columns if col not in VERBOSE_COLUMNS]
+    if unknown:
+        raise ValueError('Unknown verbose column(s): ' + str(unknown))
+    path = path_stem + EXTENSIONS[fmt]
+    if os.path.exists(path):
+        os.remove(path)
+    return {'path': path, 'format': fmt, 'columns': columns, 'decimate': int(decimate), 'writer': None,
+            'buffer': {col: np.empty(chunk_rows, dtype=VERBOSE_COLUMNS[col]) for col in columns},
+            'n': 0,  # Rows in the buffer
+            'rows_written': 0, 'steps_seen': 0}
+
+
+def verbose_sink_add(sink, load, c_log, d_log, SOC_profile, demand_profile, yyyy, mm, dd, k, u, w):
+    """Adds one optimisation window of results: the load, charge and discharge logs (c_log, d_log), SOC and net load
+    (demand_profile) of each time-step, the window's year, month and day of the month (yyyy, mm, dd, first day is 0),
+    and each time-step's demand charge sub-period k, energy price u and wholesale price w."""
+    n = len(load)
+    keep = (sink['steps_seen'] + np.arange(n)) % sink['decimate'] == 0  # Decimation runs across windows
+    sink['steps_seen'] += n
+    n_keep = int(np.count_nonzero(keep))
+    if sink['n'] + n_keep > len(next(iter(sink['buffer'].values()))):
+        verbose_sink_flush(sink)
+        if n_keep > len(next(iter(sink['buffer'].values()))):  # Window longer than the buffer
+            sink['buffer'] = {col: np.empty(n_keep, dtype=buf.dtype) for col, buf in sink['buffer'].items()}
+    values = {'yyyy': yyyy, 'mm': mm, 'dd': dd + 1,  # +1 to match labels in python output
+              'period': np.arange(1, n + 1), 'k': k, 'u': u, 'w': w, 'load': load, 'net_load': demand_profile,
+              'SOC': SOC_profile}
+    if 'P' in sink['buffer']:
+        values['P'] = np.asarray(c_log) - np.asarray(d_log)
+    rows = slice(sink['n'], sink['n'] + n_keep)
+    for col, buf in sink['buffer'].items():
+        buf[rows] = np.asarray(values[col])[keep] if np.ndim(values[col]) else values[col]
+    sink['n'] += n_keep
+
+
+def verbose_sink_flush(sink):
+    """Writes the buffered rows to disk as one chunk."""
+    if sink['n'] == 0:
+        return
+    chunk = {col: buf[:sink['n']] for col, buf in sink['buffer'].items()}
+    if sink['format'] == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.table(chunk)
+        if sink['writer'] is None:
+            sink['writer'] = pq.ParquetWriter(sink['path'], table.schema)
+        sink['writer'].write_table(table)  # One row group per chunk
+    elif sink['format'] == 'hdf5':
+        import h5py
+        if sink['writer'] is None:
+            sink['writer'] = h5py.File(sink['path'], 'w')
+            sink['writer'].attrs['columns'] = list(chunk)
+            for col, values in chunk.items():
+                sink['writer'].create_dataset(col, shape=(0,), maxshape=(None,), dtype=values.dtype,
+                                              chunks=(max(len(values), 1),))
+        for col, values in chunk.items():
+            dataset = sink['writer'][col]
+            dataset.resize((sink['rows_written'] + len(values),))
+            dataset[sink['rows_written']:] = values
+        sink['writer'].flush()
+    else:
+        index = pd.RangeIndex(sink['rows_written'], sink['rows_written'] + sink['n'])
+        pd.DataFrame(chunk, index=index).to_csv(sink['path'], mode='a', header=sink['rows_written'] == 0)
+    sink['rows_written'] += sink['n']
+    sink['n'] = 0
+
+
+def verbose_sink_close(sink):
+    verbose_sink_flush(sink)
+    if sink['writer'] is not None:
+        sink['writer'].close()
+        sink['writer'] = None
+
+
+def read_verbose_results(path):
+    """Reads a verbose results file written by any of the sink formats into a DataFrame."""
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.h5'):
+        import h5py
+        with h5py.File(path, 'r') as f:
+            return pd.DataFrame({col: f[col][:] for col in f.attrs['columns']})
+    return pd.read_csv(path, index_col=0)